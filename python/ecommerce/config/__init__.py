@@ -3,11 +3,18 @@
 by Alejo Sanchez, Jose Luis Campanello and Mariano Goldsman
 '''
 
+import os
 import re
-from yaml       import safe_load
+import signal
+import threading
+import logging
 
 from loader     import *
 from keychain   import *
+from snapshot   import loadParsed
+
+# reload and subscriber failures are reported here
+_log = logging.getLogger("ecommerce.config")
 
 class Config(object):
     '''Configuration parser
@@ -20,8 +27,11 @@ class Config(object):
         if configLoader is None:
             configLoader = loader.getDefaultLoader()
 
-        # read and parse the configuration
-        self.conf = safe_load(configLoader.load())
+        # keep the loader state (before reading, so changes are not missed)
+        self._signature = configLoader.signature()
+
+        # read and parse the configuration (or get it from the parsed cache)
+        self.conf = loadParsed(configLoader, self._signature)
 
         # Prepare the regexp for get syntax
         self.__syntaxDot = re.compile("^\.?[\w\-\ ]+(\[\d+\])?(\.[\w\-\ ]+(\[\d+\])?)*$")
@@ -36,6 +46,12 @@ class Config(object):
         return self._keychain
 
 
+    @property
+    def signature(self):
+        """The loader signature at the time the config was read"""
+        return self._signature
+
+
     def len(self):
         return len(self.conf)
 
@@ -100,7 +116,17 @@ class Config(object):
             return default
 
 
+# lazy initialization: when True, modules that initialize at import time
+# (ecommerce.db, ecommerce.db.dataset, ecommerce.db.codetables, tmklib.cache
+# and tmklib.url) wait until first used. Set it before importing them (or
+# use ECOMMERCE_LAZY_INIT=1) and call their initialize() to pre-warm.
+lazyInit = os.environ.get("ECOMMERCE_LAZY_INIT", "").lower() not in ("", "0", "no", "false")
+
 _cachedConfig = None
+_cachedLoader = None
+_subscribers  = [ ]
+_reloadLock   = threading.RLock()
+_watcher      = None
 
 
 def getConfig(configLoader = None):
@@ -108,17 +134,147 @@ def getConfig(configLoader = None):
 
     The configuration is expected to be a singleton in the sense that
     parsing it multiple times to get the same result is sub-optimal.
-    A SIGHUP signal shall be caugth to re-read the configuration.
+    The configuration can be re-read by calling reloadConfig (see
+    installReloadSignal and startWatcher to have that done automatically).
     """
     global _cachedConfig
+    global _cachedLoader
 
     # if needed, read the config
     if _cachedConfig is None:
-        _cachedConfig = Config(configLoader)
+        with _reloadLock:
+            if _cachedConfig is None:
+                if configLoader is None:
+                    configLoader = loader.getDefaultLoader()
+                _cachedLoader = configLoader
+                _cachedConfig = Config(configLoader)
 
     return _cachedConfig
 
 
+def reloadConfig(force = False):
+    """Re-read the configuration and notify the subscribers
+
+    The new configuration is parsed before replacing the current one, so
+    users of getConfig always see a complete configuration. If the loader
+    reports no changes (and force is False) nothing is done. Returns the
+    current configuration.
+    """
+    global _cachedConfig
+
+    with _reloadLock:
+
+        # nothing loaded yet => plain load
+        if _cachedConfig is None:
+            return getConfig()
+
+        # check if something changed
+        previous  = _cachedConfig
+        signature = _cachedLoader.signature()
+        if not force and signature is not None and signature == previous.signature:
+            return previous
+
+        # parse and swap
+        config = Config(_cachedLoader)
+        _cachedConfig = config
+
+        # let everybody know
+        for callback in list(_subscribers):
+            try:
+                callback(config)
+            except:
+                _log.exception("subscriber %r failed on reload", callback)
+
+    return config
+
+
+def subscribe(callback):
+    """Register a callback to be called with the new config on reload"""
+
+    with _reloadLock:
+        if callback not in _subscribers:
+            _subscribers.append(callback)
+
+
+def unsubscribe(callback):
+    """Remove a callback registered with subscribe"""
+
+    with _reloadLock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+
+def _backgroundReload(force = False):
+    """Reload the config, reporting (and surviving) errors"""
+
+    try:
+        reloadConfig(force)
+    except:
+        _log.exception("reload failed, keeping current config")
+
+
+def installReloadSignal(signum = None):
+    """Reload the configuration (in a background thread) on a signal
+
+    The default signal is SIGHUP. Must be called from the main thread.
+    """
+
+    # figure out the signal (windows has no SIGHUP)
+    if signum is None:
+        signum = getattr(signal, "SIGHUP", None)
+    if signum is None:
+        return False
+
+    def handler(signum, frame):
+        t = threading.Thread(target = _backgroundReload, args = (True, ))
+        t.daemon = True
+        t.start()
+
+    signal.signal(signum, handler)
+    return True
+
+
+class ConfigWatcher(threading.Thread):
+    """Polls the config loader and reloads the config when it changes"""
+
+    def __init__(self, period = 5):
+        threading.Thread.__init__(self, name = "ecommerce.config.watcher")
+        self.daemon     = True
+        self._period    = period
+        self._stopEvent = threading.Event()
+
+
+    def run(self):
+        while not self._stopEvent.wait(self._period):
+            _backgroundReload()
+
+
+    def stop(self):
+        self._stopEvent.set()
+
+
+def startWatcher(period = 5):
+    """Start polling the config fragments every period seconds"""
+    global _watcher
+
+    with _reloadLock:
+        if _watcher is None:
+            _watcher = ConfigWatcher(period)
+            _watcher.start()
+
+    return _watcher
+
+
+def stopWatcher():
+    """Stop the config watcher (if running)"""
+    global _watcher
+
+    with _reloadLock:
+        if _watcher is not None:
+            _watcher.stop()
+            _watcher = None
+
+
 def getConfigFromString(config = ""):
     """Return a Config object loaded with the passed in config."""
 
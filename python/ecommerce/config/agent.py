@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""Keychain agent
+
+Loading the keychain means parsing YAML, deriving the master key and
+decrypting with triple-DES. Short lived processes pay for that every time
+they start. The keychain agent is a small per host (and per user) daemon
+that keeps a loaded keychain and answers fetch requests over a Unix socket.
+When the agent socket exists, Keychain.fetch asks the agent first and
+falls back to loading the keychain in-process if the agent is not there.
+
+Access control is done with file permissions: the socket (0600) lives in
+a folder only the owner can access (0700) and, on Linux, the agent also
+checks the peer credentials of each connection, only serving processes of
+its own user (root included: root can read the keychain file anyway, but
+it gets no shortcut thru the agent of another user). The client refuses to
+talk to a socket (or in a folder) that is not private to the current user.
+No network is used.
+
+The socket path is taken from keychain.agent (false disables the agent)
+or defaults to ecommerce-keychain-{uid}/agent.sock in the temp dir.
+
+The protocol is line based, every argument is hexa encoded:
+
+    FETCH {keychain file} {key}     -> OK {value} | NONE | KEYERROR {msg} | ERR {msg}
+    PING                            -> OK
+    STOP                            -> OK (and the agent exits)
+
+usage: python -m ecommerce.config.agent <command>   (see command help)
+"""
+
+import sys
+import os
+import os.path
+import socket
+import stat
+import struct
+import binascii
+import tempfile
+import threading
+import traceback
+import SocketServer
+
+# seconds to wait for the agent before falling back
+timeout = 2.0
+
+
+def available():
+    """True if the platform supports the agent"""
+
+    return hasattr(socket, "AF_UNIX")
+
+
+def defaultSocket():
+    """The default agent socket path for the current user"""
+
+    folder = os.path.join(tempfile.gettempdir(), "ecommerce-keychain-%d" % os.getuid())
+    return os.path.join(folder, "agent.sock")
+
+
+def getSocket(config):
+    """The agent socket path from the configuration (None if disabled)"""
+
+    # not supported here
+    if not available():
+        return None
+
+    # configured (False / "" disables the agent)
+    path = config.get("keychain.agent", True)
+    if path is None or path is False or path == "":
+        return None
+    if path is True:
+        path = defaultSocket()
+
+    return path
+
+
+def _isPrivate(folder):
+    """True if the folder belongs to us and nobody else can access it"""
+
+    try:
+        st = os.stat(folder)
+    except OSError:
+        return False
+
+    return st.st_uid == os.getuid() and (st.st_mode & 0077) == 0
+
+
+def _isOwnSocket(path):
+    """True if the socket belongs to us and nobody else can connect"""
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and (st.st_mode & 0077) == 0
+
+
+#####################################################################
+#####################################################################
+#
+# CLIENT SIDE
+#
+
+class AgentUnavailable(Exception):
+    """The agent is not running or cannot serve the request"""
+    pass
+
+
+def _request(path, *args):
+    """Send a request to the agent and return the response parts"""
+
+    # only talk to private agents (in a private folder)
+    if not os.path.exists(path):
+        raise AgentUnavailable("No agent at [%s]" % path)
+    if not _isPrivate(os.path.dirname(path)) or not _isOwnSocket(path):
+        raise AgentUnavailable("Agent at [%s] is not private" % path)
+
+    # send the request and read a single line
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(" ".join([ args[0] ] + [ binascii.hexlify(a) for a in args[1:] ]) + "\n")
+        f = s.makefile("r")
+        line = f.readline()
+        f.close()
+    except socket.error as ex:
+        raise AgentUnavailable("Agent at [%s] failed: %s" % (path, ex))
+    finally:
+        s.close()
+
+    # check the response
+    parts = line.split()
+    if len(parts) == 0:
+        raise AgentUnavailable("Agent at [%s] closed the connection" % path)
+
+    return [ parts[0] ] + [ binascii.unhexlify(p) for p in parts[1:] ]
+
+
+def fetch(path, keychainPath, key):
+    """Fetch a key thru the agent
+
+    Raises AgentUnavailable if the agent cannot answer (the caller
+    should fall back to the in-process keychain) and KeyError if the key
+    is not valid.
+    """
+
+    response = _request(path, "FETCH", keychainPath or "", key)
+    if response[0] == "OK" and len(response) == 2:
+        return response[1]
+    if response[0] == "NONE":
+        return None
+    if response[0] == "KEYERROR":
+        raise KeyError(response[1] if len(response) > 1 else key)
+
+    raise AgentUnavailable(response[1] if len(response) > 1 else "Unexpected agent response")
+
+
+def ping(path):
+    """True if the agent is running"""
+
+    try:
+        return _request(path, "PING")[0] == "OK"
+    except AgentUnavailable:
+        return False
+
+
+def stop(path):
+    """Ask the agent to exit"""
+
+    return _request(path, "STOP")[0] == "OK"
+
+
+#####################################################################
+#####################################################################
+#
+# AGENT SIDE
+#
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """Handles the requests on a connection"""
+
+    def handle(self):
+
+        # check the peer (linux only)
+        if not self.server.allowed(self.request):
+            return
+
+        for line in self.rfile:
+
+            parts = line.split()
+            if len(parts) == 0:
+                continue
+
+            try:
+                args = [ binascii.unhexlify(p) for p in parts[1:] ]
+                response = self.server.dispatch(parts[0], args)
+            except KeyError as ex:
+                response = [ "KEYERROR", str(ex.args[0] if ex.args else ex) ]
+            except Exception as ex:
+                response = [ "ERR", "%s: %s" % (ex.__class__.__name__, ex) ]
+
+            self.wfile.write(" ".join([ response[0] ] +
+                                      [ binascii.hexlify(r) for r in response[1:] ]) + "\n")
+            self.wfile.flush()
+
+
+class KeychainAgent(SocketServer.ThreadingUnixStreamServer):
+    """The agent server, serves the keychain of the passed in config"""
+
+    daemon_threads = True
+
+    def __init__(self, config, path = None):
+
+        # avoid the import cycle (keychain uses this module)
+        from ecommerce.config.keychain import Keychain
+
+        # where to listen
+        if path is None:
+            path = getSocket(config)
+        if path is None:
+            raise IOError("Keychain agent is disabled or not supported")
+        self._path = path
+        self._uid  = os.getuid()
+
+        # load the keychain now (that's the whole point)
+        self._keychain = Keychain(config, useAgent = False)
+        self._keychain._ensureLoaded()
+
+        # prepare a private folder and remove stale sockets
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, 0700)
+        if not _isPrivate(folder):
+            raise IOError("Keychain agent folder [%s] is not private" % folder)
+        if os.path.exists(path):
+            if ping(path):
+                raise IOError("Keychain agent already running at [%s]" % path)
+            os.remove(path)
+
+        # listen (socket only accessible by the owner)
+        oldMask = os.umask(0177)
+        try:
+            SocketServer.ThreadingUnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(oldMask)
+
+
+    def allowed(self, conn):
+        """Check the peer credentials (where supported), only our own user is served"""
+
+        if not sys.platform.startswith("linux"):
+            return True     # rely on the folder permissions
+
+        SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+        creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i"))
+        (pid, uid, gid) = struct.unpack("3i", creds)
+
+        return uid == self._uid
+
+
+    def dispatch(self, command, args):
+        """Execute a command and return the response parts"""
+
+        if command == "PING":
+            return [ "OK" ]
+
+        if command == "STOP":
+            t = threading.Thread(target = self.shutdown)
+            t.daemon = True
+            t.start()
+            return [ "OK" ]
+
+        if command == "FETCH" and len(args) == 2:
+            (keychainPath, key) = args
+
+            # only serve clients using the same keychain file
+            if keychainPath != (self._keychain._fullPath or ""):
+                return [ "ERR", "Agent serves a different keychain" ]
+
+            value = self._keychain.fetch(key)
+            return [ "NONE" ] if value is None else [ "OK", str(value) ]
+
+        return [ "ERR", "Unknown command [%s]" % command ]
+
+
+    def server_close(self):
+        SocketServer.ThreadingUnixStreamServer.server_close(self)
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+
+###################################################
+
+def cmdServe():
+    """Run the agent in the foreground"""
+
+    import ecommerce.config
+
+    agent = KeychainAgent(ecommerce.config.getConfig())
+    print "Keychain agent listening on %s" % agent._path
+    try:
+        agent.serve_forever()
+    finally:
+        agent.server_close()
+
+    return True
+
+###################################################
+
+def cmdStart():
+    """Run the agent in the background"""
+
+    import ecommerce.config
+
+    # create the agent before forking so errors are reported
+    agent = KeychainAgent(ecommerce.config.getConfig())
+
+    if os.fork() != 0:
+        print "Keychain agent started on %s" % agent._path
+        os._exit(0)
+
+    # detach
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+    try:
+        agent.serve_forever()
+    except:
+        traceback.print_exc()
+    finally:
+        agent.server_close()
+    os._exit(0)
+
+###################################################
+
+def cmdStop():
+    """Stop a running agent"""
+
+    import ecommerce.config
+
+    path = getSocket(ecommerce.config.getConfig())
+    try:
+        stop(path)
+        print "Keychain agent stopped"
+    except AgentUnavailable:
+        print "Keychain agent not running"
+
+    return True
+
+###################################################
+
+def cmdStatus():
+    """Tell if the agent is running"""
+
+    import ecommerce.config
+
+    path = getSocket(ecommerce.config.getConfig())
+    print "Keychain agent %s (%s)" % ("running" if path and ping(path) else "not running", path)
+
+    return True
+
+###################################################
+
+def cmdHelp():
+    """Print usage help"""
+
+    print """
+usage: python -m ecommerce.config.agent <command>
+
+where command is one of:
+
+- serve --- run the keychain agent in the foreground
+- start --- run the keychain agent in the background
+- status --- tell if the keychain agent is running
+- stop --- stop the keychain agent
+- help --- this screen
+"""
+
+    return True
+
+###################################################
+
+commands = {
+    "serve":        cmdServe,
+    "start":        cmdStart,
+    "status":       cmdStatus,
+    "stop":         cmdStop,
+    "help":         cmdHelp
+}
+
+def main():
+
+    # figure out the command (default is help)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "help"
+    if cmd not in commands:
+        cmd = "help"
+
+    # dispatch the command
+    commands[cmd]()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,12 +8,22 @@ passwords.
 
 import random
 import hashlib
+import binascii
+import threading
+import time
 
 from os.path   import exists, join as os_path_join
 from yaml      import safe_load
 import pyDes
 
+# optional (much faster) triple-DES implementation
+try:
+    from Crypto.Cipher import DES3
+except ImportError:
+    DES3 = None
+
 from loader    import *
+import agent
 
 defaultConfig = """
 ---
@@ -44,9 +54,21 @@ class Keychain(object):
     Two configuration variables are required:
     - keychain.file (default keychain.yaml)
     - keychain.dirs (defaults to [ "./config", "/etc/ecommerce" ])
+
+    Optional configuration variables:
+    - keychain.cache-ttl (default None) seconds a decrypted key is kept,
+      None keeps it forever and 0 disables the cache
+    - keychain.cipher (default "auto") triple-DES implementation, one of
+      "pydes", "pycrypto" (the Crypto package) or "auto" (pycrypto if
+      installed, else pydes)
+    - keychain.agent (default True) the keychain agent socket path, True
+      for the default path or False to never use the agent (see agent.py)
+
+    The keychain file is loaded (and the master key calculated) the first
+    time a key cannot be fetched from the keychain agent.
     """
 
-    def __init__(self, config = None):
+    def __init__(self, config = None, useAgent = True):
 
         # be sure we have a config or create one with default values
         if config is None:
@@ -55,14 +77,37 @@ class Keychain(object):
         # get the config
         self._fileName = config.get("keychain.file")
         self._dirNames = config.get("keychain.dirs", [ ])
+        self._cacheTTL = config.get("keychain.cache-ttl")
+        self._cipher   = config.get("keychain.cipher", "auto")
+
+        # decrypted keys cache: key -> (value, expiration time or None)
+        self._cache    = { }
+
+        # the keychain agent socket (None if not using the agent)
+        self._agent    = agent.getSocket(config) if useAgent else None
 
-        # find and load the keychain file
+        # find the keychain file (loaded when first needed)
         self._fullPath = self._keychainFind()
-        self._keychain = self._keychainLoad()
+        self._keychain = None
+        self._lock     = threading.Lock()
 
-        # figure out the master key
-        self._getMasterKey()
 
+    def _ensureLoaded(self):
+        """Load the keychain file and figure out the master key (just once)"""
+
+        with self._lock:
+            if self._keychain is not None:
+                return
+
+            # load the keychain file
+            self._keychain = self._keychainLoad()
+
+            # figure out the master key (if it fails, retry next time)
+            try:
+                self._getMasterKey()
+            except:
+                self._keychain = None
+                raise
 
 
     def _keychainFind(self):
@@ -95,8 +140,8 @@ class Keychain(object):
         keys = f.read()
         f.close()
 
-        # parse the keychain
-        return safe_load(keys)
+        # parse the keychain (an empty file is an empty keychain)
+        return safe_load(keys) or { }
 
 
     def _getMasterKey(self):
@@ -123,12 +168,8 @@ class Keychain(object):
         # get the data
         data = self._keychain["master-key"]["data"]
 
-        # initialize the random seed
-        random.seed(data)
-
         # generate 4kb random data to calculate the master key
-        self._mkSeed        = "".join( [ "%02.2x" % random.randint(0, 255)
-                                         for i in range(4096) ] )
+        self._mkSeed        = _masterKeySeed(data)
         self._mkSeedDigest  = hashlib.sha512(self._mkSeed).digest()
 
 
@@ -144,12 +185,51 @@ class Keychain(object):
         if not key.startswith("keychain:"):
             return key
 
+        # already decrypted?
+        cached = self._cache.get(key)
+        if cached is not None and (cached[1] is None or cached[1] > time.time()):
+            return cached[0]
+
         # get the key parts
         parts = key.split(":")
         if len(parts) != 3:
             raise KeyError("Key [%s] is not a valid keychain id" % key)
         (protocol, keyName, keyValue) = (parts[0], parts[1], parts[2])
 
+        # try the agent, else do it ourselves
+        try:
+            value = self._agentFetch(key)
+        except agent.AgentUnavailable:
+            value = self._localFetch(key, protocol, keyName, keyValue)
+
+        # keep it (unless the cache is disabled)
+        if self._cacheTTL != 0:
+            expires = None if self._cacheTTL is None else time.time() + self._cacheTTL
+            self._cache[key] = (value, expires)
+
+        return value
+
+
+    def _agentFetch(self, key):
+        """Fetch a key thru the keychain agent (raises AgentUnavailable)"""
+
+        # no agent or already failed
+        if self._agent is None or self._keychain is not None:
+            raise agent.AgentUnavailable("Not using the keychain agent")
+
+        try:
+            return agent.fetch(self._agent, self._fullPath, key)
+        except agent.AgentUnavailable:
+            self._agent = None      # don't try again
+            raise
+
+
+    def _localFetch(self, key, protocol, keyName, keyValue):
+        """Fetch a key from the (in-process) keychain"""
+
+        # be sure we have the keychain
+        self._ensureLoaded()
+
         # if the key is not in the keychain, raise
         if keyName not in self._keychain:
             raise KeyError("Key [%s] not in keychain" % keyName)
@@ -186,14 +266,41 @@ class Keychain(object):
 
         # get the encripted value and convert to binary (input is hexa string)
         ciphertext = self._keychain[keyName]["data"].get(keyValue)
-        ciphertext = "".join([ chr(int(ciphertext[i:i+2], 16)) for i in range(0, len(ciphertext), 2) ])
+        ciphertext = binascii.unhexlify(ciphertext)
 
         # get the 3des key and iv
         mKey = self._mkSeedDigest[0:24]
         mIV  = self._mkSeedDigest[-8:]
 
+        # use the fast implementation if we can
+        if DES3 is not None and self._cipher in ("auto", "pycrypto"):
+            try:
+                value = DES3.new(mKey, DES3.MODE_CBC, mIV).decrypt(ciphertext)
+                return value[:-ord(value[-1])]      # PKCS5 unpad (as pyDes)
+            except ValueError:
+                pass        # key rejected (degenerates to single DES) => pyDes
+
         # create the triple-des object and decrypt
         cipher = pyDes.triple_des(mKey, pyDes.CBC, mIV, pad=None, padmode=pyDes.PAD_PKCS5)
         value = cipher.decrypt(ciphertext)
 
         return value
+
+
+def _masterKeySeed(data):
+    """Returns the 4kb (hexa) random data the master key is calculated from
+
+    Produces exactly the same output as seeding random with data and joining
+    4096 "%02.2x" % random.randint(0, 255), without touching the global
+    random generator. randint(0, 255) is int(random() * 256), which is the
+    top byte of the first of the two 32 bit words consumed by each random()
+    call, so the words are generated at once with getrandbits (word i at
+    bit 32 * i) and every other top byte is picked from the hexa dump.
+    """
+
+    # 2 words (64 bits) per byte
+    bits = random.Random(data).getrandbits(64 * 4096)
+    hexa = "%0*x" % (16 * 4096, bits)
+
+    # the first word of each pair starts 8 hexa digits from the right of the pair
+    return "".join([ hexa[p + 8 : p + 10] for p in xrange(len(hexa) - 16, -1, -16) ])
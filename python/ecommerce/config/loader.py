@@ -10,6 +10,8 @@ import sys
 import os
 import os.path
 import platform
+import time
+import hashlib
 
 #
 # default config folders (as usual, windows is "special")
@@ -23,6 +25,11 @@ if "ECOMMERCE_CONFIG_DIR" in os.environ:
 
 defaultFragmentList = [ "global", "local" ]
 
+# file systems keep modification times this precise (seconds), a file
+# modified within a tick can change again keeping its mtime (2 seconds
+# when the mtimes are whole seconds)
+mtimeTick = 0.1
+
 class ConfigLoader(object):
     """Base loader class"""
 
@@ -42,6 +49,31 @@ class ConfigLoader(object):
         raise NotImplementedError("hasFragment method not implemented")
 
 
+    def fragmentSignature(self, fragment):
+        """Returns a value that changes when the fragment changes
+
+        None means the loader cannot tell (the fragment is never
+        considered to have changed).
+        """
+
+        return None
+
+
+    def signature(self):
+        """Returns a value that changes when any fragment changes
+
+        Used to figure out if the configuration needs to be re-read.
+        Returns None if any fragment cannot be tracked.
+        """
+
+        # get every fragment signature
+        signatures = [ self.fragmentSignature(f) for f in self._fragments ]
+        if None in signatures:
+            return None
+
+        return tuple(signatures)
+
+
     def load(self):
         """Loads all the configuration fragments and returns a single string"""
 
@@ -50,7 +82,7 @@ class ConfigLoader(object):
         for f in self._fragments:
             fragment = self.loadFragment(f)
             if fragment is not None:
-                config += "\n" + self.loadFragment(f)
+                config += "\n" + fragment
         return config
 
 
@@ -84,6 +116,38 @@ class ConfigLoaderFileSystem(ConfigLoader):
         return os.path.exists(self._getFileName(fragment))
 
 
+    def fragmentSignature(self, fragment):
+        """The fragment file name, modification time, size and inode (and
+        a hash of the content if modified within a tick of now, as another
+        change could keep the same mtime and size)"""
+
+        # a missing (or unreadable) file also has a signature
+        # (so we notice it appearing)
+        fileName = self._getFileName(fragment)
+        try:
+            st = os.stat(fileName)
+        except OSError:
+            return (fileName, None)
+        if not os.access(fileName, os.R_OK):
+            return (fileName, None)
+
+        signature = (fileName, st.st_mtime, st.st_size, st.st_ino)
+
+        # modified too recently to trust the mtime
+        tick = 2 if st.st_mtime == int(st.st_mtime) else mtimeTick
+        if time.time() - st.st_mtime < tick:
+            try:
+                f = open(fileName, "rb")
+                try:
+                    signature += (hashlib.sha1(f.read()).hexdigest(), )
+                finally:
+                    f.close()
+            except IOError:
+                return (fileName, None)
+
+        return signature
+
+
     def _getFileName(self, fragment):
         """Returns the fragment file name"""
 
@@ -127,6 +191,18 @@ class ConfigLoaderMultiplexor(ConfigLoader):
         return False
 
 
+    def fragmentSignature(self, fragment):
+        """The signature of the first loader that has the fragment"""
+
+        # try each loader
+        for l in self._loaders:
+            if l.hasFragment(fragment):
+                return l.fragmentSignature(fragment)
+
+        # nobody has it (yet)
+        return ("missing", fragment)
+
+
 class ConfigLoaderStrings(ConfigLoader):
     """Load config from strings"""
 
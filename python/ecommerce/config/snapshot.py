@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Parsed config cache
+
+Parsing the configuration with the pure python YAML loader is slow and
+every tool and worker does it at startup. This file keeps the parsed
+configuration keyed by the loader signature (the file name, modification
+time, size and inode of every fragment, plus a content hash of the ones
+modified within a tick, see ConfigLoaderFileSystem.fragmentSignature) both
+in memory and as a marshal snapshot on disk, so a process only parses YAML
+when a fragment changed.
+
+Fragments are cached together (not one by one) because they share YAML
+anchors: a fragment can use an anchor defined in a previous fragment.
+
+The snapshot folder is taken from ECOMMERCE_CONFIG_CACHE_DIR (empty to
+disable snapshots) or defaults to a per user folder in the temp dir.
+"""
+
+import os
+import os.path
+import marshal
+import hashlib
+import tempfile
+
+import yaml
+
+# use libyaml if available
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# bump when the snapshot layout changes
+_version = 1
+
+# the snapshot folder (None = not figured out yet, "" = disabled)
+snapshotFolder = os.environ.get("ECOMMERCE_CONFIG_CACHE_DIR")
+
+# in memory cache: signature -> marshaled config
+_parsed = { }
+_parsedMax = 16
+
+
+def yamlLoad(text):
+    """Parse YAML text with the fastest safe loader available"""
+
+    return yaml.load(text, Loader = SafeLoader)
+
+
+def loadParsed(configLoader, signature = None):
+    """Return the parsed configuration for the loader
+
+    The signature must be the one returned by configLoader.signature()
+    before reading. If None, the configuration is always parsed.
+    """
+
+    # nothing to key on => just parse
+    if signature is None:
+        return yamlLoad(configLoader.load())
+
+    # in memory (each call gets its own copy)
+    data = _parsed.get(signature)
+
+    # on disk
+    if data is None:
+        data = _snapshotRead(signature)
+
+    # parse and keep
+    if data is None:
+        conf = yamlLoad(configLoader.load())
+        try:
+            data = marshal.dumps(conf)
+        except ValueError:
+            return conf     # has types marshal can't handle, don't cache
+        _snapshotWrite(signature, data)
+
+    # remember
+    if len(_parsed) >= _parsedMax:
+        _parsed.clear()
+    _parsed[signature] = data
+
+    return marshal.loads(data)
+
+
+def _folder():
+    """Return the snapshot folder (created if needed) or None if disabled"""
+
+    global snapshotFolder
+
+    # figure out the default
+    if snapshotFolder is None:
+        user = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "")
+        snapshotFolder = os.path.join(tempfile.gettempdir(), "ecommerce-config-%s" % user)
+
+    # disabled
+    if snapshotFolder == "":
+        return None
+
+    # create it private
+    try:
+        if not os.path.exists(snapshotFolder):
+            os.makedirs(snapshotFolder, 0700)
+
+        # refuse folders other users could write to
+        if hasattr(os, "getuid"):
+            st = os.stat(snapshotFolder)
+            if st.st_uid != os.getuid() or st.st_mode & 0022:
+                return None
+    except OSError:
+        return None
+
+    return snapshotFolder
+
+
+def _snapshotName(folder, signature):
+    """The snapshot file name (depends on the fragment file names only)"""
+
+    names = repr([ s[0] for s in signature ])
+    return os.path.join(folder, hashlib.sha1(names).hexdigest() + ".cache")
+
+
+def _snapshotRead(signature):
+    """Return the marshaled config from the snapshot or None if stale"""
+
+    folder = _folder()
+    if folder is None:
+        return None
+
+    try:
+        f = open(_snapshotName(folder, signature), "rb")
+        try:
+            (version, snapshotSignature, data) = marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    # must be for the same fragments at the same state
+    if version != _version or snapshotSignature != signature:
+        return None
+
+    return data
+
+
+def _snapshotWrite(signature, data):
+    """Write the snapshot (best effort, errors are ignored)"""
+
+    folder = _folder()
+    if folder is None:
+        return
+
+    # write to a temp file and rename so readers never see a partial file
+    fileName = _snapshotName(folder, signature)
+    try:
+        (fd, tmpName) = tempfile.mkstemp(dir = folder)
+        f = os.fdopen(fd, "wb")
+        try:
+            marshal.dump((_version, signature, data), f)
+        finally:
+            f.close()
+        try:
+            os.rename(tmpName, fileName)
+        except OSError:
+            os.remove(tmpName)      # windows won't replace
+    except (IOError, OSError):
+        pass
@@ -28,6 +28,13 @@ _modules = { }
 _defaultDB = None
 _databases = { }
 
+# initialization tracking
+_initialized = False
+
+# config reload tracking
+_reloadable = False     # True if initialized from the default configuration
+_section    = None      # the "db" section the module was initialized from
+
 class DBException(Exception):
     """Generic ecommerce.db exception"""
     pass
@@ -50,6 +57,9 @@ class DBRuntimeException(DBException):
 def hasLooseTypes(dbname = None):
     """Indicates if the named database has loose (SQLite3) or strict (Postgres) types."""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     # use default db if none passed
     if dbname is None:
         dbname = _defaultDB
@@ -66,6 +76,9 @@ def hasLooseTypes(dbname = None):
 def hasEncoding(dbname = None):
     """Indicates if the named database has an encoding other than UTF-8"""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     # use default db if none passed
     if dbname is None:
         dbname = _defaultDB
@@ -82,6 +95,9 @@ def hasEncoding(dbname = None):
 def getConnection(dbname = None):
     """Return a connection to the named database."""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     # use default db if none passed
     if dbname is None:
         dbname = _defaultDB
@@ -115,6 +131,9 @@ def getConnection(dbname = None):
 def getDefaultDB():
     """Return the default database"""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     return _defaultDB
 
 
@@ -196,13 +215,34 @@ def initialize(config = None):
 
     Can use the default configuration or a specified one
     """
-    global _defaultDB, _databases, _modules
+    global _defaultDB, _databases, _modules, _initialized, _reloadable, _section
 
     # call init
     ( _defaultDB, _databases, _modules ) = _init(config)
+    _initialized = True
+
+    # only follow config reloads when using the default configuration
+    _reloadable = config is None
+    _section    = ecommerce.config.getConfig().get("db") if _reloadable else None
+
+
+def _ensureInitialized():
+    """Initialize with the default config on first use (lazy initialization)"""
+
+    if not _initialized:
+        initialize()
+
+
+def _configReloaded(config):
+    """Re-initialize the module if the "db" section changed"""
+
+    if _reloadable and config.get("db") != _section:
+        initialize()
 
-# initialize
-initialize()
+# initialize (unless lazy)
+if not ecommerce.config.lazyInit:
+    initialize()
+ecommerce.config.subscribe(_configReloaded)
 
 # public methods
 __all__ = [ "getConnection", "hasLooseTypes", "dataset", "codetables" ]
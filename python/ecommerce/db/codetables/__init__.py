@@ -80,6 +80,13 @@ from exceptions import DBCodetablesConfigurationException, DBCodetablesRuntimeEx
 import cache
 import translator
 
+# initialization tracking
+_initialized = False
+
+# config reload tracking
+_reloadable = False     # True if initialized from the default configuration
+_section    = None      # the "codetables" section the module was initialized from
+
 
 def translate(desc, data, language = None):
     """Perform translation on data according to desc and language
@@ -94,6 +101,9 @@ def translate(desc, data, language = None):
     if desc is None or data is None:
         return data
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     # create a translation configuration
     prepared = translator.prepare(desc, language)
 
@@ -113,27 +123,56 @@ def translate(desc, data, language = None):
 def list():
     """Get the list of cached code tables"""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     return cache.codeTableList()
 
 
 def getTranslation(table, language = None):
     """Get the translation data for a table"""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     return cache.codeTableFind(table, language)
 
 
 def initialize(config = None):
     """Initialize the module with specific or default config"""
 
+    global _initialized, _reloadable, _section
+
     # initialize the cache
     cache.initialize(config)
 
     # initialize the translator
     translator.initialize(config)
+    _initialized = True
+
+    # only follow config reloads when using the default configuration
+    _reloadable = config is None
+    _section    = ecommerce.config.getConfig().get("codetables") if _reloadable else None
+
+
+def _ensureInitialized():
+    """Initialize with the default config on first use (lazy initialization)"""
+
+    if not _initialized:
+        initialize()
+
+
+def _configReloaded(config):
+    """Re-initialize (dropping the cached tables) if the "codetables" section changed"""
+
+    if _reloadable and config.get("codetables") != _section:
+        initialize()
 
 
-# initialize
-initialize()
+# initialize (unless lazy)
+if not ecommerce.config.lazyInit:
+    initialize()
+ecommerce.config.subscribe(_configReloaded)
 
 
 # public methods
@@ -31,6 +31,13 @@ from solver     import solve, solverInitialize
 # the pre-process function
 _preProcess = None
 
+# initialization tracking
+_initialized = False
+
+# config reload tracking
+_reloadable = False     # True if initialized from the default configuration
+_section    = None      # the "db.dataset" section the module was initialized from
+
 
 def setPreProcess(preProcess = None):
     """Sets the fetch list pre-process funcion
@@ -70,6 +77,9 @@ def fetch(entities, application = None):
     entities -- a list of 3-uples, each being < EntityType, EntityId, DatasetName >
     """
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     #
     # give a chance to pre-process the fetch list and change it
     #
@@ -172,6 +182,9 @@ def fetch(entities, application = None):
 def configApplication(application, config = None):
     """Configures an application and sets the folder where the datasets are"""
 
+    # be sure we are initialized
+    _ensureInitialized()
+
     # tell the loader
     loader.createLoader(application, config)
 
@@ -179,15 +192,41 @@ def configApplication(application, config = None):
 def initialize(config = None):
     """Initialize the module with specific or default config"""
 
+    global _initialized, _reloadable, _section
+
     # initialize the loader
     loaderInitialize(config)
 
     # initialize the solver
     solverInitialize(config)
+    _initialized = True
+
+    # only follow config reloads when using the default configuration
+    _reloadable = config is None
+    _section    = ecommerce.config.getConfig().get("db.dataset") if _reloadable else None
+
+
+def _ensureInitialized():
+    """Initialize with the default config on first use (lazy initialization)"""
+
+    if not _initialized:
+        initialize()
+
+
+def _configReloaded(config):
+    """Re-initialize the default loader and solver if "db.dataset" changed
+
+    Loaders for applications set up with configApplication are kept.
+    """
+
+    if _reloadable and config.get("db.dataset") != _section:
+        initialize()
 
 
-# initialize
-initialize()
+# initialize (unless lazy)
+if not ecommerce.config.lazyInit:
+    initialize()
+ecommerce.config.subscribe(_configReloaded)
 
 # public methods
 __all__ = [ "fetch", "initialize", "configApplication", "setPreProcess" ]
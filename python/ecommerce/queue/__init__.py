@@ -18,12 +18,26 @@ The API is very simple:
 - the returned Queue object has many methods to manipulate the queue, for example:
 
   - item()      - returns a new item (not in the queue)
-  - next()      - returns the next item in the queue
+  - next(blocking, timeout) - returns the next item in the queue (if blocking, waits
+                  for an item for up to timeout seconds or forever if None)
   - lock()      - returns the next item in the queue and locks it (if locking is supported)
   - isEmpty()   - True if the queue is empty
   - done(item)  - marks the item as done (removes from the queue)
   - ready(item) - marks the item as ready (puts the item in the queue)
   - error(item) - marks the item as in error (moves the item to the error list)
+  - nextBatch(n, blocking, timeout) - returns up to n items from the queue
+  - doneBatch(items)  - marks the items as done
+  - readyBatch(items) - marks the items as ready
+  - renew()     - tells the queue the items taken are still being worked on
+  - stats()     - returns a dict with the item counts (pending, work, error, done),
+                  the age of the oldest pending item and the metrics published by
+                  the producers and consumers (see ecommerce.queue.stats, also a
+                  command line tool)
+  - publish()   - publishes the queue metrics (producers and consumers do it every
+                  few seconds when they use the queue)
+
+- to process a queue with a pool of threads or processes, see ecommerce.queue.runner
+  (Runner runs a handler for every item, marking items done or in error)
 
 - the item object supports a few methods:
 
@@ -32,10 +46,16 @@ The API is very simple:
   - locked       - read only property, True if the item is locked (if locking is supported)
   - id           - read only property with the item id
   - creationDate - read only property with the creation date
+  - priority     - setable property, 0 (most urgent) to 9 (default 5), items with a
+                   lower priority number are taken first
+  - notBefore    - setable property (a datetime), the item is not taken before then
+  - key          - setable property, putting an item while an item with the same key
+                   is pending drops the new item (status "coalesced")
+  - coalesced    - read only property, how many items were dropped in favor of this one
 
 - the generic configuration options are as follows:
 
-  {{prefix}}.type       - the queue type (possible values: "folder")
+  {{prefix}}.type       - the queue type (possible values: "folder", "sqlite")
 
 - the folder queue specific configuration options are as follows:
 
@@ -45,6 +65,33 @@ The API is very simple:
   {{prefix}}.errFolder  - the error folder (default "error")
   {{prefix}}.newFolder  - the new item folder (default "new")
   {{prefix}}.doneFolder - the done item folder (default "done")
+  {{prefix}}.workFolder - the folder for items being worked on (default "work")
+  {{prefix}}.keysFolder - the folder for the pending item keys (default "keys")
+  {{prefix}}.statsFolder - the folder for the consumer metrics (default "stats")
+  {{prefix}}.durability - "none" (default): items are written and moved, no syncs
+                          "batch": no file syncs, the queue folder is synced once per
+                          readyBatch and at most every syncInterval seconds for ready
+                          "fsync": every item file and the queue folder are synced
+  {{prefix}}.syncInterval - seconds between folder syncs with "batch" durability (default 1)
+  {{prefix}}.segments   - if True, readyBatch writes the plain items (no key, priority
+                          or delay) in a single segment file (default False, all the
+                          consumers must support segments before turning it on)
+  {{prefix}}.locking    - "queue" (default): a single consumer locks the whole queue
+                          "item": many consumers (processes, hosts sharing the folder)
+                          claim items one by one, unlock(item) puts the item back
+  {{prefix}}.lease      - with "item" locking, seconds before the items of a consumer
+                          that did not use the queue (or call renew()) are put back
+                          in the queue (default 300)
+
+- the sqlite queue specific configuration options are as follows (see queue_sqlite):
+
+  {{prefix}}.file       - the database file (on a local disk)
+  {{prefix}}.keep       - if True, done items are kept (status "done") (default False)
+  {{prefix}}.lease      - seconds before the items of a consumer that did not use the
+                          queue (or call renew()) are put back in the queue (default 300)
+  {{prefix}}.rescan     - seconds between checks for expired leases (default 5)
+  {{prefix}}.durability - "none", "batch" (default) or "fsync" (SQLite synchronous
+                          OFF, NORMAL or FULL)
 
 
 by Jose Luis Campanello
@@ -53,9 +100,13 @@ by Jose Luis Campanello
 from qexceptions import *
 from queue_folder import *
 from queue_folder import QueueFolderLockException
+from runner       import Runner
+
+import queue_sqlite
 
 _queueTypes = {
-    "folder" : queue_folder.create
+    "folder" : queue_folder.create,
+    "sqlite" : queue_sqlite.create
 }
 
 #QueueException              = qexceptions.QueueException
@@ -64,8 +115,12 @@ _queueTypes = {
 #QueueFolderLockException    = queue_folder.QueueFolderLockException
 
 
-def queue(config, prefix, producer = True):
-    """Returns a Queue object of the appropriate type"""
+def queue(config, prefix, producer = True, readOnly = False):
+    """Returns a Queue object of the appropriate type
+
+    A read only queue object (for stats()) does not create anything and
+    cannot put items.
+    """
 
     global _queueTypes
 
@@ -86,9 +141,9 @@ def queue(config, prefix, producer = True):
     creator  = _queueTypes[type]
 
     # return a new queue object
-    return creator(config, prefix, producer)
+    return creator(config, prefix, producer, readOnly)
 
 
 __all__ = [ "queue", "QueueException", "QueueConfigurationException", "QueueRuntimeException",
-            "QueueFolderLockException" ]
+            "QueueFolderLockException", "Runner" ]
 
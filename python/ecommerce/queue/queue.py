@@ -4,16 +4,24 @@ by Jose Luis Campanello
 """
 
 import datetime
+import time
+
+from stats import QueueMetrics, staleAfter, expireAfter
+
+# item priorities go from 0 (most urgent) to 9
+defaultPriority = 5
 
 class Queue(object):
     """Abstract Queue Class
     """
 
-    def __init__(self, config, prefix, producer = True):
+    def __init__(self, config, prefix, producer = True, readOnly = False):
 
         self._config   = config
         self._prefix   = prefix
-        self._producer = producer
+        self._producer = producer or readOnly
+        self._readOnly = readOnly
+        self.metrics   = QueueMetrics(self._producer)
 
 
     def __del__(self):
@@ -25,7 +33,7 @@ class Queue(object):
         raise NotImplementedError("item method not implemented")
 
 
-    def next(self, blocking = False):
+    def next(self, blocking = False, timeout = None):
         """Returns the next item in the queue"""
         raise NotImplementedError("next method not implemented")
 
@@ -60,7 +68,107 @@ class Queue(object):
         raise NotImplementedError("error method not implemented")
 
 
-class QueueItem:
+    def renew(self):
+        """Tells the queue the items taken are still being worked on"""
+        return
+
+
+    def stats(self):
+        """Returns the queue statistics (see ecommerce.queue.stats)"""
+
+        stats = {
+            "type":      self.__class__.__name__,
+            "pending":   None,
+            "work":      None,
+            "error":     None,
+            "done":      None,
+            "oldest":    None,
+        }
+        stats.update(self._counts())
+
+        # the published metrics (not expired), the items enqueued are added up
+        now = time.time()
+        published = sorted([ m for m in self._readMetrics() if now - m["updated"] <= expireAfter ],
+                           key = lambda m: m["id"])
+        for m in published:
+            m["stale"] = now - m["updated"] > staleAfter
+        stats["consumers"] = [ m for m in published if not m.get("producer") ]
+        stats["producers"] = [ m for m in published if m.get("producer") ]
+        stats["enqueued"]  = sum([ m["counts"]["enqueued"] for m in published ])
+
+        return stats
+
+
+    def publish(self, force = False):
+        """Publishes the metrics of this queue object (every few seconds unless forced)"""
+
+        if self._readOnly:
+            return
+        if force or self.metrics.due():
+            self._writeMetrics(self.metrics.snapshot())
+
+
+    def _counts(self):
+        """Returns the item counts (pending, work, error, done) and oldest age"""
+        return { }
+
+
+    def _readMetrics(self):
+        """Returns the metrics published by the producers and consumers"""
+        return [ ]
+
+
+    def _writeMetrics(self, snapshot):
+        """Publishes the metrics snapshot of this queue object (and drops the
+        expired ones)"""
+        return
+
+
+    def _leaveMetrics(self):
+        """Producers publish their last metrics when they are gone (they are
+        left to expire, see ecommerce.queue.stats)"""
+
+        if self._producer and self.metrics.changed():
+            self.publish(True)
+
+
+    def nextBatch(self, n, blocking = False, timeout = None):
+        """Returns up to n items from the queue
+
+        If blocking, waits until there is at least one item (or timeout
+        seconds, if not None, have passed). Queues that can do better
+        than one next() per item should override this.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        items = [ ]
+        while len(items) < n:
+
+            # get the next (stop when empty unless we have to wait)
+            item = self.next()
+            if item is not None:
+                items.append(item)
+                continue
+            if not blocking or len(items) > 0:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.5 if deadline is None else max(0, min(0.5, deadline - time.time())))
+
+        return items
+
+
+    def doneBatch(self, items):
+        """Marks queue items as done (removes from queue)"""
+        return [ self.done(item) for item in items ]
+
+
+    def readyBatch(self, items):
+        """Marks queue items as ready (put in queue)"""
+        return [ self.ready(item) for item in items ]
+
+
+class QueueItem(object):
     """Abstract Queue Item Class
     """
 
@@ -72,6 +180,10 @@ class QueueItem:
         self._creationDate = creationDate
         self._content      = content
         self._locked       = False
+        self._priority     = defaultPriority
+        self._notBefore    = None
+        self._key          = None
+        self._coalesced    = 0
 
 
     def _getContent(self):
@@ -109,10 +221,53 @@ class QueueItem:
         return self._creationDate
 
 
+    def _getPriority(self):
+        """Returns the priority of the item (0 is the most urgent)"""
+        return self._priority
+
+
+    def _setPriority(self, priority):
+        """Sets the priority of the item (before putting it in the queue)"""
+        if priority is None:
+            priority = defaultPriority
+        if priority not in range(10):
+            raise ValueError("Invalid priority [%s], must be 0 to 9" % priority)
+        self._priority = priority
+
+
+    def _getNotBefore(self):
+        """Returns the time (a datetime) before which the item is not delivered"""
+        return self._notBefore
+
+
+    def _setNotBefore(self, notBefore):
+        """Sets the delivery time of the item (before putting it in the queue)"""
+        self._notBefore = notBefore
+
+
+    def _getKey(self):
+        """Returns the coalescing key of the item"""
+        return self._key
+
+
+    def _setKey(self, key):
+        """Sets the coalescing key (items with the same key pending are dropped)"""
+        self._key = key
+
+
+    def _getCoalesced(self):
+        """Returns how many items were coalesced into this one"""
+        return self._coalesced
+
+
     id           = property(_getId)
     status       = property(_getStatus)
     creationDate = property(_getCreationDate)
     locked       = property(_getLocked)
+    priority     = property(_getPriority, _setPriority)
+    notBefore    = property(_getNotBefore, _setNotBefore)
+    key          = property(_getKey, _setKey)
+    coalesced    = property(_getCoalesced)
 
     # need overide
     size         = property(_getSize)
@@ -6,7 +6,10 @@ by Jose Luis Campanello
 import datetime
 import time
 import uuid
-import dircache
+import heapq
+import errno
+import socket
+import hashlib
 import threading
 import shutil
 import re
@@ -18,7 +21,27 @@ import zc.lockfile
 import ecommerce.config
 
 from qexceptions import *
-from queue       import Queue, QueueItem
+from queue       import Queue, QueueItem, defaultPriority
+from stats       import expireAfter
+
+import queue_watch
+import queue_segment
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # windows, key markers are not locked
+
+# folder modification times move in ticks (whole seconds on some filesystems,
+# a few milliseconds on others): a change in the same tick as a listing keeps
+# the mtime the listing saw. Listings not at least a tick after the mtime
+# (2 seconds for whole second mtimes) are not trusted.
+mtimeTick = 0.1
 
 
 #####################################################################
@@ -64,18 +87,53 @@ class QueueFolder(Queue):
 
     Queue items have file names of the form:
 
-        YYYYMMDDhhmmssuuuuuu-aaaaaaaaaaaa-SSSSSSSS.bin
+        [P-]YYYYMMDDhhmmssuuuuuu-aaaaaaaaaaaa-SSSSSSSS[-KKKK...KKKK].bin
 
     where (last 2 fields are in hexa):
-        - YYYYMMDDhhmmssuuuuuu is the timestamp (u is microseconds)
+        - P is the priority (0 is the most urgent), omitted for the default (5)
+        - YYYYMMDDhhmmssuuuuuu is the timestamp (u is microseconds), the
+          item is not delivered before it
         - aaaaaaaaaaaa is the hardware mac address (as returned by uuid.getnode())
         - SSSSSSSS is a sequential number in hexadecimal
+        - KKKK...KKKK is the sha1 of the item key (only for items with a key)
+
+    Items with a key have a marker file (named after the key sha1) in the
+    keys folder while they are pending. Putting an item whose key has a
+    marker drops the new item (the pending one is kept and counts it as
+    coalesced). If the new item is more urgent, the pending one is renamed
+    to the new priority (and due time). The marker is removed when a
+    consumer takes the item, so changes after that point are queued again.
+
+    Consumers keep an index of the pending items (a heap of file names plus
+    a set to know what is in the heap). The queue folder is only listed
+    again when its modification time changes, so taking the head of a large
+    queue does not require listing and sorting the whole folder. The folder
+    is listed anyway every "rescan" seconds, in case a change landed in the
+    same timestamp tick as the last listing. Items whose timestamp is in
+    the future are kept in a separate heap until they are due.
+
+    With "item" locking, many consumers can share the queue. Each consumer
+    claims items by renaming them into its own work folder, named
+
+        hostname-pid-tag
+
+    The modification time of that folder is the consumer lease, renewed
+    every time the consumer uses the queue (or calls renew()). Items held
+    by a consumer that died (same host) or whose lease expired are put
+    back in the queue by the other consumers.
+
+    With "segments" on, readyBatch writes the plain items of a batch (no
+    key, no priority, no delay) as a single segment file (same name, with
+    a .seg extension, see queue_segment). Consumers take a whole segment
+    at once and hand out its items as asked, the segment is removed when
+    all its items are done (items in error are written one by one in the
+    error folder). If a consumer dies, the whole segment is delivered again.
     """
 
-    def __init__(self, config, prefix, producer = True):
+    def __init__(self, config, prefix, producer = True, readOnly = False):
 
         # base class init
-        Queue.__init__(self, config, prefix, producer)
+        Queue.__init__(self, config, prefix, producer, readOnly)
 
         # get other attributes
         self._folder     = config.getMulti(prefix, "folder")
@@ -87,46 +145,97 @@ class QueueFolder(Queue):
         self._newFolder  = config.getMulti(prefix, "newFolder",  "new")
         self._doneFolder = config.getMulti(prefix, "doneFolder", "done")
         self._workFolder = config.getMulti(prefix, "workFolder", "work")
+        self._keysFolder = config.getMulti(prefix, "keysFolder", "keys")
+        self._statsFolder = config.getMulti(prefix, "statsFolder", "stats")
+        self._locking    = config.getMulti(prefix, "locking", "queue")
+        self._lease      = config.getMulti(prefix, "lease", 300)
+        self._durability = config.getMulti(prefix, "durability", "none")
+        self._syncEvery  = config.getMulti(prefix, "syncInterval", 1)
+        self._segments   = config.getMulti(prefix, "segments", False)
         self._errFolder  = self._folder + os.sep + self._errFolder
         self._newFolder  = self._folder + os.sep + self._newFolder
         self._doneFolder = self._folder + os.sep + self._doneFolder
         self._workFolder = self._folder + os.sep + self._workFolder
-        self._pattern    = re.compile("^[0-9]{20}-[0-9a-fA-F]{12}-[0-9a-fA-F]{8}" + self._ext + "$")
+        self._keysFolder = self._folder + os.sep + self._keysFolder
+        self._statsFolder = self._folder + os.sep + self._statsFolder
+        self._workRoot   = self._workFolder
+        self._pattern    = re.compile("^([0-9]-)?[0-9]{20}-[0-9a-fA-F]{12}-[0-9a-fA-F]{8}(-[0-9a-f]{40})?(" +
+                                      self._ext + "|" + queue_segment.extension + ")$")
 
         # only for consumer queue instances, but define for all
         self._seq      = Sequencer(0)
-        self._queue    = [ ]
+        self._heap     = [ ]        # (priority, timestamp, file name) of due items (may have stale entries)
+        self._delayed  = [ ]        # (timestamp, priority, file name) of items not due yet
+        self._pending  = set()      # pending item file names
+        self._mtime    = None       # queue folder modification time when last listed
+        self._scanned  = 0          # when the folder was last listed
+        self._racy     = True       # listed too close to mtime to trust it
+        self._watcher  = None       # folder watcher for blocking waits
+        self._lockFile = None       # queue lock ("queue" locking)
+        self._consumer = None       # consumer id ("item" locking)
+        self._recovered = 0         # when stale leases were last checked
+
+        # items dropped because an item with the same key was pending
+        self.coalesced = 0
+
+        # segments
+        self._buffer   = [ ]        # items of taken segments not handed out yet
+        self._open     = { }        # segment file name -> items not finished
+
+        # folder syncs ("batch" durability)
+        self._dirty    = False      # queue folder changed since last sync
+        self._syncedAt = 0          # when the queue folder was last synced
 
         # check we have a folder
         if self._folder is None:
             raise QueueConfigurationException("Missing folder path for queue [%s]" % prefix)
 
+        # check the locking mode
+        if self._locking not in ("queue", "item"):
+            raise QueueConfigurationException("Unknown locking [%s] for queue [%s]" % (self._locking, prefix))
+
+        # check the durability mode
+        if self._durability not in ("none", "batch", "fsync"):
+            raise QueueConfigurationException("Unknown durability [%s] for queue [%s]" % (self._durability, prefix))
+
+        # a read only queue only looks
+        if self._readOnly:
+            if not os.path.isdir(self._folder):
+                raise QueueRuntimeException("Queue folder [%s] does not exist" % self._folder)
+            return
+
         # be sure all folders exist
         self._ensureFolder(self._folder)
+        self._ensureFolder(self._newFolder)
+        self._ensureFolder(self._keysFolder)
         if not self._producer:
             self._ensureFolder(self._errFolder)
-            self._ensureFolder(self._newFolder)
             self._ensureFolder(self._doneFolder)
             self._ensureFolder(self._workFolder)
 
         # if a consumer, lock the queue
-        if not self._producer:
+        if not self._producer and self._locking == "queue":
             # the pid file
             pidfile = self._folder + os.sep + self._pid
 
             # try locking
-            self._lockFile = None
             try:
                 self._lockFile = zc.lockfile.LockFile(pidfile)
             except zc.lockfile.LockError:
                 raise QueueFolderLockException("Cannot lock queue, pid file [%s]" % pidfile)
 
-        # if there are entries in work, move them to ready
-        #
-        # NOTE: only if we are consumers
-        if not self._producer:
+            # if there are entries in work, move them to ready
             self._undoWork()
 
+        # if a consumer with item locking, get our own work folder
+        if not self._producer and self._locking == "item":
+            self._consumer   = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+            self._workFolder = self._workRoot + os.sep + self._consumer
+            self._ensureFolder(self._workFolder)
+
+            # put back the entries of dead consumers
+            self._recover()
+
         # if not a producer, scan the queue
         if not self._producer:
             self._rescan()
@@ -134,12 +243,33 @@ class QueueFolder(Queue):
 
     def __del__(self):
 
+        # sync the pending folder changes
+        if self._dirty:
+            _syncFolder(self._folder)
+
         # if this is a consumer, unlock the queue
         if not self._producer:
             # release the lock
             if self._lockFile is not None:
                 self._lockFile.close()
 
+            # give back our items and drop our work folder
+            if self._consumer is not None:
+                self._release(self._workFolder)
+
+            # stop watching the folder
+            if self._watcher is not None:
+                self._watcher.close()
+
+        # we are gone, so are our metrics (producers leave the last ones)
+        try:
+            if self._producer:
+                self._leaveMetrics()
+            else:
+                os.remove(self._statsFolder + os.sep + self.metrics.id + ".json")
+        except (IOError, OSError):
+            pass
+
         # base class del
         Queue.__del__(self)
 
@@ -148,7 +278,7 @@ class QueueFolder(Queue):
         """Returns the list of item files in the queue"""
 
         self._rescan()
-        return self._queue
+        return sorted(self._pending, key = _key)
 
 
     def item(self):
@@ -157,40 +287,155 @@ class QueueFolder(Queue):
         return QueueItem(self)
 
 
-    def next(self, blocking = False):
+    def next(self, blocking = False, timeout = None):
         """Returns the next item in the queue"""
 
+        items = self.nextBatch(1, blocking, timeout)
+        return items[0] if len(items) > 0 else None
+
+
+    def nextBatch(self, n, blocking = False, timeout = None):
+        """Returns up to n items from the head of the queue
+
+        If blocking, waits until there is at least one item (or timeout
+        seconds, if not None, have passed).
+        """
+
         # if a producer => error
         if self._producer:
             raise QueueRuntimeException("Queue is not a consumer")
 
+        # items of segments already taken go first
+        items = self._buffer[:n]
+        del self._buffer[:n]
+
         # rescan
         self._rescan()
 
-        # if blocking and empty, wait until list is not empty
-        while blocking and self.isEmpty():
-            # wait half a second and rescan
-            time.sleep(0.5)
-            self._rescan()
+        # renew our lease (and check the others)
+        if self._consumer is not None:
+            self._recoverDue()
 
-        # get the head
-        head = self._head()
-        if head is None:
-            return None
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
 
-        # load the item
-        item = self._load(head, self._folder)
+            # if blocking and empty, wait until list is not empty
+            if blocking and len(items) == 0 and self._isEmpty():
+                if not self._wait(None if deadline is None else max(0, deadline - time.time())):
+                    break
 
-        # move the item to the work
-        self._move(item, self._workFolder, self._folder)
+            while len(items) < n:
 
-        return item
+                # get the heads
+                heads = [ ]
+                while len(heads) < n - len(items):
+                    head = self._pop()
+                    if head is None:
+                        break
+                    heads.append(head)
+                if len(heads) == 0:
+                    break
+
+                # move them to the work folder (all in one go) and load them
+                #
+                # NOTE: items taken by other consumers are skipped
+                items.extend(self._ownChange(self._claim, heads))
+
+            # other consumers may have taken every head, if blocking wait for more
+            if len(items) > 0 or not blocking or (deadline is not None and time.time() >= deadline):
+                break
+
+        # keep the rest of the segments for later
+        if len(items) > n:
+            self._buffer = items[n:] + self._buffer
+            items = items[:n]
+
+        self.metrics.count("dequeued", len(items))
+        self.publish()
+
+        return items
+
+
+    def _claim(self, heads):
+        """Move the item files to the work folder and load them"""
+
+        items = [ ]
+        for head in heads:
+
+            # hold the key marker (if any), nothing is coalesced into the item while it moves
+            marker = self._lockMarker(head)
+            try:
+
+                # move the item to the work (skip it if it is gone)
+                try:
+                    os.rename(self._folder + os.sep + head, self._workFolder + os.sep + head)
+                except OSError:
+                    continue
+
+                # new items with the same key are queued from now on
+                coalesced = self._unmark(head, marker)
+            finally:
+                _unlockMarker(marker)
+
+            # segment => all its items
+            if head.endswith(queue_segment.extension):
+                items.extend(self._loadSegment(head, self._workFolder))
+                continue
+
+            # load the item
+            item = self._load(head, self._workFolder)
+            item._locked    = self._consumer is not None
+            item._coalesced = coalesced
+            items.append(item)
+
+        return items
+
+
+    def _wait(self, timeout = None):
+        """Waits until the queue is not empty, False if timed out
+
+        Uses inotify where available (no CPU while idle, wakes up as soon
+        as an item arrives), otherwise polls with an adaptive backoff.
+        """
+
+        # start watching before rescanning, so no arrival is missed
+        if self._watcher is None:
+            self._watcher = queue_watch.watcher(self._folder)
+
+        deadline = None if timeout is None else time.time() + timeout
+        changed  = False
+        while True:
+
+            # with item locking, someone has to put back stale items
+            if self._consumer is not None:
+                self._recoverDue()
+
+            # rescan (always if the watcher saw a change)
+            self._rescan(changed)
+            if not self._isEmpty():
+                self._watcher.reset()
+                return True
+
+            # wait for a change (up to the deadline)
+            left = None
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+            if self._consumer is not None:
+                left = self._period if left is None else min(left, self._period)
+
+            # until the next delayed item is due
+            due = self._nextDue()
+            if due is not None:
+                left = due if left is None else min(left, due)
+            changed = self._watcher.wait(left) is True
 
 
     def lock(self, blocking = False):
         """Lock queue head and return it
 
-        IMPORTANT: No support for locking here, just do next()
+        IMPORTANT: with "queue" locking the whole queue is locked, just do next()
         """
         return self.next(blocking)
 
@@ -204,41 +449,139 @@ class QueueFolder(Queue):
 
 
     def unlock(self, item):
-        """Unlocks item, leaves it as is
+        """Unlocks item
 
-        IMPORTANT: No support for locking here, do nothing
+        With "item" locking, the item is put back in the queue. With
+        "queue" locking, does nothing (the item is left as is).
         """
 
         # if a producer => error
         if self._producer:
             raise QueueRuntimeException("Queue is not a consumer")
 
+        # put it back in the queue
+        if self._consumer is not None and item is not None and item.locked and \
+           isinstance(item, SegmentItem):
+            self._settle(item, "ready")
+            item._locked = False
+        elif self._consumer is not None and item is not None and item.locked:
+            fname = item.id + self._ext
+            self._ownChange(os.rename, self._workFolder + os.sep + fname, self._folder + os.sep + fname)
+            self._push(fname)
+            item._locked = False
+            item._status = "ready"
+
         return
 
 
+    def renew(self):
+        """Renews the consumer lease ("item" locking)
+
+        Consumers renew their lease every time they use the queue, call
+        this while working on items for longer than the lease.
+        """
+
+        if self._consumer is None:
+            return
+
+        # recreate the folder if someone took it while we were idle
+        try:
+            os.utime(self._workFolder, None)
+        except OSError:
+            self._ensureFolder(self._workFolder)
+
+
     def ready(self, item):
         """Marks queue item as ready (put in queue)"""
 
         # sanity checks
+        if self._readOnly:
+            raise QueueRuntimeException("Queue is read only")
         if item is None:
             raise QueueRuntimeException("Trying to make ready None item")
 
         # figure out the item id
-        item._id = self._makeId()
+        item._id = self._makeId(item.priority, item.notBefore, item.key)
+
+        # drop it if an item with the same key is pending
+        if not self._mark(item):
+            return item
 
         # write the item (goes to ready folder then moved to queue)
-        self._write(item)
+        if self._producer:
+            self._write(item)
+        else:
+            self._ownChange(self._write, item)
+            self._push(item.id + self._ext)
+        self._sync()
+        self.metrics.count("enqueued")
+        self.publish()
 
         # change item status
         item._status = "ready"
 
-        # if not a producer => rescan the queue
-        if not self._producer:
-            self._rescan()
-
         return item
 
 
+    def readyBatch(self, items):
+        """Marks queue items as ready (put in queue)"""
+
+        # sanity checks
+        if self._readOnly:
+            raise QueueRuntimeException("Queue is read only")
+        for item in items:
+            if item is None:
+                raise QueueRuntimeException("Trying to make ready None item")
+
+        # drop the items with the same key as pending items
+        given = items
+        items = [ ]
+        for item in given:
+            item._id = self._makeId(item.priority, item.notBefore, item.key)
+            if self._mark(item):
+                items.append(item)
+
+        # the plain items go in a segment (if enabled)
+        plain   = [ ]
+        segment = None
+        if self._segments:
+            others = [ ]
+            for item in items:
+                if item.key is None and item.notBefore is None and item.priority == defaultPriority:
+                    plain.append(item)
+                else:
+                    others.append(item)
+            if len(plain) > 1:
+                segment = self._writeSegment(plain)
+                items   = others
+            else:
+                plain   = [ ]
+
+        # write all the items in the new folder
+        for item in items:
+            self._writeNew(item)
+        names = [ item.id + self._ext for item in items ]
+        if segment is not None:
+            names.append(segment)
+
+        # move them all to the queue
+        if self._producer:
+            self._renameAll(names, self._newFolder, self._folder)
+        else:
+            self._ownChange(self._renameAll, names, self._newFolder, self._folder)
+            for fname in names:
+                self._push(fname)
+        self._sync(True)
+        self.metrics.count("enqueued", len(items) + len(plain))
+        self.publish()
+
+        # change items status
+        for item in items + plain:
+            item._status = "ready"
+
+        return given
+
+
     def done(self, item):
         """Marks queue item as done (removes from queue)"""
 
@@ -251,7 +594,10 @@ class QueueFolder(Queue):
             raise QueueRuntimeException("Queue is not a consumer")
 
         # delete or move the item
-        if self._keep:
+        if isinstance(item, SegmentItem):
+            # one less in the segment
+            self._settle(item, "done")
+        elif self._keep:
             # move to done folder
             self._move(item, self._doneFolder, self._workFolder, True)
         else:
@@ -260,10 +606,50 @@ class QueueFolder(Queue):
 
         # change item status
         item._status = "done"
+        self.metrics.count("done")
 
         return item
 
 
+    def doneBatch(self, items):
+        """Marks queue items as done (removes from queue)"""
+
+        # sanity checks
+        for item in items:
+            if item is None:
+                raise QueueRuntimeException("Trying to mark None item as done")
+
+        # if a producer => error
+        if self._producer:
+            raise QueueRuntimeException("Queue is not a consumer")
+
+        # items in segments
+        files = [ ]
+        for item in items:
+            if isinstance(item, SegmentItem):
+                self._settle(item, "done")
+            else:
+                files.append(item)
+
+        # delete or move the items
+        if self._keep:
+            # move to done folder (figure out the dated folder once)
+            if len(files) > 0:
+                self._renameAll([ item.id + self._ext for item in files ],
+                                self._workFolder, self._datedFolder(self._doneFolder))
+        else:
+            # remove the items
+            for item in files:
+                self._delete(item, self._workFolder)
+
+        # change items status
+        for item in items:
+            item._status = "done"
+        self.metrics.count("done", len(items))
+
+        return items
+
+
     def error(self, item):
         """Marks queue item as in error (removes from queue)"""
 
@@ -276,33 +662,364 @@ class QueueFolder(Queue):
             raise QueueRuntimeException("Queue is not a consumer")
 
         # move to error folder
-        self._move(item, self._errFolder, self._workFolder, True)
+        if isinstance(item, SegmentItem):
+            self._settle(item, "error")
+        else:
+            self._move(item, self._errFolder, self._workFolder, True)
 
         # change item status
         item._status = "error"
+        self.metrics.count("errors")
 
         return item
 
 
     def _head(self):
         """Returns the head of the queue"""
-        return None if len(self._queue) == 0 else self._queue[0]
+
+        # move the items that are now due
+        if len(self._delayed) > 0:
+            stamp = _stamp()
+            while len(self._delayed) > 0 and self._delayed[0][0] <= stamp:
+                (timestamp, priority, fname) = heapq.heappop(self._delayed)
+                if fname in self._pending:
+                    heapq.heappush(self._heap, (priority, timestamp, fname))
+
+        # drop entries no longer pending
+        while len(self._heap) > 0 and self._heap[0][2] not in self._pending:
+            heapq.heappop(self._heap)
+
+        return None if len(self._heap) == 0 else self._heap[0][2]
+
+
+    def _pop(self):
+        """Removes the head of the queue from the index and returns it"""
+
+        head = self._head()
+        if head is not None:
+            heapq.heappop(self._heap)
+            self._pending.discard(head)
+
+        return head
+
+
+    def _push(self, fname, stamp = None):
+        """Adds an item file to the index"""
+
+        if fname not in self._pending:
+            self._pending.add(fname)
+            (priority, timestamp, fname) = _key(fname)
+            if timestamp > (stamp or _stamp()):
+                heapq.heappush(self._delayed, (timestamp, priority, fname))
+            else:
+                heapq.heappush(self._heap, (priority, timestamp, fname))
 
 
     def _isEmpty(self):
-        """True if the queue is empty"""
-        return True if len(self._queue) == 0 else False
+        """True if the queue has no items due"""
+        return len(self._buffer) == 0 and self._head() is None
+
+
+    def _nextDue(self):
+        """Seconds until the next delayed item is due (None if none)"""
+
+        while len(self._delayed) > 0 and self._delayed[0][2] not in self._pending:
+            heapq.heappop(self._delayed)
+        if len(self._delayed) == 0:
+            return None
+
+        due = _parseStamp(self._delayed[0][0])
+        return max(0, time.mktime(due.timetuple()) + due.microsecond / 1e6 - time.time())
 
 
-    def _makeId(self):
+    def _counts(self):
+        """Returns the item counts and the oldest item age"""
+
+        now   = time.time()
+        stamp = _stamp()
+
+        # pending (and the oldest due)
+        pending = 0
+        oldest  = None
+        for fname in os.listdir(self._folder):
+            if self._pattern.match(fname) is None:
+                continue
+            if fname.endswith(queue_segment.extension):
+                try:
+                    pending += queue_segment.count(self._folder + os.sep + fname)
+                except (IOError, OSError, QueueRuntimeException):
+                    continue
+            else:
+                pending += 1
+            timestamp = _key(fname)[1]
+            if timestamp <= stamp and (oldest is None or timestamp < oldest):
+                oldest = timestamp
+
+        if oldest is not None:
+            due    = _parseStamp(oldest)
+            oldest = max(0, now - time.mktime(due.timetuple()) - due.microsecond / 1e6)
+
+        return {
+            "pending": pending,
+            "oldest":  oldest,
+            "work":    self._countFiles(self._workRoot),
+            "error":   self._countFiles(self._errFolder),
+            "done":    self._countFiles(self._doneFolder) if self._keep else None,
+        }
+
+
+    def _countFiles(self, folder):
+        """Number of item files under a folder (segments count as one)"""
+
+        n = 0
+        for (path, dirs, files) in os.walk(folder):
+            n += len([ fname for fname in files if self._pattern.match(fname) is not None ])
+
+        return n
+
+
+    def _readMetrics(self):
+        """Returns the metrics published by the producers and consumers"""
+
+        metrics = [ ]
+        try:
+            l = os.listdir(self._statsFolder)
+        except OSError:
+            return metrics
+
+        for fname in l:
+            if not fname.endswith(".json"):
+                continue
+            try:
+                f = open(self._statsFolder + os.sep + fname, "r")
+                try:
+                    metrics.append(json.load(f))
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                pass
+
+        return metrics
+
+
+    def _writeMetrics(self, snapshot):
+        """Publishes the metrics in the stats folder (drops the expired ones)"""
+
+        self._ensureFolder(self._statsFolder)
+        fname = self._statsFolder + os.sep + snapshot["id"] + ".json"
+        f = open(fname + ".tmp", "w")
+        try:
+            json.dump(snapshot, f)
+        finally:
+            f.close()
+        os.rename(fname + ".tmp", fname)
+
+        expired = time.time() - expireAfter
+        for other in os.listdir(self._statsFolder):
+            try:
+                if os.stat(self._statsFolder + os.sep + other).st_mtime < expired:
+                    os.remove(self._statsFolder + os.sep + other)
+            except OSError:
+                pass
+
+
+    def _folderMTime(self):
+        """The modification time of the queue folder"""
+
+        try:
+            return os.stat(self._folder).st_mtime
+        except OSError:
+            return None
+
+
+    def _ownChange(self, fcn, *args):
+        """Execute a change on the queue folder done by us
+
+        If nobody else changed the folder since it was last listed, the new
+        modification time is taken as listed (we already know what changed).
+        """
+
+        before = self._folderMTime()
+        result = fcn(*args)
+        if before == self._mtime and not self._racy:
+            self._mtime = self._folderMTime()
+            self._racy  = self._isRacy(self._mtime, time.time())
+
+        return result
+
+
+    def _isRacy(self, mtime, now):
+        """True if a change at now could keep the folder mtime (so it can't be trusted)"""
+
+        if mtime is None:
+            return True
+
+        tick = 2 if mtime == int(mtime) else mtimeTick
+        return now - mtime < tick
+
+
+    def _mark(self, item):
+        """Creates the key marker of the item, False if the item is coalesced
+
+        The marker holds the file name of the pending item plus a "+" for
+        every item coalesced into it. Producers and consumers hold a lock
+        on the marker while they use it (consumers take the item and remove
+        the marker in one go), so an item is never coalesced into one that
+        is being taken and no count is lost. If the new item is more urgent
+        (lower priority number or earlier due time) the pending item is
+        renamed to the most urgent priority and due time of both.
+        """
+
+        # no key, nothing to do
+        if item.key is None:
+            return True
+
+        fname = item.id + self._ext
+        for attempt in range(5):
+
+            # the first with the key wins
+            if self._createMarker(fname):
+                return True
+
+            # the marker of the pending item
+            marker = self._lockMarker(fname)
+            if marker is None:
+                continue        # just taken, try again
+            try:
+                lines = _readMarker(marker[1])
+                if lines is None:
+                    time.sleep(0.01)
+                    continue    # still being created
+
+                # NOTE: an item still being written can't be moved, if the
+                #       new item is more urgent it is queued too (unmarked)
+                pending = lines[0]
+                if os.path.exists(self._folder + os.sep + pending):
+                    pending = self._coalesce(marker, lines, fname)
+                elif not os.path.exists(self._newFolder + os.sep + pending):
+                    pending = None
+                elif _isUrgent(fname, pending):
+                    return True
+                else:
+                    os.write(marker[1], "+")
+
+                if pending is not None:
+                    item._id     = pending[:-len(self._ext)]
+                    item._status = "coalesced"
+                    self.coalesced += 1
+                    self.metrics.count("coalesced")
+                    return False
+
+                # stale marker (item removed by hand, or not written yet:
+                # then both are queued)
+                os.remove(marker[0])
+            finally:
+                _unlockMarker(marker)
+
+        return True
+
+
+    def _coalesce(self, marker, lines, fname):
+        """Counts the item file in the (locked) marker of the pending item
+
+        Returns the pending item file name (None if it is gone).
+        """
+
+        # more urgent => move the pending item
+        pending = lines[0]
+        if _isUrgent(fname, pending):
+            target = _urgentName(fname, pending)
+            try:
+                os.rename(self._folder + os.sep + pending, self._folder + os.sep + target)
+            except OSError:
+                return None
+            os.ftruncate(marker[1], 0)
+            os.write(marker[1], target + "\n" + lines[1])
+            pending = target
+
+        # count one more
+        os.write(marker[1], "+")
+        return pending
+
+
+    def _createMarker(self, fname):
+        """Creates the key marker of an item file, False if it already exists"""
+
+        path = self._keysFolder + os.sep + _keyHash(fname)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0644)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            return False
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, fname + "\n")
+        finally:
+            os.close(fd)
+
+        return True
+
+
+    def _lockMarker(self, fname):
+        """Opens and locks the key marker of an item file
+
+        Returns (path, fd), None if the item has no key or no marker. Use
+        _unlockMarker when done.
+        """
+
+        hash = _keyHash(fname)
+        if hash is None:
+            return None
+
+        path = self._keysFolder + os.sep + hash
+        for attempt in range(5):
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_APPEND | getattr(os, "O_BINARY", 0))
+            except OSError:
+                return None
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # removed (or replaced) while waiting for the lock
+            if _sameFile(fd, path):
+                return (path, fd)
+            os.close(fd)
+
+        return None
+
+
+    def _unmark(self, fname, marker):
+        """Removes the (locked) key marker of a taken item, returns the coalesced count"""
+
+        if marker is None:
+            return 0
+
+        # only if it is ours
+        lines = _readMarker(marker[1])
+        if lines is None or lines[0] != fname:
+            return 0
+        try:
+            os.remove(marker[0])
+        except OSError:
+            pass
+
+        return lines[1].count("+")
+
+
+    def _makeId(self, priority = None, notBefore = None, key = None):
         """Create an id for a queue item
 
-            YYYYMMDDhhmmssuuuuuu-aaaaaaaaaaaa-SSSSSSSS.bin
+            [P-]YYYYMMDDhhmmssuuuuuu-aaaaaaaaaaaa-SSSSSSSS[-KKKK...KKKK].bin
 
         where (last 2 fields are in hexa):
-            - YYYYMMDDhhmmssuuuuuu is the timestamp (u is microseconds)
+            - P is the priority (omitted for the default priority)
+            - YYYYMMDDhhmmssuuuuuu is the timestamp (u is microseconds), now
+              or notBefore (if in the future)
             - aaaaaaaaaaaa is the hardware mac address (as returned by uuid.getnode())
             - SSSSSSSS is a sequential number in hexadecimal
+            - KKKK...KKKK is the sha1 of the key (if any)
         """
 
         # get some data
@@ -310,13 +1027,42 @@ class QueueFolder(Queue):
         node = uuid.getnode()
         seq  = self._seq.next()
 
+        # delayed delivery
+        if notBefore is not None and notBefore > now:
+            now = notBefore
+
         id = "%s-%012x-%08x" % (now.strftime("%Y%m%d%H%M%S%f"), node, seq)
 
+        # priority
+        if priority is not None and priority != defaultPriority:
+            id = "%d-%s" % (priority, id)
+
+        # key
+        if key is not None:
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            id = "%s-%s" % (id, hashlib.sha1(str(key)).hexdigest())
+
         return id
 
 
     def _rescan(self, forced = False):
-        """Rescans the queue directory"""
+        """Rescans the queue directory (if it changed)"""
+
+        # skip if the folder did not change (and we can trust it)
+        now   = time.time()
+        mtime = self._folderMTime()
+        if not forced and not self._racy and mtime == self._mtime and \
+                now - self._scanned < self._period:
+            return
+
+        # remember the state before listing (changes while listing are seen next time)
+        #
+        # a change in the same mtime tick as the listing would keep the same
+        # mtime, so don't trust it until later
+        self._mtime   = mtime
+        self._scanned = now
+        self._racy    = self._isRacy(mtime, now)
 
         # get the queue contents
         l = os.listdir(self._folder)
@@ -330,10 +1076,85 @@ class QueueFolder(Queue):
         # - aaaaaaaaaaaa is the hardware mac address (as returned by uuid.getnode())
         # - SSSSSSSS is a sequential number in hexadecimal
         #
-        q = sorted( [ item for item in l if self._pattern.match(item) is not None ] )
+        current = set(l)
+
+        # forget what is gone (heap entries are dropped when they reach the head)
+        self._pending &= current
+
+        # index what is new
+        stamp = _stamp()
+        for item in current - self._pending:
+            if self._pattern.match(item) is not None:
+                self._push(item, stamp)
+
+
+    def _recoverDue(self):
+        """Renews our lease and checks the others if it is time to"""
+
+        if time.time() - self._recovered >= min(self._period, self._lease):
+            self._recover()
+        else:
+            self.renew()
+
+
+    def _recover(self):
+        """Puts back in the queue the items of dead consumers"""
+
+        self._recovered = time.time()
+        self.renew()
+
+        for name in os.listdir(self._workRoot):
+            path = self._workRoot + os.sep + name
+            if name == self._consumer or not os.path.isdir(path) or not self._isStale(name, path):
+                continue
+
+            # take over the folder (the rename only works for one consumer)
+            claimed = self._workRoot + os.sep + self._consumer + "~" + name
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+
+            self._release(claimed)
+
 
-        # set the new queue list
-        self._queue = q
+    def _isStale(self, name, path):
+        """True if the consumer work folder lease expired"""
+
+        # the folder owner (folders being recovered are owned by the recoverer)
+        try:
+            (host, pid, tag) = name.split("~")[0].rsplit("-", 2)
+            pid = int(pid)
+        except ValueError:
+            return False        # not a consumer folder
+
+        # on the same host, a dead consumer is stale right away
+        if host == socket.gethostname() and not _alive(pid):
+            return True
+
+        # otherwise check the lease
+        try:
+            return time.time() - os.path.getmtime(path) > self._lease
+        except OSError:
+            return False
+
+
+    def _release(self, folder):
+        """Moves the items in a work folder back to the queue and drops the folder"""
+
+        try:
+            l = os.listdir(folder)
+        except OSError:
+            return
+
+        for fname in l:
+            if self._pattern.match(fname) is not None:
+                try:
+                    os.rename(folder + os.sep + fname, self._folder + os.sep + fname)
+                except OSError:
+                    pass
+
+        shutil.rmtree(folder, True)
 
 
     def _undoWork(self):
@@ -347,12 +1168,7 @@ class QueueFolder(Queue):
 
         # move to the ready
         for entry in q:
-
-            # load the item
-            item = self._load(entry, self._workFolder)
-
-            # move the item
-            self._move(item, self._folder, self._workFolder)
+            os.rename(self._workFolder + os.sep + entry, self._folder + os.sep + entry)
 
 
     def _load(self, fname, folder):
@@ -361,14 +1177,91 @@ class QueueFolder(Queue):
         # build the file name
         filename = folder + os.sep + fname
 
-        # get item attributes
+        # get item attributes (one open, no extra stat)
+        #
+        # NOTE: the creation date is the file mtime, moving the file to the
+        #       work folder changes its ctime (on POSIX) but not its mtime
         ext          = self._ext
         id           = fname[:-len(ext)] if fname.endswith(ext) else fname
-        creationDate = datetime.datetime.fromtimestamp(os.path.getctime(filename))
-        content      = open(filename, "r").read()
+        f            = open(filename, "rb")
+        try:
+            creationDate = datetime.datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime)
+            content      = f.read()
+        finally:
+            f.close()
+
+        # create the item (priority and delivery time come from the id)
+        item = QueueItem(self, "work", id, creationDate, content)
+        (priority, timestamp, fname) = _key(fname)
+        item._priority  = priority
+        item._notBefore = _parseStamp(timestamp)
+
+        return item
+
 
-        # create the item
-        return QueueItem(self, "work", id, creationDate, content)
+    def _loadSegment(self, fname, folder):
+        """Load the items of a segment from a folder"""
+
+        # read the segment
+        filename = folder + os.sep + fname
+        f = open(filename, "rb")
+        try:
+            creationDate = datetime.datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime)
+            contents     = queue_segment.unpack(f.read())
+        finally:
+            f.close()
+
+        # nothing in it
+        if len(contents) == 0:
+            os.remove(filename)
+            return [ ]
+
+        # the items (ids are the segment id plus the item number)
+        id    = fname[:-len(queue_segment.extension)]
+        items = [ ]
+        for i in range(len(contents)):
+            item = SegmentItem(self, "work", "%s.%d" % (id, i), creationDate, contents[i])
+            item._segment   = fname
+            item._notBefore = _parseStamp(_key(fname)[1])
+            item._locked    = self._consumer is not None
+            items.append(item)
+        self._open[fname] = len(items)
+
+        return items
+
+
+    def _settle(self, item, status):
+        """An item of a segment is finished, drop the segment when all are"""
+
+        # already finished
+        fname = item._segment
+        if fname is None:
+            return
+        item._segment = None
+
+        # items in error are kept one by one (with an item id of their own)
+        if status == "error":
+            item._id = self._makeId()
+            self._writeFile(self._datedFolder(self._errFolder) + os.sep + item.id + self._ext, item.content)
+
+        # unlocked items go back to the queue one by one
+        if status == "ready":
+            copy = QueueItem(self, content = item.content)
+            self.ready(copy)
+            item._id = copy.id
+
+        # one less
+        self._open[fname] -= 1
+        if self._open[fname] > 0:
+            return
+        del self._open[fname]
+
+        # remove or move the segment
+        path = self._workFolder + os.sep + fname
+        if self._keep:
+            os.rename(path, self._datedFolder(self._doneFolder) + os.sep + fname)
+        else:
+            os.remove(path)
 
 
     def _delete(self, item, folder = None):
@@ -404,38 +1297,50 @@ class QueueFolder(Queue):
             src = self._folder
 
         # if dst path is dated, add the YYYY-MM/YYYY-MM-DD
-        datedpath = ""
         if dated:
-            # format the parts
-            ltime     = time.localtime()
-            part1     = os.sep + time.strftime("%Y-%m", ltime)
-            part2     = os.sep + time.strftime("%Y-%m-%d", ltime)
-
-            # create the part1 (if needed)
-            if not os.path.exists(dst + part1):
-                try:
-                    os.mkdir(dst + part1)
-                except:
-                    pass
-
-            # create the part2 (if needed)
-            if not os.path.exists(dst + part1 + part2):
-                try:
-                    os.mkdir(dst + part1 + part2)
-                except:
-                    pass
-
-            # the dated path
-            datedpath = part1 + part2
+            dst = self._datedFolder(dst)
 
         # item is in the queue folder
         srcPath = src + os.sep + item.id + self._ext
-        dstPath = dst + datedpath + os.sep + item.id + self._ext
+        dstPath = dst + os.sep + item.id + self._ext
 
         # move the file
         shutil.move(srcPath, dstPath)
 
 
+    def _datedFolder(self, dst):
+        """Returns dst plus the YYYY-MM/YYYY-MM-DD folders (created if needed)"""
+
+        # format the parts
+        ltime     = time.localtime()
+        part1     = os.sep + time.strftime("%Y-%m", ltime)
+        part2     = os.sep + time.strftime("%Y-%m-%d", ltime)
+
+        # create the part1 (if needed)
+        if not os.path.exists(dst + part1):
+            try:
+                os.mkdir(dst + part1)
+            except:
+                pass
+
+        # create the part2 (if needed)
+        if not os.path.exists(dst + part1 + part2):
+            try:
+                os.mkdir(dst + part1 + part2)
+            except:
+                pass
+
+        # the dated path
+        return dst + part1 + part2
+
+
+    def _renameAll(self, names, src, dst):
+        """Move files between folders of the queue (same file system)"""
+
+        for fname in names:
+            os.rename(src + os.sep + fname, dst + os.sep + fname)
+
+
     def _write(self, item):
         """Write the item to the queue
 
@@ -446,17 +1351,71 @@ class QueueFolder(Queue):
         if item.id is None:
             return
 
-        # get the file name
-        fname = self._newFolder + os.sep + item.id + self._ext
-
         # write the item content
-        fname = self._newFolder + os.sep + item.id + self._ext
-        file = open(fname, "w")
-        file.write(item.content)
-        file.close()
+        self._writeNew(item)
 
         # move to the destination folder
-        self._move(item, self._folder, self._newFolder)
+        fname = item.id + self._ext
+        os.rename(self._newFolder + os.sep + fname, self._folder + os.sep + fname)
+
+
+    def _writeNew(self, item):
+        """Write the item to the new folder"""
+
+        self._writeFile(self._newFolder + os.sep + item.id + self._ext, item.content)
+
+
+    def _writeSegment(self, items):
+        """Write the items as a segment in the new folder, returns its file name"""
+
+        # the segment takes the place of an item
+        id = self._makeId()
+        for i in range(len(items)):
+            items[i]._id = "%s.%d" % (id, i)
+
+        fname = id + queue_segment.extension
+        self._writeFile(self._newFolder + os.sep + fname,
+                        queue_segment.pack([ item.content for item in items ]))
+
+        return fname
+
+
+    def _writeFile(self, fname, content):
+        """Write a file (binary, synced to disk with "fsync" durability)"""
+
+        if content is None:
+            content = ""
+        elif isinstance(content, unicode):
+            content = content.encode("utf-8")
+
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0644)
+        try:
+            while len(content) > 0:
+                content = content[os.write(fd, content):]
+            if self._durability == "fsync":
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def _sync(self, batch = False):
+        """Sync the queue folder (as the durability mode says)
+
+        "fsync" syncs on every change, "batch" syncs once per batch and at
+        most every syncInterval seconds for single items.
+        """
+
+        if self._durability == "none":
+            return
+
+        now = time.time()
+        if self._durability == "batch" and not batch and now - self._syncedAt < self._syncEvery:
+            self._dirty = True
+            return
+
+        _syncFolder(self._folder)
+        self._dirty    = False
+        self._syncedAt = now
 
 
     def _ensureFolder(self, folder):
@@ -464,8 +1423,12 @@ class QueueFolder(Queue):
 
         # if the target folder does not exists, create it
         if not os.path.exists(folder):
-            # create the folder
-            os.makedirs(folder)
+            # create the folder (other consumers may be doing the same)
+            try:
+                os.makedirs(folder)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
 
 
 #####################################################################
@@ -474,8 +1437,118 @@ class QueueFolder(Queue):
 # CREATOR FUNCTION
 #
 
-def create(config, prefix, producer):
+class SegmentItem(QueueItem):
+    """An item taken from a segment"""
+
+    _segment = None         # the segment file name (in the work folder)
+
+
+def _syncFolder(folder):
+    """Sync a folder (its entries) to disk, where supported"""
+
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return              # windows can't open folders
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _stamp():
+    """The current timestamp as in item ids"""
+    return datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+
+def _parseStamp(stamp):
+    """The datetime of a timestamp (strptime is too slow for every item)"""
+
+    return datetime.datetime(int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]),
+                             int(stamp[8:10]), int(stamp[10:12]), int(stamp[12:14]),
+                             int(stamp[14:20]))
+
+
+def _keyHash(fname):
+    """The key sha1 in an item file name (None if the item has no key)"""
+
+    hash = os.path.splitext(fname)[0].rsplit("-", 1)[-1]
+    return hash if len(hash) == 40 else None
+
+
+def _key(fname):
+    """The (priority, timestamp, file name) of an item file"""
+
+    if fname[1] == "-":
+        return (int(fname[0]), fname[2:22], fname)
+
+    return (defaultPriority, fname[:20], fname)
+
+
+def _isUrgent(fname, pending):
+    """True if the item file is more urgent (priority or due time) than the pending one"""
+
+    (priority, stamp, ignored) = _key(fname)
+    (pendingPriority, pendingStamp, ignored) = _key(pending)
+
+    return priority < pendingPriority or stamp < pendingStamp
+
+
+def _urgentName(fname, pending):
+    """The file name of the pending item moved to the most urgent priority and due time of both"""
+
+    (priority, stamp, ignored) = _key(fname)
+    priority = min(priority, _key(pending)[0])
+    stamp    = min(stamp, _key(pending)[1])
+
+    # the rest as in the new item (with the same key)
+    prefix = "" if priority == defaultPriority else "%d-" % priority
+    return prefix + stamp + fname[(2 if fname[1] == "-" else 0) + len(stamp):]
+
+
+def _readMarker(fd):
+    """The [ pending file name, counts ] in a key marker (None if still being created)"""
+
+    os.lseek(fd, 0, os.SEEK_SET)
+    lines = "".join(iter(lambda: os.read(fd, 65536), "")).split("\n", 1)
+
+    return lines if len(lines) == 2 else None
+
+
+def _unlockMarker(marker):
+    """Unlocks (and closes) a marker opened with _lockMarker"""
+
+    if marker is not None:
+        os.close(marker[1])
+
+
+def _sameFile(fd, path):
+    """True if the open file is (still) the file at path"""
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+
+    return os.path.samestat(os.fstat(fd), st) if hasattr(os.path, "samestat") else True
+
+
+def _alive(pid):
+    """True if the process exists"""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+
+    return True
+
+
+def create(config, prefix, producer, readOnly = False):
     """Create a QueueFolder"""
 
-    return QueueFolder(config, prefix, producer)
+    return QueueFolder(config, prefix, producer, readOnly)
 
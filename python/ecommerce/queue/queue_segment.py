@@ -0,0 +1,81 @@
+"""Segment files for the Queue module
+
+A segment holds many queue items in a single file, so high volume producers
+don't pay a file (inode, directory entry, rename, fsync) per item. The
+format is compact and length prefixed:
+
+    EQS1                    magic (4 bytes)
+    LLLL content            repeated, LLLL is the content length (4 bytes, big endian)
+
+Segments are written once (in the new folder, then moved into the queue)
+and are never modified after that.
+"""
+
+import struct
+
+from qexceptions import *
+
+# the segment file extension
+extension = ".seg"
+
+_magic  = "EQS1"
+_length = struct.Struct(">I")
+
+
+def pack(contents):
+    """Returns the segment data for a list of item contents"""
+
+    parts = [ _magic ]
+    for content in contents:
+        if content is None:
+            content = ""
+        elif isinstance(content, unicode):
+            content = content.encode("utf-8")
+        parts.append(_length.pack(len(content)))
+        parts.append(content)
+
+    return "".join(parts)
+
+
+def unpack(data):
+    """Returns the list of item contents in the segment data"""
+
+    if data[:len(_magic)] != _magic:
+        raise QueueRuntimeException("Not a queue segment")
+
+    contents = [ ]
+    pos  = len(_magic)
+    size = len(data)
+    while pos < size:
+        if pos + _length.size > size:
+            raise QueueRuntimeException("Truncated queue segment")
+        (length, ) = _length.unpack_from(data, pos)
+        pos += _length.size
+        if pos + length > size:
+            raise QueueRuntimeException("Truncated queue segment")
+        contents.append(data[pos:pos + length])
+        pos += length
+
+    return contents
+
+
+def count(fname):
+    """Returns the number of items in a segment file (without reading the contents)"""
+
+    f = open(fname, "rb")
+    try:
+        if f.read(len(_magic)) != _magic:
+            raise QueueRuntimeException("Not a queue segment")
+
+        n = 0
+        while True:
+            header = f.read(_length.size)
+            if len(header) < _length.size:
+                return n
+            f.seek(_length.unpack(header)[0], 1)
+            n += 1
+    finally:
+        f.close()
+
+
+__all__ = [ "extension", "pack", "unpack", "count" ]
@@ -0,0 +1,524 @@
+"""SQLite based Queue object for the Queue module
+
+All the items live in a single SQLite database (in WAL mode, so readers
+don't block the writer), one row per item. Many producers and consumers
+(processes on the same host) can share the database:
+
+- consumers claim items atomically (BEGIN IMMEDIATE + UPDATE), taking a
+  lease that is renewed every time the consumer uses the queue (or calls
+  renew()); items whose lease expired go back to the queue
+
+- items are taken by priority (0 is the most urgent), then delivery time
+  (notBefore), then arrival order, all from an index
+
+- items with a key are coalesced while pending (a partial unique index on
+  the key of the ready items), the pending item takes the most urgent
+  priority and delivery time of both
+
+- batches (nextBatch, doneBatch, readyBatch) are a single transaction
+
+The database must be on a local disk (SQLite locking does not work over
+network file systems). A queue object must be used from a single thread.
+"""
+
+import datetime
+import time
+import uuid
+import socket
+import os
+import os.path
+import sqlite3
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from qexceptions import *
+from queue       import Queue, QueueItem
+from stats       import expireAfter
+
+import queue_watch
+
+
+_schema = [
+    """CREATE TABLE IF NOT EXISTS items (
+           id         INTEGER PRIMARY KEY AUTOINCREMENT,
+           status     TEXT    NOT NULL,
+           priority   INTEGER NOT NULL,
+           notBefore  REAL    NOT NULL,
+           created    REAL    NOT NULL,
+           key        TEXT,
+           coalesced  INTEGER NOT NULL DEFAULT 0,
+           owner      TEXT,
+           leaseUntil REAL,
+           content    BLOB
+       )""",
+    """CREATE INDEX IF NOT EXISTS items_ready ON items (priority, notBefore, id)
+           WHERE status = 'ready'""",
+    """CREATE INDEX IF NOT EXISTS items_work ON items (leaseUntil)
+           WHERE status = 'work'""",
+    """CREATE INDEX IF NOT EXISTS items_owner ON items (owner)
+           WHERE status = 'work'""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS items_key ON items (key)
+           WHERE status = 'ready' AND key IS NOT NULL""",
+    """CREATE TABLE IF NOT EXISTS metrics (
+           id      TEXT PRIMARY KEY,
+           updated REAL NOT NULL,
+           data    TEXT NOT NULL
+       )""",
+]
+
+_synchronous = {
+    "none":  "OFF",
+    "batch": "NORMAL",
+    "fsync": "FULL",
+}
+
+
+#####################################################################
+#####################################################################
+#
+# QUEUE CLASS
+#
+
+class QueueSqlite(Queue):
+    """SQLite Queue Class
+
+    Item ids are the row ids (as strings).
+    """
+
+    def __init__(self, config, prefix, producer = True, readOnly = False):
+
+        # base class init
+        Queue.__init__(self, config, prefix, producer, readOnly)
+
+        # get other attributes
+        self._file       = config.getMulti(prefix, "file")
+        self._period     = config.getMulti(prefix, "rescan", 5)
+        self._keep       = config.getMulti(prefix, "keep", False)
+        self._lease      = config.getMulti(prefix, "lease", 300)
+        self._durability = config.getMulti(prefix, "durability", "batch")
+        self._db         = None
+        self._watcher    = None
+        self._recovered  = 0
+        self._consumer   = None
+
+        # items dropped because an item with the same key was pending
+        self.coalesced = 0
+
+        # check we have a file
+        if self._file is None:
+            raise QueueConfigurationException("Missing file path for queue [%s]" % prefix)
+
+        # check the durability mode
+        if self._durability not in _synchronous:
+            raise QueueConfigurationException("Unknown durability [%s] for queue [%s]" % (self._durability, prefix))
+
+        # a read only queue only looks (the database must be there)
+        if self._readOnly:
+            if not os.path.isfile(self._file):
+                raise QueueRuntimeException("Queue database [%s] does not exist" % self._file)
+            self._db = sqlite3.connect(self._file, timeout = 30, isolation_level = None)
+            self._db.text_factory = str
+            return
+
+        # be sure the folder exists
+        folder = os.path.dirname(os.path.abspath(self._file))
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+
+        # open the database (transactions are handled here)
+        self._db = sqlite3.connect(self._file, timeout = 30, isolation_level = None)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = %s" % _synchronous[self._durability])
+        for statement in _schema:
+            self._db.execute(statement)
+
+        # consumers have an id (for the leases)
+        if not self._producer:
+            self._consumer = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+            self._recover()
+
+
+    def __del__(self):
+
+        # give back our items, we are gone, so are our metrics (producers
+        # leave the last ones)
+        if self._db is not None:
+            if not self._readOnly:
+                try:
+                    if self._producer:
+                        self._leaveMetrics()
+                    else:
+                        self._release()
+                        self._db.execute("DELETE FROM metrics WHERE id = ?", (self.metrics.id, ))
+                except sqlite3.Error:
+                    pass
+            self._db.close()
+            self._db = None
+
+        # base class del
+        Queue.__del__(self)
+
+
+    def list(self):
+        """Returns the list of item ids in the queue (in order)"""
+
+        rows = self._db.execute("SELECT id FROM items WHERE status = 'ready' "
+                                "ORDER BY priority, notBefore, id")
+        return [ str(row[0]) for row in rows ]
+
+
+    def count(self, status = "ready"):
+        """Returns the number of items with a status (ready, work, error or done)"""
+
+        return self._db.execute("SELECT COUNT(*) FROM items WHERE status = ?", (status, )).fetchone()[0]
+
+
+    def item(self):
+        """Creates a new item for the queue"""
+
+        return QueueItem(self)
+
+
+    def next(self, blocking = False, timeout = None):
+        """Returns the next item in the queue"""
+
+        items = self.nextBatch(1, blocking, timeout)
+        return items[0] if len(items) > 0 else None
+
+
+    def nextBatch(self, n, blocking = False, timeout = None):
+        """Returns up to n items from the head of the queue
+
+        If blocking, waits until there is at least one item (or timeout
+        seconds, if not None, have passed).
+        """
+
+        # if a producer => error
+        if self._producer:
+            raise QueueRuntimeException("Queue is not a consumer")
+
+        # renew our lease (and check the others)
+        self._recoverDue()
+        self.publish()
+
+        items = self._claim(n)
+        if len(items) > 0 or not blocking:
+            return items
+
+        # wait (polling, there is no change notification)
+        if self._watcher is None:
+            self._watcher = queue_watch.PollWatcher(self._file)
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            left = None
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    return [ ]
+            self._watcher.wait(left)
+
+            self._recoverDue()
+            items = self._claim(n)
+            if len(items) > 0:
+                self._watcher.reset()
+                return items
+
+
+    def lock(self, blocking = False):
+        """Lock queue head and return it (items are always locked here)"""
+        return self.next(blocking)
+
+
+    def isEmpty(self):
+        """True if the queue has no items due"""
+
+        row = self._db.execute("SELECT 1 FROM items WHERE status = 'ready' AND notBefore <= ? LIMIT 1",
+                               (time.time(), )).fetchone()
+        return row is None
+
+
+    def unlock(self, item):
+        """Unlocks item, it is put back in the queue"""
+
+        # if a producer => error
+        if self._producer:
+            raise QueueRuntimeException("Queue is not a consumer")
+
+        if item is not None and item.locked:
+            self._transaction(self._requeue, "owner = ? AND id = ?", (self._consumer, int(item.id)))
+            item._locked = False
+            item._status = "ready"
+
+
+    def renew(self):
+        """Renews the consumer lease"""
+
+        if self._consumer is None:
+            return
+
+        self._db.execute("UPDATE items SET leaseUntil = ? WHERE status = 'work' AND owner = ?",
+                         (time.time() + self._lease, self._consumer))
+
+
+    def ready(self, item):
+        """Marks queue item as ready (put in queue)"""
+
+        # sanity checks
+        if item is None:
+            raise QueueRuntimeException("Trying to make ready None item")
+
+        return self.readyBatch([ item ])[0]
+
+
+    def readyBatch(self, items):
+        """Marks queue items as ready (put in queue)"""
+
+        # sanity checks
+        if self._readOnly:
+            raise QueueRuntimeException("Queue is read only")
+        for item in items:
+            if item is None:
+                raise QueueRuntimeException("Trying to make ready None item")
+
+        self._transaction(self._insert, items)
+        self.publish()
+
+        return items
+
+
+    def done(self, item):
+        """Marks queue item as done (removes from queue)"""
+
+        # sanity checks
+        if item is None:
+            raise QueueRuntimeException("Trying to mark None item as done")
+
+        return self.doneBatch([ item ])[0]
+
+
+    def doneBatch(self, items):
+        """Marks queue items as done (removes from queue)"""
+
+        # sanity checks
+        for item in items:
+            if item is None:
+                raise QueueRuntimeException("Trying to mark None item as done")
+
+        return self._finish(items, "done")
+
+
+    def error(self, item):
+        """Marks queue item as in error (removes from queue)"""
+
+        # sanity checks
+        if item is None:
+            raise QueueRuntimeException("Trying to mark None item in error")
+
+        return self._finish([ item ], "error")[0]
+
+
+    def _counts(self):
+        """Returns the item counts and the oldest item age"""
+
+        now    = time.time()
+        counts = dict([ (status, 0) for status in ("ready", "work", "error", "done") ])
+        for (status, n) in self._db.execute("SELECT status, COUNT(*) FROM items GROUP BY status"):
+            counts[status] = n
+        (oldest, ) = self._db.execute("SELECT MIN(notBefore) FROM items WHERE status = 'ready' AND notBefore <= ?",
+                                      (now, )).fetchone()
+
+        return {
+            "pending": counts["ready"],
+            "oldest":  None if oldest is None else now - oldest,
+            "work":    counts["work"],
+            "error":   counts["error"],
+            "done":    counts["done"] if self._keep else None,
+        }
+
+
+    def _readMetrics(self):
+        """Returns the metrics published by the producers and consumers"""
+
+        return [ json.loads(data) for (data, ) in self._db.execute("SELECT data FROM metrics") ]
+
+
+    def _writeMetrics(self, snapshot):
+        """Publishes the metrics in the database (drops the expired ones)"""
+
+        self._db.execute("INSERT OR REPLACE INTO metrics (id, updated, data) VALUES (?, ?, ?)",
+                         (snapshot["id"], snapshot["updated"], json.dumps(snapshot)))
+        self._db.execute("DELETE FROM metrics WHERE updated < ?", (snapshot["updated"] - expireAfter, ))
+
+
+    def _transaction(self, fcn, *args):
+        """Run fcn in a write transaction"""
+
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fcn(*args)
+        except:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+        return result
+
+
+    def _claim(self, n):
+        """Take up to n items (in one transaction)"""
+
+        def claim():
+            now  = time.time()
+            rows = self._db.execute("SELECT id, priority, notBefore, created, coalesced, content "
+                                    "FROM items WHERE status = 'ready' AND notBefore <= ? "
+                                    "ORDER BY priority, notBefore, id LIMIT ?", (now, n)).fetchall()
+            self._db.executemany("UPDATE items SET status = 'work', owner = ?, leaseUntil = ? WHERE id = ?",
+                                 [ (self._consumer, now + self._lease, row[0]) for row in rows ])
+            return rows
+
+        # quick check before taking the write lock
+        if self.isEmpty():
+            return [ ]
+
+        items = [ ]
+        for (id, priority, notBefore, created, coalesced, content) in self._transaction(claim):
+            self.metrics.count("dequeued")
+            item = QueueItem(self, "work", str(id), datetime.datetime.fromtimestamp(created),
+                             None if content is None else str(content))
+            item._priority  = priority
+            item._notBefore = datetime.datetime.fromtimestamp(notBefore)
+            item._coalesced = coalesced
+            item._locked    = True
+            items.append(item)
+
+        return items
+
+
+    def _insert(self, items):
+        """Insert the items (in a transaction)"""
+
+        now = time.time()
+        for item in items:
+
+            # the row values
+            content = item.content
+            if isinstance(content, unicode):
+                content = content.encode("utf-8")
+            notBefore = now
+            if item.notBefore is not None:
+                notBefore = max(now, time.mktime(item.notBefore.timetuple()) + item.notBefore.microsecond / 1e6)
+            key = item.key
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+
+            # insert (ignored if an item with the same key is pending)
+            cursor = self._db.execute("INSERT OR IGNORE INTO items (status, priority, notBefore, created, key, content) "
+                                      "VALUES ('ready', ?, ?, ?, ?, ?)",
+                                      (item.priority, notBefore, now, key,
+                                       None if content is None else buffer(content)))
+            if cursor.rowcount == 1:
+                item._id     = str(cursor.lastrowid)
+                item._status = "ready"
+                self.metrics.count("enqueued")
+                continue
+
+            # coalesced (the pending item takes the most urgent priority and delivery time)
+            self._db.execute("UPDATE items SET coalesced = coalesced + 1, priority = MIN(priority, ?), "
+                             "notBefore = MIN(notBefore, ?) WHERE status = 'ready' AND key = ?",
+                             (item.priority, notBefore, key))
+            row = self._db.execute("SELECT id FROM items WHERE status = 'ready' AND key = ?", (key, )).fetchone()
+            item._id     = None if row is None else str(row[0])
+            item._status = "coalesced"
+            self.coalesced += 1
+            self.metrics.count("coalesced")
+
+
+    def _finish(self, items, status):
+        """Marks our items as done or in error"""
+
+        # if a producer => error
+        if self._producer:
+            raise QueueRuntimeException("Queue is not a consumer")
+
+        ids = [ (self._consumer, int(item.id)) for item in items ]
+        if status == "done" and not self._keep:
+            sql = "DELETE FROM items WHERE owner = ? AND id = ?"
+        else:
+            sql = "UPDATE items SET status = '%s', leaseUntil = NULL WHERE owner = ? AND id = ?" % status
+        self._transaction(self._db.executemany, sql, ids)
+
+        # change items status
+        for item in items:
+            item._status = status
+            item._locked = False
+        self.metrics.count("done" if status == "done" else "errors", len(items))
+
+        return items
+
+
+    def _requeue(self, where, args):
+        """Put items in work back in the queue (in a transaction)
+
+        Items with a key already pending again are coalesced into it.
+        """
+
+        self._db.execute("UPDATE OR IGNORE items SET status = 'ready', owner = NULL, leaseUntil = NULL "
+                         "WHERE status = 'work' AND " + where, args)
+
+        # what is left has a key pending again
+        rows = self._db.execute("SELECT id, priority, notBefore, key, coalesced FROM items "
+                                "WHERE status = 'work' AND " + where, args).fetchall()
+        for (id, priority, notBefore, key, coalesced) in rows:
+            self._db.execute("UPDATE items SET coalesced = coalesced + ?, priority = MIN(priority, ?), "
+                             "notBefore = MIN(notBefore, ?) WHERE status = 'ready' AND key = ?",
+                             (coalesced + 1, priority, notBefore, key))
+            self._db.execute("DELETE FROM items WHERE id = ?", (id, ))
+        if len(rows) > 0:
+            self.coalesced += len(rows)
+            self.metrics.count("coalesced", len(rows))
+
+
+    def _recoverDue(self):
+        """Renews our lease and puts back expired items if it is time to"""
+
+        if time.time() - self._recovered >= min(self._period, self._lease):
+            self._recover()
+        else:
+            self.renew()
+
+
+    def _recover(self):
+        """Puts back in the queue the items whose lease expired"""
+
+        self._recovered = time.time()
+        self.renew()
+        self._transaction(self._requeue, "leaseUntil < ?", (self._recovered, ))
+
+
+    def _release(self):
+        """Puts back in the queue the items we hold"""
+
+        self._transaction(self._requeue, "owner = ?", (self._consumer, ))
+
+
+#####################################################################
+#####################################################################
+#
+# CREATOR FUNCTION
+#
+
+def create(config, prefix, producer, readOnly = False):
+    """Create a QueueSqlite"""
+
+    return QueueSqlite(config, prefix, producer, readOnly)
+
+
+__all__ = [ "QueueSqlite" ]
@@ -0,0 +1,187 @@
+"""Folder watchers for the Queue module
+
+Blocking consumers wait for the queue folder to change instead of
+sleeping a fixed time. On Linux, inotify is used (thru ctypes, there is
+no extra dependency) so an idle consumer sleeps in select() and wakes up
+as soon as an item is moved into the folder. Elsewhere (or if inotify
+is not available) the folder is polled with an adaptive backoff: quick
+polls right after activity, slowing down while the queue stays idle.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+
+
+#####################################################################
+#####################################################################
+#
+# POLLING WATCHER
+#
+
+class PollWatcher(object):
+    """Polls with an adaptive backoff
+
+    wait() returns None (the folder may or may not have changed).
+    """
+
+    changes = False
+
+    def __init__(self, folder, minDelay = 0.01, maxDelay = 0.5):
+        self._folder   = folder
+        self._minDelay = minDelay
+        self._maxDelay = maxDelay
+        self._delay    = minDelay
+
+
+    def wait(self, timeout = None):
+        """Sleep for the current delay (never past timeout)"""
+
+        delay = self._delay
+        if timeout is not None:
+            delay = max(0, min(delay, timeout))
+        time.sleep(delay)
+
+        # back off while nothing happens
+        self._delay = min(self._delay * 2, self._maxDelay)
+
+        return None
+
+
+    def reset(self):
+        """Something happened, poll fast again"""
+        self._delay = self._minDelay
+
+
+    def close(self):
+        pass
+
+
+#####################################################################
+#####################################################################
+#
+# INOTIFY WATCHER (linux)
+#
+
+IN_CREATE   = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC  = 0x00080000
+
+_libc = None
+
+def _inotify():
+    """Returns libc if it has inotify, None otherwise"""
+
+    global _libc
+
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+                import ctypes.util
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                _libc = libc
+            except (ImportError, OSError, AttributeError):
+                pass
+
+    return _libc or None
+
+
+class InotifyWatcher(object):
+    """Waits for files to be created or moved into the folder
+
+    wait() returns True if the folder changed, False on timeout.
+    """
+
+    changes = True
+
+    def __init__(self, folder):
+
+        libc = _inotify()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+
+        # create the instance and watch the folder
+        self._fd = None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = _errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(fd, folder, IN_CREATE | IN_MOVED_TO) < 0:
+            err = _errno()
+            os.close(fd)
+            raise OSError(err, "%s [%s]" % (os.strerror(err), folder))
+        self._fd = fd
+
+
+    def wait(self, timeout = None):
+        """Wait for a change (or timeout seconds, if not None)"""
+
+        if self._fd is None:
+            return False
+
+        try:
+            (r, w, x) = select.select([ self._fd ], [ ], [ ], timeout)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                return False
+            raise
+        if not r:
+            return False
+
+        # drain the events (any event means "rescan")
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except OSError as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        return True
+
+
+    def reset(self):
+        pass
+
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+    def __del__(self):
+        self.close()
+
+
+def _errno():
+    """The errno of the last libc call"""
+    import ctypes
+    return ctypes.get_errno()
+
+
+#####################################################################
+#####################################################################
+#
+# FACTORY
+#
+
+def watcher(folder):
+    """Returns the best watcher available for the folder"""
+
+    if _inotify() is not None:
+        try:
+            return InotifyWatcher(folder)
+        except OSError:
+            pass
+
+    return PollWatcher(folder)
+
+
+__all__ = [ "watcher", "PollWatcher", "InotifyWatcher" ]
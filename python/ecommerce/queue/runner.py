@@ -0,0 +1,276 @@
+"""Worker pool runner for the Queue module
+
+Runs a handler for every item of a queue in a pool of threads (for I/O
+bound jobs) or processes (for CPU bound jobs). The queue is only used from
+the thread calling run(): it takes items in batches (prefetch), keeps at
+most "inflight" items in the pool, marks items done when the handler
+returns and routes them to error() when the handler raises or takes longer
+than the per item timeout.
+
+The handler gets a detached copy of the item (id, creationDate and content,
+it is pickled for process pools), its return value is ignored.
+
+SIGTERM (or stop()) makes the runner stop taking items and wait for the
+items in flight. Items still running when the process dies stay in the
+work folder and go back to the queue later (jobs are idempotent, running
+them twice is harmless). A timed out item is routed to error() right away
+but its worker is not interrupted (threads can't be), it just keeps its
+pool slot until the handler returns.
+
+Usage:
+
+    import ecommerce.queue.runner
+
+    def handler(item):
+        ... do something with item.content ...
+
+    ecommerce.queue.runner.run(config, "content.queue", handler)
+
+The configuration options (all optional) are:
+
+  {{prefix}}.workers  - the pool size (default: the number of cpus)
+  {{prefix}}.pool     - "thread" (default) or "process"
+  {{prefix}}.prefetch - how many items to take from the queue at a time (default: workers)
+  {{prefix}}.inflight - maximum number of items in the pool (default: 2 * workers)
+  {{prefix}}.timeout  - seconds before an item is considered failed (default: no timeout)
+"""
+
+import time
+import signal
+import threading
+import traceback
+import logging
+import multiprocessing
+import multiprocessing.pool
+
+from qexceptions import *
+from queue       import QueueItem
+
+_log = logging.getLogger("ecommerce.queue")
+
+# seconds between checks when idle (stop requests, deadlines)
+_poll = 1.0
+
+
+def _call(handler, item):
+    """Run the handler (in the pool), returns the item id and None or the error text"""
+
+    try:
+        handler(item)
+    except:
+        return (item.id, traceback.format_exc())
+
+    return (item.id, None)
+
+
+def _detach(item):
+    """A copy of the item that can travel to the pool"""
+
+    detached = QueueItem(None, item.status, item.id, item.creationDate, item.content)
+    detached._priority  = item.priority
+    detached._notBefore = item.notBefore
+
+    return detached
+
+
+class Runner(object):
+    """Runs a handler for the queue items in a pool"""
+
+    def __init__(self, queue, handler, workers = None, pool = "thread", prefetch = None,
+                       inflight = None, timeout = None):
+
+        # sanity checks
+        if pool not in ("thread", "process"):
+            raise QueueConfigurationException("Unknown pool type [%s]" % pool)
+
+        self._queue    = queue
+        self._handler  = handler
+        self._workers  = workers or multiprocessing.cpu_count()
+        self._poolType = pool
+        self._prefetch = prefetch or self._workers
+        self._inflight = max(inflight or 2 * self._workers, 1)
+        self._timeout  = timeout
+        self._stopping = threading.Event()
+        self._changed  = threading.Event()
+        self._finished = [ ]        # (item id, error) appended by the pool
+        self._started  = { }        # item id -> start time (for the metrics)
+        self._previous = None       # SIGTERM handler before run()
+
+        # counters
+        self.done     = 0
+        self.errors   = 0
+        self.timeouts = 0
+
+
+    def stop(self):
+        """Stop taking items (the items in flight are finished)"""
+
+        self._stopping.set()
+        self._changed.set()
+
+
+    def run(self, untilEmpty = False):
+        """Process items until stopped (or until the queue is empty)
+
+        Returns the number of items done.
+        """
+
+        # the pool
+        if self._poolType == "process":
+            pool = multiprocessing.Pool(self._workers)
+        else:
+            pool = multiprocessing.pool.ThreadPool(self._workers)
+
+        installed = self._installSignal()
+        inflight  = { }             # item id -> (item, deadline)
+        try:
+            while not self._stopping.is_set():
+
+                # take more items (wait for them only if idle)
+                items = [ ]
+                room  = self._inflight - len(inflight)
+                if room > 0:
+                    blocking = len(inflight) == 0 and not untilEmpty
+                    items = self._queue.nextBatch(min(room, self._prefetch), blocking, _poll)
+                    if len(items) == 0 and len(inflight) == 0 and untilEmpty:
+                        break
+
+                # hand them to the pool
+                for item in items:
+                    deadline = None if self._timeout is None else time.time() + self._timeout
+                    inflight[item.id] = (item, deadline)
+                    self._started[item.id] = time.time()
+                    pool.apply_async(_call, (self._handler, _detach(item)), callback = self._notify)
+
+                # mark the finished
+                self._collect(inflight)
+
+                # full (or nothing new) => wait for something to finish
+                if len(inflight) >= self._inflight or (len(inflight) > 0 and len(items) == 0):
+                    self._wait(inflight)
+
+            # stopping, finish the items in flight
+            while len(inflight) > 0:
+                self._wait(inflight)
+                self._collect(inflight)
+
+        finally:
+            if installed:
+                signal.signal(signal.SIGTERM, self._previous)
+            if len(inflight) > 0:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+        return self.done
+
+
+    def _notify(self, result):
+        """Called (in a pool thread) when an item finishes"""
+
+        self._finished.append(result)
+        self._changed.set()
+
+
+    def _wait(self, inflight):
+        """Wait until an item finishes (or a deadline or the poll time passes)"""
+
+        wait = _poll
+        deadlines = [ d for (i, d) in inflight.values() if d is not None ]
+        if len(deadlines) > 0:
+            wait = max(0, min(wait, min(deadlines) - time.time()))
+
+        if len(self._finished) == 0:
+            self._changed.wait(wait)
+        self._changed.clear()
+
+        # long jobs, keep the items ours
+        self._queue.renew()
+        self._queue.publish()
+
+
+    def _collect(self, inflight):
+        """Mark the finished (and timed out) items"""
+
+        done = [ ]
+
+        # finished (ignore the ones that already timed out)
+        while len(self._finished) > 0:
+            (id, err) = self._finished.pop(0)
+            if id not in inflight:
+                continue
+            (item, deadline) = inflight.pop(id)
+            self._observe(id)
+
+            if err is None:
+                done.append(item)
+            else:
+                self._error(item, err)
+
+        # too late
+        now = time.time()
+        for (id, (item, deadline)) in inflight.items():
+            if deadline is not None and now >= deadline:
+                del inflight[id]
+                self._observe(id)
+                self.timeouts += 1
+                self._error(item, "timed out after %s seconds" % self._timeout)
+
+        # done in one go
+        if len(done) > 0:
+            self._queue.doneBatch(done)
+            self.done += len(done)
+
+
+    def _observe(self, id):
+        """Add the item processing time to the queue metrics"""
+
+        started = self._started.pop(id, None)
+        if started is not None:
+            self._queue.metrics.observe(time.time() - started)
+
+
+    def _error(self, item, err):
+        """Route the item to the queue errors"""
+
+        _log.error("item [%s] failed\n%s", item.id, err)
+        self._queue.error(item)
+        self.errors += 1
+
+
+    def _installSignal(self):
+        """Stop on SIGTERM (only possible from the main thread), True if installed"""
+
+        try:
+            self._previous = signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        except ValueError:
+            return False
+
+        # not installed from python => back to the default
+        if self._previous is None:
+            self._previous = signal.SIG_DFL
+
+        return True
+
+
+def run(config, prefix, handler, untilEmpty = False):
+    """Consume the queue at prefix with the handler (see the module doc for options)
+
+    Returns the number of items done.
+    """
+
+    import ecommerce.queue
+
+    queue  = ecommerce.queue.queue(config, prefix, False)
+    runner = Runner(queue, handler,
+                    workers  = config.getMulti(prefix, "workers"),
+                    pool     = config.getMulti(prefix, "pool", "thread"),
+                    prefetch = config.getMulti(prefix, "prefetch"),
+                    inflight = config.getMulti(prefix, "inflight"),
+                    timeout  = config.getMulti(prefix, "timeout"))
+
+    return runner.run(untilEmpty)
+
+
+__all__ = [ "Runner", "run" ]
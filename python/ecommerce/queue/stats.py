@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Queue statistics
+
+Every queue object has a QueueMetrics (queue.metrics) counting what it
+did: items enqueued (put in the queue by this object), dequeued, done, in
+error and coalesced, plus a histogram of processing times (filled by the
+runner). Producers and consumers publish their metrics every few seconds
+(when they use the queue) next to the queue, so queue.stats() (and the
+command below) can report, for the whole queue:
+
+    pending, work, error, done  - item counts (done only if kept)
+    oldest                      - age in seconds of the oldest item due
+    enqueued                    - items enqueued, added up over the
+                                  published metrics
+    producers, consumers        - the metrics published by each producer
+                                  and consumer, with the rates over the
+                                  last minute (and stale if not updated
+                                  for staleAfter seconds)
+
+Consumers remove their metrics when they are gone. Producers (usually
+short lived) publish their last metrics when they are gone and leave them,
+so their items are still added up; they are reported as stale and
+dropped expireAfter seconds after they were published.
+
+usage: python -m ecommerce.queue.stats <command> <prefix>   (see command help)
+"""
+
+import sys
+import os
+import time
+import socket
+import uuid
+import bisect
+
+# how often producers and consumers publish their metrics (seconds)
+publishInterval = 10
+
+# the rates are computed over this many seconds
+rateWindow = 60
+
+# published metrics older than this are reported as stale (seconds)
+staleAfter = 5 * publishInterval
+
+# published metrics older than this are dropped (seconds)
+expireAfter = 3600
+
+# processing time histogram buckets (upper bounds, in seconds)
+buckets = [ 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300 ]
+
+# the counters
+counters = [ "enqueued", "dequeued", "done", "errors", "coalesced" ]
+
+
+class QueueMetrics(object):
+    """The metrics of a queue object"""
+
+    def __init__(self, producer = False):
+
+        self.id        = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.producer  = producer
+        self.started   = time.time()
+        self.counts    = dict([ (name, 0) for name in counters ])
+        self.histogram = [ 0 ] * (len(buckets) + 1)
+        self.timeSum   = 0.0
+        self._history  = [ ]            # (time, counts) at each snapshot
+        self._published = 0
+
+
+    def count(self, name, n = 1):
+        """Adds n to a counter"""
+
+        self.counts[name] += n
+
+
+    def observe(self, seconds):
+        """Adds a processing time to the histogram"""
+
+        self.histogram[bisect.bisect_left(buckets, seconds)] += 1
+        self.timeSum += seconds
+
+
+    def changed(self):
+        """True if something was counted since the last snapshot"""
+
+        if len(self._history) == 0:
+            return any(self.counts.values())
+        return self.counts != self._history[-1][1]
+
+
+    def due(self):
+        """True if it is time to publish"""
+
+        return time.time() - self._published >= publishInterval
+
+
+    def snapshot(self):
+        """Returns the metrics as a dict (with the rates per second)"""
+
+        now = time.time()
+        self._published = now
+
+        # remember the counts for the rates (only over the window)
+        self._history.append((now, dict(self.counts)))
+        while len(self._history) > 2 and now - self._history[1][0] >= rateWindow:
+            self._history.pop(0)
+        (then, before) = self._history[0]
+        if now - then <= 0:
+            (then, before) = (self.started, dict([ (name, 0) for name in counters ]))
+        elapsed = max(now - then, 1e-6)
+
+        return {
+            "id":        self.id,
+            "producer":  self.producer,
+            "updated":   now,
+            "started":   self.started,
+            "counts":    dict(self.counts),
+            "rates":     dict([ (name, (self.counts[name] - before[name]) / elapsed) for name in counters ]),
+            "histogram": list(self.histogram),
+            "timeSum":   self.timeSum,
+        }
+
+
+def percentile(histogram, p):
+    """The bucket upper bound where the p (0 to 1) percentile falls (None if no data)"""
+
+    total = sum(histogram)
+    if total == 0:
+        return None
+
+    seen = 0
+    for i in range(len(histogram)):
+        seen += histogram[i]
+        if seen >= p * total:
+            return buckets[i] if i < len(buckets) else float("inf")
+
+
+###################################################
+
+def _format(value, fmt = "%d"):
+    """Format a value that may be missing"""
+
+    return "-" if value is None else fmt % value
+
+
+def _print(prefix, stats):
+    """Print the queue stats"""
+
+    print ""
+    print "queue %s (%s)" % (prefix, stats.get("type"))
+    print "  pending   %10s   oldest %ss" % (_format(stats.get("pending")), _format(stats.get("oldest"), "%.1f"))
+    print "  work      %10s" % _format(stats.get("work"))
+    print "  error     %10s" % _format(stats.get("error"))
+    print "  done      %10s" % _format(stats.get("done"))
+
+    print "  enqueued  %10s" % _format(stats.get("enqueued"))
+
+    producers = stats.get("producers", [ ])
+    print "  producers %10d" % len(producers)
+    for p in producers:
+        print "    %s%s" % (p["id"], " (stale)" if p["stale"] else "")
+        print "      per second: enqueued %.2f coalesced %.2f" % (p["rates"]["enqueued"], p["rates"]["coalesced"])
+
+    consumers = stats.get("consumers", [ ])
+    print "  consumers %10d" % len(consumers)
+    for c in consumers:
+        rates = c["rates"]
+        print "    %s%s" % (c["id"], " (stale)" if c["stale"] else "")
+        print "      per second: enqueued %.2f dequeued %.2f done %.2f errors %.2f" % \
+              (rates["enqueued"], rates["dequeued"], rates["done"], rates["errors"])
+        total = sum(c["histogram"])
+        if total > 0:
+            print "      processing: %d items, mean %.3fs, p50 <= %ss p90 <= %ss p99 <= %ss" % \
+                  (total, c["timeSum"] / total,
+                   percentile(c["histogram"], 0.5), percentile(c["histogram"], 0.9),
+                   percentile(c["histogram"], 0.99))
+    print ""
+
+
+def _queue():
+    """Open the queue for the prefix in the command line (None if missing)"""
+
+    if len(sys.argv) < 3:
+        print ""
+        print "Command requires the queue prefix, use command help"
+        print ""
+        return (None, None)
+
+    import ecommerce.config
+    import ecommerce.queue
+
+    prefix = sys.argv[2]
+    return (prefix, ecommerce.queue.queue(ecommerce.config.getConfig(), prefix, True, True))
+
+###################################################
+
+def cmdShow():
+    """Print the stats of a queue"""
+
+    (prefix, queue) = _queue()
+    if queue is None:
+        return False
+
+    _print(prefix, queue.stats())
+
+    return True
+
+###################################################
+
+def cmdWatch():
+    """Print the stats of a queue every few seconds"""
+
+    (prefix, queue) = _queue()
+    if queue is None:
+        return False
+
+    interval = float(sys.argv[3]) if len(sys.argv) > 3 else publishInterval
+    try:
+        while True:
+            _print(prefix, queue.stats())
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+    return True
+
+###################################################
+
+def cmdHelp():
+    """Print usage help"""
+
+    print """
+usage: python -m ecommerce.queue.stats <command> <prefix> [...]
+
+where command is one of:
+
+- show {prefix} --- print the stats of the queue configured at prefix
+- watch {prefix} [seconds] --- print the stats every few seconds
+- help --- this screen
+"""
+
+    return True
+
+###################################################
+
+commands = {
+    "show":         cmdShow,
+    "watch":        cmdWatch,
+    "help":         cmdHelp
+}
+
+def main():
+
+    # figure out the command (default is help)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "help"
+    if cmd not in commands:
+        cmd = "help"
+
+    # dispatch the command
+    commands[cmd]()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,231 @@ from os.path       import dirname, exists, join as os_path_join
 from os            import remove, makedirs, sep
 from boto          import connect_s3
 from boto.s3.key   import Key
-from gzip          import GzipFile
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.utils    import merge_meta
+from shutil        import copyfileobj
 from win_unc import (DiskDrive, UncDirectory,
                      UncDirectoryConnection, UncDirectoryMount, UncCredentials)
 
 import types
+import sys
 import os
+import errno
+import uuid
+import itertools
+import mmap
+import shutil
+import collections
+import functools
+import mimetypes
+import multiprocessing
+import multiprocessing.pool
+import zlib
+import hashlib
+import time
+import random
+import threading
+import traceback
+import Queue
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO  import StringIO
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import ecommerce.config
 
+from manifest import Manifest
+
 content_gzippable = ('text/html', 'text/css', 'application/javascript',
-                     'text/plain', 'text/xml')
+                     'text/plain', 'text/xml', 'text/javascript',
+                     'application/xml', 'application/json')
+
+# precompressed variants (see FilesystemStorage), the file suffix of each
+variantSuffixes = { 'gzip': '.gz', 'br': '.br' }
+
+# streams are read (and compressed) in chunks of this size
+chunkSize = 256 * 1024
+
+# FilesystemStorage.putMany sorts this many objects at a time by directory
+groupSize = 1000
+
+# putMany defaults: threads, retries per object and first retry delay (doubles)
+putWorkers = 8
+putRetries = 3
+putBackoff = 0.5
+
+
+###############################################################
+###############################################################
+#
+# PutReport class
+#
+class PutReport(object):
+    """What happened in a putMany call
+
+    attributes:
+        stored:   number of objects stored
+        skipped:  number of objects unchanged (see manifest)
+        failed:   list of (name, error text) of the objects not stored
+        retries:  number of retries (over all objects)
+        elapsed:  seconds taken
+    """
+
+    def __init__(self):
+        self.stored  = 0
+        self.skipped = 0
+        self.failed  = [ ]
+        self.retries = 0
+        self.elapsed = 0.0
+        self._lock   = threading.Lock()
+
+    @property
+    def ok(self):
+        """True if all the objects were stored"""
+        return len(self.failed) == 0
+
+    def __str__(self):
+        return "%d stored, %d skipped, %d failed, %d retries in %.1fs" % \
+               (self.stored, self.skipped, len(self.failed), self.retries, self.elapsed)
+
+
+###############################################################
+###############################################################
+#
+# ReplicationReport class
+#
+class ReplicationReport(object):
+    """What happened to the writes of a ReplicatedStorage
+
+    attributes:
+        backends:      { backend name: PutReport }
+        inconsistent:  sorted names of the objects that failed on some backend
+                       (the backends may differ for them)
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.inconsistent = sorted(set([ name for report in backends.values()
+                                              for (name, err) in report.failed ]))
+
+    @property
+    def ok(self):
+        """True if every object was stored on every backend"""
+        return len(self.inconsistent) == 0
+
+    def __str__(self):
+        lines = [ "%s: %s" % (name, self.backends[name]) for name in sorted(self.backends) ]
+        lines.append("%d objects inconsistent" % len(self.inconsistent))
+        return "\n".join(lines)
+
+
+###############################################################
+###############################################################
+#
+# StorageStats class
+#
+class StorageStats(object):
+    """What a storage did (storage.stats), for every operation
+
+    attributes:
+        ops:      { operation: { "count", "errors", "seconds", "bytes" } }
+                  (bytes only for put/send and get)
+        raw:      bytes given to put/send
+        stored:   bytes written or uploaded (after compression, with variants)
+        retries:  putMany retries
+        skipped:  objects not stored because they were unchanged
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start counting again"""
+
+        with self._lock:
+            self.ops     = { }
+            self.raw     = 0
+            self.stored  = 0
+            self.retries = 0
+            self.skipped = 0
+
+    def timed(self, op, seconds, error = False):
+        """Count an operation"""
+
+        with self._lock:
+            entry = self.ops.get(op)
+            if entry is None:
+                entry = self.ops[op] = { "count": 0, "errors": 0, "seconds": 0.0, "bytes": 0 }
+            entry["count"]   += 1
+            entry["errors"]  += 1 if error else 0
+            entry["seconds"] += seconds
+
+    def transferred(self, op, raw, stored = None):
+        """Count the bytes of an operation (stored: after compression, for writes)"""
+
+        with self._lock:
+            entry = self.ops.setdefault(op, { "count": 0, "errors": 0, "seconds": 0.0, "bytes": 0 })
+            entry["bytes"] += raw
+            if stored is not None:
+                self.raw    += raw
+                self.stored += stored
+
+    def count(self, name, n = 1):
+        """Add to the retries or skipped counters"""
+
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def snapshot(self):
+        """The stats as a dict"""
+
+        with self._lock:
+            return {
+                "ops":     dict([ (op, dict(entry)) for (op, entry) in self.ops.items() ]),
+                "raw":     self.raw,
+                "stored":  self.stored,
+                "retries": self.retries,
+                "skipped": self.skipped,
+            }
+
+    def __str__(self):
+        stats = self.snapshot()
+        lines = [ "%-12s %8s %6s %10s %12s" % ("operation", "count", "errors", "ms/op", "bytes") ]
+        for op in sorted(stats["ops"]):
+            entry = stats["ops"][op]
+            lines.append("%-12s %8d %6d %10.2f %12d" % (op, entry["count"], entry["errors"],
+                                                       1000 * entry["seconds"] / max(entry["count"], 1),
+                                                       entry["bytes"]))
+        lines.append("%d bytes stored for %d bytes (%.0f%%), %d retries, %d skipped" %
+                     (stats["stored"], stats["raw"], 100.0 * stats["stored"] / max(stats["raw"], 1),
+                      stats["retries"], stats["skipped"]))
+        return "\n".join(lines)
+
+
+def _instrumented(op):
+    """Decorator counting and timing a storage method in storage.stats"""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def instrumented(self, *args, **kw):
+            started = time.time()
+            try:
+                result = method(self, *args, **kw)
+            except:
+                self.stats.timed(op, time.time() - started, True)
+                raise
+            self.stats.timed(op, time.time() - started)
+            return result
+        return instrumented
+
+    return decorate
+
 
 ###############################################################
 ###############################################################
@@ -31,6 +241,8 @@ class BaseStorage(object):
 
     def __init__(self):
         self.sep = sep
+        self.manifest = None
+        self.stats = StorageStats()
 
     def send(self, name, src, headers = None):
         return self.put(name, src, headers)
@@ -38,15 +250,182 @@ class BaseStorage(object):
     def put(self, name, src, headers = None):
         raise NotImplementedError("BaseStorage.put method not implemented")
 
+    @_instrumented('putMany')
+    def putMany(self, objects, workers = None, retries = None, backoff = None, progress = None):
+        '''Store many objects in parallel (with send)
+
+        params:
+            objects:  iterable of (name, src, headers), consumed as the
+                      threads go (it can be a generator)
+            workers:  number of threads (putWorkers)
+            retries:  times a failed object is retried (putRetries)
+            backoff:  seconds before the first retry, doubles on every
+                      retry (putBackoff)
+            progress: if not None, called (from the threads) with the report,
+                      the name and None or the error text after every object
+
+        Returns a PutReport, objects that failed every retry are in
+        report.failed (putMany does not raise for them).
+        '''
+
+        workers = workers or putWorkers
+        retries = putRetries if retries is None else retries
+        backoff = putBackoff if backoff is None else backoff
+
+        report  = PutReport()
+        started = time.time()
+
+        # a bounded queue, so big generators are not loaded in memory
+        tasks = Queue.Queue(2 * workers)
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                self._putRetry(task, retries, backoff, report, progress)
+
+        threads = [ threading.Thread(target = work) for i in range(workers) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for task in objects:
+                tasks.put(task)
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+        report.elapsed = time.time() - started
+
+        return report
+
+    def _putRetry(self, task, retries, backoff, report, progress):
+        """Send an object (retrying), updates the report (never raises, the
+        threads of putMany must go on)
+
+        Streams that can't seek back to where they were are not retried (a
+        retry would send what is left of them).
+        """
+
+        (name, stored, err) = (task[0] if len(task) > 0 else None, None, None)
+        try:
+            (name, src, headers) = task[:3]
+
+            # where to go back to for a retry (None: can't retry)
+            start = None
+            if hasattr(src, 'read'):
+                try:
+                    start = src.tell()
+                except Exception:
+                    retries = 0
+            for attempt in range(retries + 1):
+                try:
+                    if attempt > 0:
+                        with report._lock:
+                            report.retries += 1
+                        self.stats.count('retries')
+                        time.sleep(backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+                        if start is not None:
+                            src.seek(start)
+                    stored = self.send(*task)
+                    err = None
+                    break
+                except Exception:
+                    err = traceback.format_exc()
+        except Exception:
+            err = traceback.format_exc()
+
+        with report._lock:
+            if err is None and stored is False:
+                report.skipped += 1
+            elif err is None:
+                report.stored += 1
+            else:
+                report.failed.append((name, err))
+            if progress is not None:
+                try:
+                    progress(report, name, err)
+                except Exception:
+                    pass
+
     def copy(self, dst_name, src_name):
         raise NotImplementedError("BaseStorage.copy method not implemented")
 
+    def _listing(self):
+        '''Yields (name, size, etag) for the stored objects (for the manifest)'''
+        raise NotImplementedError("BaseStorage._listing method not implemented")
+
+    def _changed(self, name, src, headers):
+        '''False if the manifest has the object unchanged (skip storing it),
+        otherwise what to _record once stored'''
+
+        # streams that can't be read twice are not checked
+        if self.manifest is None or (hasattr(src, 'read') and not hasattr(src, 'seek')):
+            return True
+
+        digest = self.manifest.digest(src, headers)
+        if self.manifest.unchanged(name, digest):
+            self.stats.count('skipped')
+            return False
+
+        return digest
+
+    def _record(self, name, digest, size, etag):
+        '''Tell the manifest the object was stored'''
+
+        if self.manifest is not None:
+            self.manifest.record(name, digest, size, etag)
+
+    def _forget(self, name):
+        '''Tell the manifest the object changed by other means'''
+
+        if self.manifest is not None:
+            self.manifest.forget(name)
+
     def get(self, name):
         raise NotImplementedError("BaseStorage.get method not implemented")
 
+    def getStream(self, name):
+        '''A file like object reading the object'''
+        return StringIO(self.get(name))
+
     def delete(self, name):
         raise NotImplementedError("BaseStorage.delete method not implemented")
 
+    def deleteMany(self, names):
+        '''Remove many objects (missing objects are not an error: delete
+        raising ENOENT or KeyError)
+
+        Returns the list of (name, error text) of the objects not removed.
+        '''
+
+        failed = [ ]
+        for name in names:
+            try:
+                self.delete(name)
+            except (OSError, IOError) as ex:
+                if ex.errno != errno.ENOENT:
+                    failed.append((name, traceback.format_exc()))
+            except KeyError:
+                pass
+            except Exception:
+                failed.append((name, traceback.format_exc()))
+
+        return failed
+
+    def list(self, prefix = ''):
+        '''Yields the names of the objects starting with prefix (as they are listed,
+        a page at a time, so big storages are not loaded in memory)'''
+        raise NotImplementedError("BaseStorage.list method not implemented")
+
+    def stat(self, name):
+        '''Returns (size, etag, last modified) of an object, None if missing'''
+        raise NotImplementedError("BaseStorage.stat method not implemented")
+
 
 ###############################################################
 ###############################################################
@@ -60,10 +439,29 @@ class FilesystemStorage(BaseStorage):
     has to be noticed). Use manual string joins, using self.sep (initialized
     to os.sep).
 
+    Objects are written to a temporary file next to the destination and
+    renamed over it, so readers never see a partial object (and files
+    linked by copy are never changed in place).
+
     params:
         directory:             destination directory (key prefix)
+        copy_mode:             how copy duplicates a file:
+                               "copy"    - copies the data (in the kernel where
+                                           possible), the default
+                               "link"    - hard links the file (no data copied,
+                                           same volume only)
+                               "reflink" - clones the file (copy on write, btrfs,
+                                           xfs), falls back to "copy"
+        variants:              precompressed variants written next to the
+                               compressible objects (content_gzippable), so
+                               the web server can serve them as they are:
+                               "gzip" (name.gz) and "br" (name.br, needs the
+                               brotli module), default none
+        compressors:           processes compressing the variants in putMany
+                               (default the number of cpus), the threads
+                               writing the files don't compress
     '''
-    def __init__(self, directory):
+    def __init__(self, directory, copy_mode = 'copy', variants = None, compressors = None):
 
         BaseStorage.__init__(self)
 
@@ -80,36 +478,75 @@ class FilesystemStorage(BaseStorage):
             print directory
             raise IOError('invalid storage directory')
 
+        # check the copy mode
+        if copy_mode not in _copiers:
+            raise ValueError('unknown copy mode [%s]' % copy_mode)
+
+        # check the variants
+        if isinstance(variants, types.StringTypes):
+            variants = [ variants ]
+        variants = list(variants or [ ])
+        for kind in variants:
+            if kind not in variantSuffixes:
+                raise ValueError('unknown variant [%s]' % kind)
+            if kind == 'br' and brotli is None:
+                raise ValueError('brotli variants need the brotli module')
+
         self._directory  = directory
+        self._copier     = _copiers[copy_mode]
+        self._variants   = variants
+        self._compressors = compressors
 
+        # directories known to exist
+        self._dirs       = set()
+        self._dirsLock   = threading.Lock()
 
-    def put(self, name, src, headers = None):
+
+    def send(self, name, src, headers = None, variants = None, digest = None):
+        return self.put(name, src, headers, variants, digest)
+
+    @_instrumented('put')
+    def put(self, name, src, headers = None, variants = None, digest = None):
         '''Store an object on the filesystem
             params
-                name:    name for the destination object
-                src:     generator of object data
-                headers: (ignored)
+                name:     name for the destination object
+                src:      generator of object data
+                headers:  only Content-Type (compressible or not) is used
+                variants: the precompressed variants [ (suffix, data) ],
+                          made here if None (and configured)
+                digest:   what _changed returned for the object, if
+                          already checked (putMany)
+
+            Returns False if the object was unchanged (not written)
         '''
 
         if name[0] == self.sep:
             name = name[len(self.sep):] # Strip leading slash
+        if digest is None:
+            digest = self._changed(name, src, headers)
+        if digest is False:
+            return False
         tname = self._directory + self.sep + name
-        tdir = dirname(tname)
-        try:
-            if not exists(tdir):
-                #
-                # supposedly doesn't fail if directories
-                # appear, but it does fail!
-                #
-                makedirs(tdir)
-        except:
-            pass
-        f = open(tname, 'w')
-        f.write(src)
-        f.close()
+        size = self._write(tname, src)
+        stored = size
 
-        open(self._directory + self.sep + name, 'w').write(src)
+        # the variants next to it
+        if self._variants and _compressible(name, headers):
+            if variants is None:
+                if hasattr(src, 'read'):
+                    src = open(tname, 'rb').read()
+                variants = _compress(src, self._variants)
+            for (suffix, data) in variants:
+                stored += self._write(tname + suffix, data)
 
+        self.stats.transferred('put', size, stored)
+
+        if digest is not True:
+            self._record(name, digest, size, digest[0])
+
+        return True
+
+    @_instrumented('copy')
     def copy(self, dst_name, src_name):
         '''Copy S3 object to this storage
 
@@ -118,22 +555,184 @@ class FilesystemStorage(BaseStorage):
             src_name:   source object (base directory added for this store)
         '''
 
+        self._forget(dst_name)
         dst_name = self._directory + self.sep + dst_name
         src_name = self._directory + self.sep + src_name
 
-        f = open(dst_name, 'w').write(open(src_name, 'r').read())
-        f.close()
+        self._atomic(dst_name, lambda tmp: self._copier(src_name, tmp))
 
+        # and its variants (the old ones of the destination go)
+        for kind in self._variants:
+            (src, dst) = (src_name + variantSuffixes[kind], dst_name + variantSuffixes[kind])
+            if os.path.exists(src):
+                self._atomic(dst, lambda tmp: self._copier(src, tmp))
+            else:
+                try:
+                    os.remove(dst)
+                except OSError:
+                    pass
 
+
+    def putMany(self, objects, workers = None, retries = None, backoff = None, progress = None):
+        '''Store many objects in parallel (see BaseStorage.putMany)
+
+        The objects are taken groupSize at a time and sorted by directory:
+        the directories are created up front (once) and the writes to a
+        directory go together.
+        '''
+
+        objects = self._grouped(objects)
+        if not self._variants:
+            return BaseStorage.putMany(self, objects, workers, retries, backoff, progress)
+
+        # the compressing processes (started before the writing threads)
+        pool = multiprocessing.Pool(self._compressors)
+        try:
+            return BaseStorage.putMany(self, self._precompressed(objects, pool), workers, retries, backoff, progress)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def _precompressed(self, objects, pool):
+        '''Yields the tasks with their variants and manifest check
+        (name, src, headers, variants, digest), compressed in the pool
+        groupSize at a time'''
+
+        objects = iter(objects)
+        while True:
+            group = list(itertools.islice(objects, groupSize))
+            if len(group) == 0:
+                return
+
+            # only what will be written, compresses and is not a stream goes to
+            # the pool, the manifest check is passed on so put does not hash it again
+            (checked, args) = ([ ], [ ])
+            for (name, src, headers) in group:
+                digest = None
+                if not hasattr(src, 'read'):
+                    digest = self._changed(name.lstrip(self.sep), src, headers)
+                wanted = digest not in (None, False) and _compressible(name, headers)
+                if wanted:
+                    args.append((src, self._variants))
+                checked.append(((name, src, headers), digest, wanted))
+
+            compressed = pool.imap(_precompress, args, 8)
+            for (task, digest, wanted) in checked:
+                yield task + (compressed.next() if wanted else None, digest)
+
+
+    def _grouped(self, objects):
+        '''Yields the objects sorted by directory, groupSize at a time'''
+
+        objects = iter(objects)
+        while True:
+            group = list(itertools.islice(objects, groupSize))
+            if len(group) == 0:
+                return
+            group.sort(key = lambda task: dirname(task[0].lstrip(self.sep)))
+            for tdir in set([ dirname(self._directory + self.sep + task[0].lstrip(self.sep)) for task in group ]):
+                self._ensureDir(tdir)
+            for task in group:
+                yield task
+
+
+    def _write(self, tname, src):
+        '''Write a file atomically, returns the size'''
+
+        def write(tmp):
+            f = open(tmp, 'wb')
+            try:
+                if hasattr(src, 'read'):
+                    copyfileobj(src, f, chunkSize)
+                else:
+                    f.write(src)
+                return f.tell()
+            finally:
+                f.close()
+
+        return self._atomic(tname, write)
+
+
+    def _atomic(self, tname, fill):
+        '''Create a file thru a temporary file fill(tmp) creates, returns what fill returns'''
+
+        self._ensureDir(dirname(tname))
+
+        # the temporary file is in the same directory (the rename is atomic)
+        (tdir, fname) = (dirname(tname), tname[len(dirname(tname)) + len(self.sep):])
+        tmp = tdir + self.sep + '.' + fname + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        try:
+            size = fill(tmp)
+            _replace(tmp, tname)
+        except:
+            error = sys.exc_info()
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise error[0], error[1], error[2]
+
+        return size
+
+
+    def _ensureDir(self, tdir):
+        '''Create a directory (if not known to exist)'''
+
+        if tdir in self._dirs:
+            return
+
+        try:
+            makedirs(tdir)
+        except OSError as ex:
+            # created by someone else meanwhile is fine
+            if ex.errno != errno.EEXIST and not os.path.isdir(tdir):
+                raise
+
+        with self._dirsLock:
+            self._dirs.add(tdir)
+
+
+    @_instrumented('get')
     def get(self, name):
         '''Read an object from Storage
 
         params
             name:    name for the object to read
         '''
-        return open(self._directory + self.sep + name, "r").read()
+        data = open(self._directory + self.sep + name, "rb").read()
+        self.stats.transferred('get', len(data))
+        return data
+
 
+    @_instrumented('getStream')
+    def getStream(self, name):
+        '''Open an object for reading
 
+        params
+            name:    name for the object to read
+        '''
+        return open(self._directory + self.sep + name, "rb")
+
+
+    @_instrumented('getMap')
+    def getMap(self, name):
+        '''Map an object in memory (read only), the data is read by the OS as
+        it is used (an empty string for empty objects)
+
+        params
+            name:    name for the object to map
+        '''
+        f = open(self._directory + self.sep + name, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ''
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+
+    @_instrumented('delete')
     def delete(self, name):
         '''Remove an object from Storage
 
@@ -141,8 +740,96 @@ class FilesystemStorage(BaseStorage):
             name:    name for the object to delete
         '''
 
+        self._forget(name)
         os.remove(self._directory + self.sep + name)
 
+        # and its variants
+        for kind in self._variants:
+            try:
+                os.remove(self._directory + self.sep + name + variantSuffixes[kind])
+            except OSError:
+                pass
+
+
+    @_instrumented('deleteMany')
+    def deleteMany(self, names, workers = None):
+        '''Remove many objects in parallel (missing objects are not an error)
+
+        params
+            names:   the names of the objects to delete
+            workers: number of threads (putWorkers)
+
+        Returns the list of (name, error text) of the objects not removed.
+        '''
+
+        def unlink(name):
+            try:
+                self.delete(name)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    return (name, str(ex))
+            return None
+
+        pool = multiprocessing.pool.ThreadPool(workers or putWorkers)
+        try:
+            return [ err for err in pool.imap_unordered(unlink, names, 64) if err is not None ]
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def list(self, prefix = ''):
+        '''Yields the names of the objects starting with prefix
+
+        params
+            prefix:  the start of the names (only the folders that can
+                     match are walked)
+        '''
+
+        # the folder part of the prefix is where to start
+        start = prefix[:prefix.rfind(self.sep)] if self.sep in prefix else ''
+        top   = self._directory + self.sep + start if start else self._directory
+        skip  = len(self._directory) + len(self.sep)
+
+        for (path, dirs, files) in os.walk(top):
+            dirs.sort()
+            for fname in sorted(files):
+                if fname.startswith('.') and fname.endswith('.tmp'):
+                    continue            # being written
+                name = (path + self.sep + fname)[skip:]
+                if name.startswith(prefix):
+                    yield name
+
+
+    @_instrumented('stat')
+    def stat(self, name):
+        '''Returns (size, etag, last modified) of an object, None if missing
+
+        params
+            name:    name for the object
+        '''
+        try:
+            st = os.stat(self._directory + self.sep + name)
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                return None
+            raise
+
+        # files are replaced, never changed in place: inode, time and size tell
+        return (st.st_size, '%x-%x-%x' % (st.st_ino, int(st.st_mtime * 1000000), st.st_size), st.st_mtime)
+
+
+    def _listing(self):
+        '''Yields (name, size, md5) for the files in the directory'''
+
+        for (path, dirs, files) in os.walk(self._directory):
+            for fname in files:
+                if fname.startswith('.') and fname.endswith('.tmp'):
+                    continue            # being written
+                fname = path + self.sep + fname
+                data  = open(fname, 'rb').read()
+                yield (fname[len(self._directory) + len(self.sep):], len(data), hashlib.md5(data).hexdigest())
+
 
 
 ###############################################################
@@ -160,20 +847,43 @@ class S3Storage(BaseStorage):
            cache_type:            Cache-Control header (public,max-age=3600)
            AWS_ACCESS_KEY_ID:     AWS key id
            AWS_SECRET_ACCESS_KEY: AWS secret key
+           level:                 gzip compression level, 1 (fast) to 9 (small) (9)
+           part_size:             objects larger than this are uploaded in parts of
+                                  this size (8Mb, S3 needs at least 5Mb)
+           host:                  S3 endpoint (default AWS), for S3 compatible servers
+           port:                  S3 endpoint port (default 443, or 80 if not secure)
+           secure:                use https (True)
+
+       boto connections are not thread safe, every thread (see putMany)
+       gets its own connection.
     '''
     def __init__(self, bucket_name, directory = None, gzip = True,
            cache_type = 'public,max-age=3600',
-           AWS_ACCESS_KEY_ID = None, AWS_SECRET_ACCESS_KEY = None):
+           AWS_ACCESS_KEY_ID = None, AWS_SECRET_ACCESS_KEY = None,
+           level = 9, part_size = 8 * 1024 * 1024,
+           host = None, port = None, secure = True):
 
         BaseStorage.__init__(self)
 
         # overide operating system (this is the web)
         self.sep         = "/"
 
-        self._conn       = connect_s3(AWS_ACCESS_KEY_ID,
-                                      AWS_SECRET_ACCESS_KEY)
-        self._bucket     = self._conn.get_bucket(bucket_name)
+        self._bucket_name = bucket_name
+        self._connArgs   = { "is_secure": secure }
+        if host is not None:
+            # not AWS, address the bucket in the path
+            self._connArgs["host"] = host
+            self._connArgs["calling_format"] = OrdinaryCallingFormat()
+        if port is not None:
+            self._connArgs["port"] = int(port)
+        self._keys       = (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        self._local      = threading.local()
+
+        # connect (and check the bucket) in this thread
+        self._local.bucket = self._connect().get_bucket(bucket_name)
         self._gzip       = gzip
+        self._level      = int(level)
+        self._part_size  = int(part_size)
         self._cache_type = cache_type
         if directory:
             if directory[0] is self.sep:
@@ -182,19 +892,44 @@ class S3Storage(BaseStorage):
                 directory = directory[:-1] # Remove trailing slash for S3
         self._directory  = directory
 
-    def send(self, name, src, headers):
+    def _connect(self):
+        '''A new S3 connection'''
+        return connect_s3(self._keys[0], self._keys[1], **self._connArgs)
+
+    @property
+    def _bucket(self):
+        '''The bucket for the current thread'''
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            bucket = self._connect().get_bucket(self._bucket_name, validate = False)
+            self._local.bucket = bucket
+        return bucket
+
+    def put(self, name, src, headers = None):
+        return self.send(name, src, headers)
+
+    @_instrumented('send')
+    def send(self, name, src, headers = None):
         '''Upload an object to S3
            params
            name:    name for the destination object
-           src:     generator of object data
-           headers: Content-Type, Content-Encoding, Cache-Control'''
+           src:     object data (a string or a file like object, read in chunks)
+           headers: Content-Type, Content-Encoding, Cache-Control
+
+           The data is compressed as it is read (if Content-Encoding is
+           gzip), objects over part_size are uploaded in parts, so memory
+           stays around part_size whatever the object size.'''
+
+        if headers is None:
+            headers = { }
+
+        digest = self._changed(name, src, headers)
+        if digest is False:
+            return False
 
         # Create key
         key     = Key(self._bucket)
-        if self._directory:
-            key.key = (self.sep).join((self._directory, name))
-        else:
-            key.key = name
+        key.key = self._keyName(name)
 
         # Headers
         for header_name, header_value in headers.items():
@@ -202,20 +937,74 @@ class S3Storage(BaseStorage):
 
         # Note: S3 already sets Etag
 
-        fbuf = StringIO()  # Temporary in-memory virtual file
+        raw = [ 0 ]
+        def counted(chunks):
+            for chunk in chunks:
+                raw[0] += len(chunk)
+                yield chunk
+
+        chunks = counted(_chunks(src))
         if headers.get('Content-Encoding', None) == 'gzip' and self._gzip:
             # Compressed
-            zf = GzipFile(name, 'wb', 9, fbuf)
-            zf.write(src)
-            zf.close()
-        else:
-            # Plain
-            fbuf.write(src)
+            chunks = _gzip(chunks, self._level)
+
+        (size, etag) = self._upload(key, chunks)
+        self.stats.transferred('send', raw[0], size)
 
-        # Upload
-        key.set_contents_from_file(fbuf, policy = 'public-read',
-                reduced_redundancy = True)
+        if digest is not True:
+            self._record(name, digest, size, etag)
 
+        return True
+
+    def _upload(self, key, chunks):
+        '''Upload the chunks (in parts if over part_size), returns the (size, etag)'''
+
+        size = 0
+        part = 0
+        mp   = None
+        fbuf = StringIO()  # Temporary in-memory virtual file
+        try:
+            for chunk in chunks:
+                fbuf.write(chunk)
+                size += len(chunk)
+                if fbuf.tell() < self._part_size:
+                    continue
+
+                # large object, send this part
+                if mp is None:
+                    mp = self._bucket.initiate_multipart_upload(key.key, policy = 'public-read',
+                            reduced_redundancy = True,
+                            headers = merge_meta({ }, key.metadata, self._bucket.connection.provider))
+                part += 1
+                fbuf.seek(0)
+                mp.upload_part_from_file(fbuf, part)
+                fbuf = StringIO()
+
+            # small object, in one go (from the start of the buffer)
+            if mp is None:
+                fbuf.seek(0)
+                key.set_contents_from_file(fbuf, policy = 'public-read',
+                        reduced_redundancy = True)
+                return (size, key.etag.strip('"'))
+
+            # the last part
+            if fbuf.tell() > 0 or part == 0:
+                part += 1
+                fbuf.seek(0)
+                mp.upload_part_from_file(fbuf, part)
+            return (size, mp.complete_upload().etag.strip('"'))
+
+        except:
+            # give up the parts (keeping the original error)
+            error = sys.exc_info()
+            if mp is not None:
+                try:
+                    mp.cancel_upload()
+                except Exception:
+                    pass
+            raise error[0], error[1], error[2]
+
+    @_instrumented('copy')
     def copy(self, dst_name, src_name, src_bucket_name = None):
         '''Copy S3 object to this storage
            dst_name:   new name (without base directory)
@@ -224,24 +1013,746 @@ class S3Storage(BaseStorage):
          '''
         if not src_bucket_name:
             src_bucket_name = self._bucket.name
+        self._forget(dst_name)
         if self._directory:
             dst_name = (self.sep).join((self._directory, dst_name))
             if src_bucket_name == self._bucket.name:
                 src_name = (self.sep).join((self._directory, src_name))
         self._bucket.copy_key(dst_name, src_bucket_name, src_name)
 
+    @_instrumented('get')
     def get(self, name):
-        key = self._bucket.get_key(name)
-        ret = key.get_contents_as_string()
+        stream = self._open(name)
+        try:
+            data = stream.read()
+        finally:
+            stream.close()
+        self.stats.transferred('get', len(data))
+        return data
+
+    @_instrumented('getStream')
+    def getStream(self, name):
+        '''A file like object reading the object (uncompressed as it is read)'''
+
+        return self._open(name)
+
+    def _open(self, name):
+        '''getStream (not counted, get uses it)'''
+
+        key = self._bucket.get_key(self._keyName(name))
+        if key is None:
+            raise IOError("object [%s] not found" % name)
 
         if key.content_encoding == 'gzip':
-            fbuf = StringIO(ret)  # Temporary in-memory virtual file
-            zf = GzipFile(mode = 'rb', fileobj = fbuf)
-            ret = zf.read()
-            zf.close()
+            return _GunzipReader(key)
+
+        return key
+
+    @_instrumented('delete')
+    def delete(self, name):
+        '''Remove an object'''
+
+        self._forget(name)
+        self._bucket.delete_key(self._keyName(name))
+
+    @_instrumented('deleteMany')
+    def deleteMany(self, names):
+        '''Remove many objects, 1000 per request (missing objects are not an error)
+
+        Returns the list of (name, error text) of the objects not removed.
+        '''
+
+        failed = [ ]
+        names  = iter(names)
+        while True:
+            page = list(itertools.islice(names, 1000))
+            if len(page) == 0:
+                return failed
+
+            for name in page:
+                self._forget(name)
+            keys   = dict([ (self._keyName(name), name) for name in page ])
+            result = self._bucket.delete_keys(keys.keys(), quiet = True)
+            for error in result.errors:
+                failed.append((keys.get(error.key, error.key), '%s: %s' % (error.code, error.message)))
+
+    def list(self, prefix = ''):
+        '''Yields the names of the objects starting with prefix (S3 lists 1000 at a time)'''
+
+        skip = len(self._directory) + len(self.sep) if self._directory else 0
+        for key in self._bucket.list(self._keyName(prefix)):
+            yield key.name[skip:]
+
+    @_instrumented('stat')
+    def stat(self, name):
+        '''Returns (size, etag, last modified) of an object, None if missing'''
+
+        key = self._bucket.get_key(self._keyName(name))
+        if key is None:
+            return None
+
+        return (key.size, key.etag.strip('"'), key.last_modified)
+
+    def _keyName(self, name):
+        '''The key for an object name (in the directory)'''
+
+        if self._directory:
+            return (self.sep).join((self._directory, name))
+
+        return name
+
+    def _listing(self):
+        '''Yields (name, size, etag) for the keys under the directory'''
+
+        prefix = self._directory + self.sep if self._directory else ''
+        for key in self._bucket.list(prefix):
+            yield (key.name[len(prefix):], key.size, key.etag.strip('"'))
+
+
+###############################################################
+###############################################################
+#
+# CachingStorage class
+#
+class CachingStorage(BaseStorage):
+    '''Read-through cache in front of another storage
+
+    Objects read are kept in a local folder (size bounded, least recently
+    used go first) and the small ones also in memory. An object is checked
+    against the backend (stat: etag or last modified) at most every
+    revalidate seconds, until then the cached copy is used. The cache folder
+    can be shared by many processes (files are named by object and etag).
+
+    Writes go to the backend (and drop the cached copy).
+
+    params:
+        backend:               the storage cached
+        directory:             the cache folder
+        max_size:              cache folder size in bytes (1Gb)
+        memory_size:           bytes kept in memory (64Mb)
+        memory_object:         larger objects are not kept in memory (1Mb)
+        revalidate:            seconds before checking an object again (60)
+    '''
+    def __init__(self, backend, directory, max_size = 1024 * 1024 * 1024,
+           memory_size = 64 * 1024 * 1024, memory_object = 1024 * 1024, revalidate = 60):
+
+        BaseStorage.__init__(self)
+
+        if not directory:
+            raise IOError('cache directory required')
+
+        # the cache folder
+        if not exists(directory):
+            makedirs(directory)
+
+        self.sep             = backend.sep
+        self._backend        = backend
+        self._cache          = FilesystemStorage(directory)
+        self._directory      = directory
+        self._max_size       = int(max_size)
+        self._memory_size    = int(memory_size)
+        self._memory_object  = int(memory_object)
+        self._revalidate     = float(revalidate)
+
+        self._lock           = threading.Lock()
+        self._memory         = collections.OrderedDict()   # name -> (etag, data), LRU order
+        self._memoryUsed     = 0
+        self._checked        = { }                         # name -> (etag, time checked)
+        self._written        = self._max_size              # bytes cached since the last trim
+
+        # counters
+        self.hits            = 0          # from memory
+        self.diskHits        = 0          # from the cache folder
+        self.misses          = 0          # from the backend
+
+    @property
+    def manifest(self):
+        return self._backend.manifest
+
+    @manifest.setter
+    def manifest(self, manifest):
+        # BaseStorage.__init__ sets it before there is a backend
+        if hasattr(self, '_backend'):
+            self._backend.manifest = manifest
+
+    @_instrumented('send')
+    def send(self, name, src, headers = None):
+        self._drop(name)
+        return self._backend.send(name, src, headers)
+
+    @_instrumented('put')
+    def put(self, name, src, headers = None):
+        self._drop(name)
+        return self._backend.put(name, src, headers)
+
+    @_instrumented('putMany')
+    def putMany(self, objects, workers = None, retries = None, backoff = None, progress = None):
+        def dropping(objects):
+            for task in objects:
+                self._drop(task[0])
+                yield task
+        return self._backend.putMany(dropping(objects), workers, retries, backoff, progress)
+
+    @_instrumented('copy')
+    def copy(self, dst_name, src_name):
+        self._drop(dst_name)
+        return self._backend.copy(dst_name, src_name)
+
+    @_instrumented('delete')
+    def delete(self, name):
+        self._drop(name)
+        return self._backend.delete(name)
+
+    @_instrumented('deleteMany')
+    def deleteMany(self, names):
+        def dropping(names):
+            for name in names:
+                self._drop(name)
+                yield name
+        return self._backend.deleteMany(dropping(names))
+
+    def list(self, prefix = ''):
+        return self._backend.list(prefix)
+
+    @_instrumented('stat')
+    def stat(self, name):
+        return self._backend.stat(name)
+
+    def _listing(self):
+        return self._backend._listing()
+
+    @_instrumented('get')
+    def get(self, name):
+        '''Read an object (from memory, the cache folder or the backend)'''
+
+        etag = self._etag(name)
+
+        # in memory?
+        with self._lock:
+            entry = self._memory.get(name)
+            if entry is not None and entry[0] == etag:
+                self._memory[name] = self._memory.pop(name)     # most recently used
+                self.hits += 1
+                return entry[1]
+
+        f = self._cached(name, etag)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self._remember(name, etag, data)
+
+        return data
+
+    @_instrumented('getStream')
+    def getStream(self, name):
+        '''Open an object for reading (the cached copy)'''
+
+        return self._cached(name, self._etag(name))
+
+    def _etag(self, name):
+        '''The object etag, checked on the backend every revalidate seconds'''
+
+        now = time.time()
+        with self._lock:
+            (etag, checked) = self._checked.get(name, (None, 0))
+        if now - checked < self._revalidate:
+            return etag
+
+        st = self._backend.stat(name)
+        if st is None:
+            self._drop(name)
+            raise IOError('object [%s] not found' % name)
+        etag = str(st[1] or st[2])
+
+        with self._lock:
+            self._checked[name] = (etag, now)
+
+        return etag
+
+    def _cached(self, name, etag):
+        '''Open the cached copy of an object version (fetching it if needed)'''
+
+        cname = self._cacheName(name, etag)
+        try:
+            f = self._cache.getStream(cname)
+            os.utime(f.name, None)              # recently used
+            with self._lock:
+                self.diskHits += 1
+            return f
+        except (IOError, OSError):
+            pass
+
+        # fetch it
+        stream = self._backend.getStream(name)
+        try:
+            size = self._cache._write(self._directory + self.sep + cname, stream)
+        finally:
+            stream.close()
+        with self._lock:
+            self.misses  += 1
+            self._written += size
+            trim = self._written >= self._max_size / 10
+            if trim:
+                self._written = 0
+        if trim:
+            self._trim()
+
+        return self._cache.getStream(cname)
+
+    def _cacheName(self, name, etag):
+        '''The cache file name of an object version'''
+
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        hash = hashlib.sha1(name).hexdigest()
+        return hash[:2] + self.sep + hash + '-' + hashlib.sha1(etag).hexdigest()[:16]
+
+    def _remember(self, name, etag, data):
+        '''Keep a small object in memory'''
+
+        if len(data) > self._memory_object:
+            return
+
+        with self._lock:
+            old = self._memory.pop(name, None)
+            if old is not None:
+                self._memoryUsed -= len(old[1])
+            self._memory[name] = (etag, data)
+            self._memoryUsed += len(data)
+            while self._memoryUsed > self._memory_size:
+                (n, (e, d)) = self._memory.popitem(last = False)
+                self._memoryUsed -= len(d)
+
+    def _drop(self, name):
+        '''Forget what we know about an object (it is being changed)'''
+
+        with self._lock:
+            self._checked.pop(name, None)
+            old = self._memory.pop(name, None)
+            if old is not None:
+                self._memoryUsed -= len(old[1])
+
+    def _trim(self):
+        '''Remove the least recently used files over the cache size'''
+
+        files = [ ]
+        total = 0
+        for (path, dirs, names) in os.walk(self._directory):
+            for fname in names:
+                if fname.endswith('.tmp'):
+                    continue            # being written
+                fname = path + self.sep + fname
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, fname))
+                total += st.st_size
+
+        # down to 90%, so it does not trim again right away
+        files.sort()
+        for (mtime, size, fname) in files:
+            if total <= self._max_size * 0.9:
+                break
+            try:
+                os.remove(fname)
+                total -= size
+            except OSError:
+                pass
+
+
+###############################################################
+###############################################################
+#
+# ReplicatedStorage class
+#
+class ReplicatedStorage(BaseStorage):
+    '''Writes every object to many storages
+
+    Every backend has its own queue and threads, so a slow backend does not
+    hold the others back (until its queue fills up). put/send only queue the
+    object (file like objects are read in memory first), flush() waits until
+    every backend has written everything queued and returns a
+    ReplicationReport. putMany queues and flushes.
+
+    Reads (get, getStream, stat, list) go to the first backend. copy and
+    delete wait for the objects queued (so they act on what was put
+    before), then are done on every backend in turn. close() flushes and
+    stops the threads.
+
+    params:
+        backends:              list of (name, storage), the first one is read
+        workers:               threads per backend (2)
+        queue_size:            objects waiting per backend (1000)
+        retries:               times a failed object is retried (putRetries)
+        backoff:               seconds before the first retry (putBackoff)
+    '''
+    def __init__(self, backends, workers = 2, queue_size = 1000, retries = None, backoff = None):
+
+        BaseStorage.__init__(self)
+
+        if len(backends) == 0:
+            raise ValueError('replicated storage needs backends')
+
+        self.sep       = backends[0][1].sep
+        self._retries  = putRetries if retries is None else retries
+        self._backoff  = putBackoff if backoff is None else backoff
+        self._replicas = [ _Replica(name, storage, workers, queue_size) for (name, storage) in backends ]
+        self._primary  = backends[0][1]
+
+    @_instrumented('send')
+    def send(self, name, src, headers = None):
+        '''Queue an object for every backend'''
+
+        self._queue((name, src, headers), self._retries, self._backoff, None)
+        return True
+
+    def put(self, name, src, headers = None):
+        return self.send(name, src, headers)
+
+    @_instrumented('putMany')
+    def putMany(self, objects, workers = None, retries = None, backoff = None, progress = None):
+        '''Store many objects on every backend (workers is per backend, set when
+        created), returns the ReplicationReport of everything queued so far'''
+
+        retries = self._retries if retries is None else retries
+        backoff = self._backoff if backoff is None else backoff
+        for task in objects:
+            self._queue(task, retries, backoff, progress)
+
+        return self.flush()
+
+    def flush(self):
+        '''Wait until every backend wrote everything queued, returns (and resets)
+        the ReplicationReport'''
+
+        self._wait()
+
+        return ReplicationReport(dict([ (replica.name, replica.take()) for replica in self._replicas ]))
+
+    def close(self):
+        '''Flush and stop the backend threads, returns the last ReplicationReport'''
+
+        report = self.flush()
+        for replica in self._replicas:
+            replica.close()
+
+        return report
+
+    def _wait(self):
+        '''Wait until every backend wrote everything queued (the reports are kept)'''
+
+        for replica in self._replicas:
+            replica.queue.join()
+
+    def _queue(self, task, retries, backoff, progress):
+        '''Queue a task in every backend'''
+
+        (name, src, headers) = task
+        if hasattr(src, 'read'):
+            task = (name, src.read(), headers)  # one stream can't be read by many
+
+        for replica in self._replicas:
+            replica.put(task, retries, backoff, progress)
+
+    @_instrumented('copy')
+    def copy(self, dst_name, src_name):
+        self._wait()
+        for replica in self._replicas:
+            replica.storage.copy(dst_name, src_name)
+
+    @_instrumented('delete')
+    def delete(self, name):
+        self._wait()
+        for replica in self._replicas:
+            replica.storage.delete(name)
+
+    @_instrumented('deleteMany')
+    def deleteMany(self, names):
+        names  = list(names)
+        failed = [ ]
+        self._wait()
+        for replica in self._replicas:
+            failed.extend(replica.storage.deleteMany(names))
+        return failed
+
+    @_instrumented('get')
+    def get(self, name):
+        return self._primary.get(name)
+
+    @_instrumented('getStream')
+    def getStream(self, name):
+        return self._primary.getStream(name)
+
+    @_instrumented('stat')
+    def stat(self, name):
+        return self._primary.stat(name)
+
+    def list(self, prefix = ''):
+        return self._primary.list(prefix)
+
+    def _listing(self):
+        return self._primary._listing()
+
+
+class _Replica(object):
+    '''A backend of a ReplicatedStorage, with its queue and threads'''
+
+    def __init__(self, name, storage, workers, queueSize):
+        self.name    = name
+        self.storage = storage
+        self.queue   = Queue.Queue(queueSize)
+        self.report  = PutReport()
+        self.started = None
+        self.threads = [ ]
+
+        for i in range(workers):
+            thread = threading.Thread(target = self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, task, retries, backoff, progress):
+        if not self.threads:
+            raise ValueError('replicated storage closed')
+        if self.started is None:
+            self.started = time.time()
+        self.queue.put((task, retries, backoff, progress))
+
+    def take(self):
+        '''The report so far (a new one starts)'''
+
+        (report, self.report) = (self.report, PutReport())
+        if self.started is not None:
+            report.elapsed = time.time() - self.started
+        self.started = None
+
+        return report
+
+    def close(self):
+        '''Stop the threads (after the tasks queued)'''
+
+        (threads, self.threads) = (self.threads, [ ])
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            work = self.queue.get()
+            if work is None:
+                self.queue.task_done()
+                return
+            (task, retries, backoff, progress) = work
+            try:
+                self.storage._putRetry(task, retries, backoff, self.report, progress)
+            finally:
+                self.queue.task_done()
+
+
+###############################################################
+###############################################################
+#
+# helpers
+#
+
+def _replace(src, dst):
+    '''Rename src over dst (atomically, even where rename does not replace)'''
+
+    if os.name != 'nt':
+        os.rename(src, dst)
+        return
+
+    # windows: rename fails if dst exists, MoveFileEx can replace it
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), MOVEFILE_REPLACE_EXISTING):
+        raise ctypes.WinError()
+
+
+def _chunks(src):
+    '''Yields the data of a string or file like object in chunks'''
+
+    if not hasattr(src, 'read'):
+        if isinstance(src, unicode):
+            src = src.encode('utf-8')
+        yield src
+        return
+
+    while True:
+        chunk = src.read(chunkSize)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _gzip(chunks, level):
+    '''Yields the chunks gzip compressed (no name or time in the header,
+    the same data always compresses the same)'''
+
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+
+def _compressible(name, headers):
+    '''True if the object content compresses (by Content-Type, or name)'''
+
+    ctype = (headers or { }).get('Content-Type')
+    if ctype is None:
+        ctype = mimetypes.guess_type(name)[0]
+
+    return ctype is not None and ctype.split(';')[0].strip() in content_gzippable
+
+
+def _compress(data, kinds):
+    '''The precompressed variants of the data [ (suffix, data) ]'''
+
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    variants = [ ]
+    for kind in kinds:
+        if kind == 'gzip':
+            variants.append((variantSuffixes[kind], ''.join(_gzip([ data ], 9))))
+        elif kind == 'br':
+            variants.append((variantSuffixes[kind], brotli.compress(data, quality = 11)))
+
+    return variants
+
+
+def _precompress(args):
+    '''The variants of a putMany object (in a pool process)'''
+
+    (src, kinds) = args
+    return _compress(src, kinds)
+
+
+def _copyData(src, dst):
+    '''Copy a file (with sendfile where available, the data stays in the kernel)'''
+
+    fin = open(src, 'rb')
+    try:
+        fout = open(dst, 'wb')
+        try:
+            size = os.fstat(fin.fileno()).st_size
+            if not _sendfile(fin.fileno(), fout.fileno(), size):
+                copyfileobj(fin, fout, chunkSize)
+        finally:
+            fout.close()
+    finally:
+        fin.close()
+
+    shutil.copymode(src, dst)
+
+
+def _linkData(src, dst):
+    '''Hard link a file'''
+    os.link(src, dst)
+
+
+def _cloneData(src, dst):
+    '''Clone a file (copy on write), copy it if the file system can't'''
+
+    fin = open(src, 'rb')
+    try:
+        fout = open(dst, 'wb')
+        try:
+            try:
+                import fcntl
+                fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+                return
+            except (ImportError, IOError, OSError):
+                pass
+        finally:
+            fout.close()
+    finally:
+        fin.close()
+
+    _copyData(src, dst)
+
+
+_copiers = {
+    'copy':    _copyData,
+    'link':    _linkData,
+    'reflink': _cloneData,
+}
+
+# linux ioctl to clone a file
+_FICLONE = 0x40049409
+
+_libc = None
+
+def _sendfile(fdin, fdout, size):
+    '''Copy size bytes between files in the kernel (linux), False if not possible'''
+
+    global _libc
+
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                import ctypes.util
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+                libc.sendfile.restype  = ctypes.c_ssize_t
+                libc.sendfile.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t ]
+                _libc = libc
+            except (ImportError, OSError, AttributeError):
+                pass
+
+    if not _libc:
+        return False
+
+    # sendfile copies at most ~2Gb per call
+    done = 0
+    while done < size:
+        sent = _libc.sendfile(fdout, fdin, None, min(size - done, 0x40000000))
+        if sent < 0:
+            if done == 0:
+                return False            # not supported for these files
+            import ctypes
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if sent == 0:
+            break
+        done += sent
+
+    return True
+
+
+class _GunzipReader(object):
+    '''File like object uncompressing a gzip stream as it is read'''
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._z       = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer  = ''
+        self._eof     = False
+
+    def read(self, size = -1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._fileobj.read(chunkSize)
+            if data:
+                self._buffer += self._z.decompress(data)
+            else:
+                self._buffer += self._z.flush()
+                self._eof = True
+
+        if size < 0:
+            size = len(self._buffer)
+        (ret, self._buffer) = (self._buffer[:size], self._buffer[size:])
 
         return ret
 
+    def close(self):
+        self._fileobj.close()
+
 
 ###############################################################
 ###############################################################
@@ -269,10 +1780,13 @@ def _createFilesystemStorage(config, prefix):
     
     # fetch attributes and create
     dir = config.getMulti(prefix, "path")
-    return FilesystemStorage(dir)
+    copyMode = config.getMulti(prefix, "copy", "copy")
+    variants = config.getMulti(prefix, "variants")
+    compressors = config.getMulti(prefix, "compressors")
+    return FilesystemStorage(dir, copyMode, variants, compressors)
 
 
-def _createS3Storage(config, prefix, name):
+def _createS3Storage(config, prefix):
 
     # fetch attributes and create
     bucket     = config.getMulti(prefix, "bucket")
@@ -281,8 +1795,46 @@ def _createS3Storage(config, prefix, name):
     cache      = config.getMulti(prefix, "cache", "public,max-age=3600")
     accessKey  = config.getMulti(prefix, "access-key")
     secretKey  = config.getMulti(prefix, "secret-key")
+    level      = config.getMulti(prefix, "level", 9)
+    partSize   = config.getMulti(prefix, "part-size", 8 * 1024 * 1024)
+    host       = config.getMulti(prefix, "host")
+    port       = config.getMulti(prefix, "port")
+    secure     = config.getMulti(prefix, "secure", True)
+
+    return S3Storage(bucket, dir, gzip, cache, accessKey, secretKey, level, partSize, host, port, secure)
+
+
+def _createCachingStorage(config, prefix):
 
-    return S3Storage(bucket, dir, gzip, cache, accessKey, secretKey)
+    # the backend options are in the same place
+    backend = config.getMulti(prefix, "backend", "folder")
+    if backend not in _types or _types[backend] is _createCachingStorage:
+        raise ValueError("Storage backend type [%s] now known" % backend)
+
+    # fetch attributes and create ("cache" is the Cache-Control of s3 backends)
+    dir        = config.getMulti(prefix, "cache-dir")
+    maxSize    = config.getMulti(prefix, "cache-size", 1024 * 1024 * 1024)
+    memory     = config.getMulti(prefix, "memory-size", 64 * 1024 * 1024)
+    memoryObj  = config.getMulti(prefix, "memory-object", 1024 * 1024)
+    revalidate = config.getMulti(prefix, "revalidate", 60)
+
+    return CachingStorage(_types[backend](config, prefix), dir, maxSize, memory, memoryObj, revalidate)
+
+
+def _createReplicatedStorage(config, prefix):
+
+    # the backends are other storages (by name) next to this one
+    parent   = prefix.rsplit(".", 1)[0]
+    names    = config.getMulti(prefix, "backends", [ ])
+    backends = [ (name, getStorage(config, parent, name)) for name in names ]
+
+    # fetch attributes and create
+    workers    = config.getMulti(prefix, "workers", 2)
+    queueSize  = config.getMulti(prefix, "queue-size", 1000)
+    retries    = config.getMulti(prefix, "retries")
+    backoff    = config.getMulti(prefix, "backoff")
+
+    return ReplicatedStorage(backends, workers, queueSize, retries, backoff)
 
 
 _types = {
@@ -291,7 +1843,9 @@ _types = {
     "file"   : _createFilesystemStorage,
     "s3"     : _createS3Storage,
     "aws"    : _createS3Storage,
-    "amazon" : _createS3Storage
+    "amazon" : _createS3Storage,
+    "cached" : _createCachingStorage,
+    "replicated" : _createReplicatedStorage
 }
 
 
@@ -310,7 +1864,14 @@ def getStorage(config, prefix, name):
         raise ValueError("Storage type [%s] now known" % type)
 
     # create the storage
-    return _types[type](config, prefix + "." + name)
+    storage = _types[type](config, prefix + "." + name)
+
+    # skip unchanged objects?
+    manifest = config.getMulti(prefix + "." + name, "manifest")
+    if manifest is not None:
+        storage.manifest = Manifest(manifest)
+
+    return storage
 
 
 def getStorages(config, prefix):
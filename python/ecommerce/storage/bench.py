@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Storage throughput benchmark
+
+Pushes synthetic pages (html of about the size of a product page, each one
+different) thru putMany and prints, for every setting, the pages and MB per
+second, the bytes before and after compression, the retries and the
+storage.stats table:
+
+    folder  FilesystemStorage in a temporary folder, with 1, 4 and 16
+            workers, without variants and with gzip variants
+    s3      S3Storage against the local S3 stand-in (ecommerce.storage.s3local),
+            or an S3 compatible server given as host:port, with 1, 4 and 16
+            workers and gzip levels 1, 6 and 9
+
+The numbers are for tuning putWorkers and the gzip level of the publish
+window, compare them on the machine that publishes.
+
+usage: python -m ecommerce.storage.bench <command> [pages] [host:port bucket]   (see command help)
+"""
+
+import sys
+import os
+import random
+import tempfile
+import shutil
+
+# pages pushed by default
+defaultPages = 2000
+
+# the settings compared
+workerCounts = [ 1, 4, 16 ]
+gzipLevels   = [ 1, 6, 9 ]
+
+_headers = { "Content-Type": "text/html", "Cache-Control": "public,max-age=3600" }
+
+# S3Storage compresses what is sent with Content-Encoding gzip
+_gzipHeaders = dict(_headers, **{ "Content-Encoding": "gzip" })
+
+_words = ("product", "price", "offer", "shipping", "stock", "color", "size", "brand",
+          "review", "rating", "warranty", "delivery", "category", "model", "new", "sale")
+
+
+def pages(n, headers = _headers, seed = 0):
+    """Generates n synthetic (name, html, headers), about 15KB each"""
+
+    rnd = random.Random(seed)
+    for i in xrange(n):
+        items = "".join([ '<li class="item"><a href="/p/%d">%s</a> <span>%d.%02d</span></li>\n' %
+                          (rnd.randint(1, 10 ** 6), " ".join(rnd.sample(_words, 5)),
+                           rnd.randint(1, 999), rnd.randint(0, 99))
+                          for _ in xrange(150) ])
+        html = "<html><head><title>Page %d</title></head><body><ul>\n%s</ul></body></html>\n" % (i, items)
+        yield ("bench/%03d/page%d.html" % (i % 100, i), html, headers)
+
+
+def run(label, storage, n, workers, headers = _headers):
+    """Push n pages thru storage.putMany, print the numbers and return the report"""
+
+    storage.stats.reset()
+    report = storage.putMany(pages(n, headers), workers = workers, backoff = 0.1)
+    stats  = storage.stats.snapshot()
+    elapsed = max(report.elapsed, 1e-6)
+
+    print "%-28s %8.1f pages/s %8.2f MB/s raw %8.2f MB/s stored %5.1f%% %4d retries %4d failed" % \
+          (label, report.stored / elapsed, stats["raw"] / elapsed / 1e6, stats["stored"] / elapsed / 1e6,
+           100.0 * stats["stored"] / max(stats["raw"], 1), stats["retries"], len(report.failed))
+    return report
+
+###################################################
+
+def _pages():
+    """The number of pages in the command line"""
+
+    return int(sys.argv[2]) if len(sys.argv) > 2 else defaultPages
+
+
+def _verbose():
+    """Print the stats tables"""
+
+    return "-v" in sys.argv
+
+###################################################
+
+def cmdFolder():
+    """Benchmark FilesystemStorage"""
+
+    from ecommerce.storage import FilesystemStorage
+
+    n = _pages()
+    print ""
+    print "FilesystemStorage, %d pages" % n
+    for variants in (None, [ "gzip" ]):
+        for workers in workerCounts:
+            directory = tempfile.mkdtemp(prefix = "storage-bench-")
+            try:
+                storage = FilesystemStorage(directory, variants = variants)
+                run("workers %2d variants %-5s" % (workers, ",".join(variants or [ "none" ])), storage, n, workers)
+                if _verbose():
+                    print storage.stats
+            finally:
+                shutil.rmtree(directory, True)
+    print ""
+
+    return True
+
+###################################################
+
+def cmdS3():
+    """Benchmark S3Storage"""
+
+    from ecommerce.storage import S3Storage
+    from ecommerce.storage.s3local import S3Server
+
+    n = _pages()
+    args = [ arg for arg in sys.argv[3:] if arg != "-v" ]
+
+    # a given server (credentials from the environment) or the stand-in
+    server = None
+    if args:
+        (host, port) = args[0].split(":")
+        (port, bucket) = (int(port), args[1] if len(args) > 1 else "storage-bench")
+        (key, secret) = (os.environ.get("AWS_ACCESS_KEY_ID"), os.environ.get("AWS_SECRET_ACCESS_KEY"))
+    else:
+        server = S3Server()
+        server.start()
+        (host, port, bucket, key, secret) = ("127.0.0.1", server.server_port, "storage-bench", "key", "secret")
+
+    print ""
+    print "S3Storage at %s:%d, %d pages" % (host, port, n)
+    try:
+        for level in gzipLevels:
+            for workers in workerCounts:
+                storage = S3Storage(bucket, AWS_ACCESS_KEY_ID = key, AWS_SECRET_ACCESS_KEY = secret,
+                                    level = level, host = host, port = port, secure = False)
+                run("workers %2d gzip level %d" % (workers, level), storage, n, workers, _gzipHeaders)
+                if _verbose():
+                    print storage.stats
+                if server is not None:
+                    server.objects.clear()
+    finally:
+        if server is not None:
+            server.stop()
+    print ""
+
+    return True
+
+###################################################
+
+def cmdAll():
+    """Run all the benchmarks"""
+
+    return cmdFolder() and cmdS3()
+
+###################################################
+
+def cmdHelp():
+    """Print usage help"""
+
+    print """
+usage: python -m ecommerce.storage.bench <command> [pages] [...] [-v]
+
+where command is one of:
+
+- folder [pages] --- FilesystemStorage in a temporary folder
+- s3 [pages] [host:port [bucket]] --- S3Storage against the local stand-in, or
+  the S3 compatible server at host:port (plain http, credentials from
+  AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY, objects are left there)
+- all [pages] --- both
+- help --- this screen
+
+pages defaults to %d, -v prints the storage stats of every run
+""" % defaultPages
+
+    return True
+
+###################################################
+
+commands = {
+    "folder":       cmdFolder,
+    "s3":           cmdS3,
+    "all":          cmdAll,
+    "help":         cmdHelp
+}
+
+def main():
+
+    # figure out the command (default is help)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "help"
+    if cmd not in commands:
+        cmd = "help"
+
+    # dispatch the command
+    commands[cmd]()
+
+
+if __name__ == "__main__":
+    main()
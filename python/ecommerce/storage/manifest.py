@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Upload manifest for the storage module
+
+A manifest is a local SQLite file remembering, for every object stored,
+the hash of its content (and headers), its stored size and etag. A storage
+with a manifest skips put/send when the object is unchanged, so a full
+regeneration only uploads what changed.
+
+The manifest only knows what went thru this storage object. If the remote
+objects change behind its back (or the manifest is lost), rebuild it from
+the remote listing with the reconcile command below: entries whose remote
+object is gone are dropped, remote objects the manifest did not know (or
+that changed) are recorded by etag (simple uncompressed uploads then match
+on their content, the others are stored once more).
+
+Set {{prefix}}.{{name}}.manifest to the manifest file path to turn it on.
+
+usage: python -m ecommerce.storage.manifest <command> <prefix> <name>   (see command help)
+"""
+
+import sys
+import time
+import hashlib
+import threading
+import sqlite3
+
+_schema = [
+    """CREATE TABLE IF NOT EXISTS objects (
+           name    TEXT PRIMARY KEY,
+           hash    TEXT NOT NULL,
+           meta    TEXT,
+           size    INTEGER NOT NULL,
+           etag    TEXT,
+           updated REAL NOT NULL
+       )""",
+]
+
+
+class Manifest(object):
+    """The manifest of the objects in a storage (safe to use from many threads)"""
+
+    def __init__(self, fname):
+
+        self._fname = fname
+        self._lock  = threading.Lock()
+
+        # losing the last writes only means storing those objects again
+        self._db = sqlite3.connect(fname, timeout = 30, isolation_level = None, check_same_thread = False)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = OFF")
+        for statement in _schema:
+            self._db.execute(statement)
+
+
+    def close(self):
+        """Close the manifest file"""
+
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+    def digest(self, src, headers = None):
+        """The (content hash, headers hash) of an object
+
+        src can be a string or a seekable file like object (read and put
+        back where it was).
+        """
+
+        meta = repr(sorted((headers or { }).items()))
+
+        content = hashlib.md5()
+        if hasattr(src, "read"):
+            start = src.tell()
+            for chunk in iter(lambda: src.read(256 * 1024), ""):
+                content.update(chunk)
+            src.seek(start)
+        elif isinstance(src, unicode):
+            content.update(src.encode("utf-8"))
+        else:
+            content.update(src)
+
+        return (content.hexdigest(), hashlib.md5(meta).hexdigest())
+
+
+    def unchanged(self, name, digest):
+        """True if the object was stored with the same content and headers"""
+
+        with self._lock:
+            row = self._db.execute("SELECT hash, meta FROM objects WHERE name = ?", (name, )).fetchone()
+
+        # objects added by reconcile have no headers hash, the content decides
+        return row is not None and row[0] == digest[0] and (row[1] is None or row[1] == digest[1])
+
+
+    def record(self, name, digest, size, etag = None):
+        """Remember a stored object"""
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO objects (name, hash, meta, size, etag, updated) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (name, digest[0], digest[1], size, etag, time.time()))
+
+
+    def forget(self, name):
+        """Forget an object (deleted, or changed by other means)"""
+
+        with self._lock:
+            self._db.execute("DELETE FROM objects WHERE name = ?", (name, ))
+
+
+    def count(self):
+        """Returns the (number of objects, total size) in the manifest"""
+
+        with self._lock:
+            (n, size) = self._db.execute("SELECT COUNT(*), SUM(size) FROM objects").fetchone()
+
+        return (n, size or 0)
+
+
+    def reconcile(self, listing):
+        """Rebuild the manifest from the remote listing
+
+        params:
+            listing:    iterable of (name, size, etag) of the remote objects
+
+        Returns the (kept, added, removed) entry counts.
+        """
+
+        kept  = 0
+        added = 0
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("CREATE TEMP TABLE IF NOT EXISTS remote (name TEXT PRIMARY KEY)")
+                self._db.execute("DELETE FROM remote")
+
+                now = time.time()
+                for (name, size, etag) in listing:
+                    self._db.execute("INSERT OR REPLACE INTO remote (name) VALUES (?)", (name, ))
+                    row = self._db.execute("SELECT size, etag FROM objects WHERE name = ?", (name, )).fetchone()
+                    if row is not None and row[0] == size and row[1] == etag:
+                        kept += 1
+                        continue
+
+                    # unknown (or changed remotely), the etag is the content md5 of simple uploads
+                    self._db.execute("INSERT OR REPLACE INTO objects (name, hash, meta, size, etag, updated) "
+                                     "VALUES (?, ?, NULL, ?, ?, ?)", (name, etag or "", size, etag, now))
+                    added += 1
+
+                # gone remotely
+                removed = self._db.execute("DELETE FROM objects WHERE name NOT IN (SELECT name FROM remote)").rowcount
+                self._db.execute("DELETE FROM remote")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+        return (kept, added, removed)
+
+
+###################################################
+
+def _storage():
+    """Open the storage in the command line (None if missing or without manifest)"""
+
+    if len(sys.argv) < 4:
+        print ""
+        print "Command requires the storages prefix and the storage name, use command help"
+        print ""
+        return None
+
+    import ecommerce.config
+    import ecommerce.storage
+
+    storage = ecommerce.storage.getStorage(ecommerce.config.getConfig(), sys.argv[2], sys.argv[3])
+    if storage.manifest is None:
+        print ""
+        print "Storage [%s.%s] has no manifest" % (sys.argv[2], sys.argv[3])
+        print ""
+        return None
+
+    return storage
+
+###################################################
+
+def cmdReconcile():
+    """Rebuild the manifest from the remote listing"""
+
+    storage = _storage()
+    if storage is None:
+        return False
+
+    (kept, added, removed) = storage.manifest.reconcile(storage._listing())
+    print "%d kept, %d added, %d removed" % (kept, added, removed)
+
+    return True
+
+###################################################
+
+def cmdShow():
+    """Print the manifest size"""
+
+    storage = _storage()
+    if storage is None:
+        return False
+
+    print "%d objects, %d bytes" % storage.manifest.count()
+
+    return True
+
+###################################################
+
+def cmdHelp():
+    """Print usage help"""
+
+    print """
+usage: python -m ecommerce.storage.manifest <command> <prefix> <name>
+
+where command is one of:
+
+- reconcile {prefix} {name} --- rebuild the manifest of the storage from the remote listing
+- show {prefix} {name} --- print the number of objects in the manifest
+- help --- this screen
+"""
+
+    return True
+
+###################################################
+
+commands = {
+    "reconcile":    cmdReconcile,
+    "show":         cmdShow,
+    "help":         cmdHelp
+}
+
+def main():
+
+    # figure out the command (default is help)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "help"
+    if cmd not in commands:
+        cmd = "help"
+
+    # dispatch the command
+    commands[cmd]()
+
+
+if __name__ == "__main__":
+    main()
+
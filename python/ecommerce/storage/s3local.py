@@ -0,0 +1,182 @@
+"""A local S3 stand-in for the storage module tests and benchmarks
+
+Just enough of the S3 REST API for S3Storage (path style buckets, any
+bucket exists, objects are kept in memory, no authentication):
+
+- HEAD, GET, PUT and DELETE of objects (and HEAD of buckets)
+- bucket listing (prefix only, in one page)
+- multipart uploads
+- multi-object delete
+
+Usage:
+
+    server = S3Server()
+    server.start()
+    storage = S3Storage("bucket", AWS_ACCESS_KEY_ID = "key", AWS_SECRET_ACCESS_KEY = "secret",
+                        host = "127.0.0.1", port = server.server_port, secure = False)
+    ...
+    server.stop()
+"""
+
+import re
+import itertools
+import threading
+
+from hashlib          import md5
+from urlparse         import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from BaseHTTPServer   import HTTPServer, BaseHTTPRequestHandler
+from SocketServer     import ThreadingMixIn
+
+
+class S3Server(ThreadingMixIn, HTTPServer):
+    """The S3 stand-in (listens on localhost, on a free port by default)"""
+
+    daemon_threads = True
+
+    def __init__(self, port = 0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _S3Handler)
+        self.objects  = { }         # path -> (headers, body)
+        self.uploads  = { }         # multipart upload id -> (path, headers, { part: body })
+        self.failPuts = 0           # the next PUTs fail with 400
+        self._ids     = itertools.count(1)
+
+
+    def start(self):
+        """Serve in a thread"""
+
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+    def stop(self):
+        """Stop serving"""
+
+        self.shutdown()
+        self.server_close()
+
+
+def _split(path):
+    """The (bucket, key) of a request path"""
+
+    parts = path.lstrip("/").split("/", 1)
+    return (parts[0], parts[1] if len(parts) > 1 else "")
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+    def reply(self, code, headers, body = ""):
+        self.send_response(code)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+    def stored(self):
+        """The request headers kept with the object"""
+
+        return dict([ (name, self.headers[name]) for name in ("Content-Type", "Content-Encoding", "Cache-Control")
+                                                 if name in self.headers ])
+
+
+    def do_HEAD(self):
+        path = urlparse(self.path).path
+        if _split(path)[1] == "":
+            self.reply(200, { })            # the bucket
+        elif path in self.server.objects:
+            self.reply(200, self.server.objects[path][0])
+        else:
+            self.reply(404, { })
+
+
+    def do_GET(self):
+        (path, query) = (urlparse(self.path).path, parse_qs(urlparse(self.path).query))
+        (bucket, key) = _split(path)
+
+        # the parts of a multipart upload
+        if "uploadId" in query:
+            parts = self.server.uploads[query["uploadId"][0]][2]
+            self.reply(200, { }, "<ListPartsResult><IsTruncated>false</IsTruncated>%s</ListPartsResult>" %
+                                 "".join([ '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag><Size>%d</Size></Part>' %
+                                           (n, md5(parts[n]).hexdigest(), len(parts[n])) for n in sorted(parts) ]))
+            return
+
+        # bucket listing
+        if key == "":
+            prefix = "/%s/%s" % (bucket, query.get("prefix", [ "" ])[0])
+            self.reply(200, { }, "<ListBucketResult><IsTruncated>false</IsTruncated>%s</ListBucketResult>" %
+                                 "".join([ "<Contents><Key>%s</Key><Size>%d</Size><ETag>%s</ETag></Contents>" %
+                                           (escape(_split(p)[1]), len(body), escape(headers["ETag"]))
+                                           for (p, (headers, body)) in sorted(self.server.objects.items())
+                                           if p.startswith(prefix) ]))
+            return
+
+        if path not in self.server.objects:
+            self.reply(404, { }, "<Error><Code>NoSuchKey</Code></Error>")
+            return
+        (headers, body) = self.server.objects[path]
+        self.reply(200, headers, body)
+
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.failPuts > 0:
+            self.server.failPuts -= 1
+            self.reply(400, { }, "<Error><Code>InvalidRequest</Code></Error>")
+            return
+
+        etag = '"%s"' % md5(body).hexdigest()
+        (path, query) = (urlparse(self.path).path, parse_qs(urlparse(self.path).query))
+        if "uploadId" in query:
+            self.server.uploads[query["uploadId"][0]][2][int(query["partNumber"][0])] = body
+        else:
+            headers = self.stored()
+            headers["ETag"] = etag
+            self.server.objects[path] = (headers, body)
+        self.reply(200, { "ETag": etag })
+
+
+    def do_DELETE(self):
+        (path, query) = (urlparse(self.path).path, parse_qs(urlparse(self.path).query))
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"][0], None)
+        else:
+            self.server.objects.pop(path, None)
+        self.reply(204, { })
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        (path, query) = (urlparse(self.path).path, urlparse(self.path).query)
+        (bucket, key) = _split(path)
+
+        # multi-object delete
+        if query == "delete":
+            for name in re.findall("<Key>(.*?)</Key>", body):
+                self.server.objects.pop("/%s/%s" % (bucket, name), None)
+            self.reply(200, { }, "<DeleteResult></DeleteResult>")
+            return
+
+        # multipart upload start
+        if query == "uploads":
+            id = str(self.server._ids.next())
+            self.server.uploads[id] = (path, self.stored(), { })
+            self.reply(200, { }, "<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>"
+                                 "<UploadId>%s</UploadId></InitiateMultipartUploadResult>" % (bucket, escape(key), id))
+            return
+
+        # multipart upload end
+        (path, headers, parts) = self.server.uploads.pop(parse_qs(query)["uploadId"][0])
+        data = "".join([ parts[n] for n in sorted(parts) ])
+        headers["ETag"] = '"%s-%d"' % (md5(data).hexdigest(), len(parts))
+        self.server.objects[path] = (headers, data)
+        self.reply(200, { }, "<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag>"
+                             "</CompleteMultipartUploadResult>" % (bucket, escape(key), headers["ETag"]))
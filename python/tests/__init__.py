@@ -3,4 +3,4 @@ by Alejo Sanchez, Jose Luis Campanello and Mariano Goldsman
 """
 
 # Exported names
-__all__ = [ "config", "db", "db_dataset", "db_dataset_code" ]
+__all__ = [ "config", "db", "db_dataset", "db_dataset_code", "queue" ]
@@ -1,9 +1,15 @@
-from ecommerce.config import Config, getConfig, defaultFolders, defaultFragmentList, ConfigLoaderFileSystem
+from ecommerce.config import Config, getConfig, getConfigFromString, defaultFolders, defaultFragmentList, ConfigLoaderFileSystem
+from ecommerce.config import keygen, agent
+from ecommerce.config.keychain import Keychain
+import ecommerce.config
+import ecommerce.config.snapshot
 from unittest         import TestCase
 from tempfile         import mkdtemp
 from shutil           import rmtree
-from os               import chmod, remove
+from os               import chmod, remove, listdir, getuid, utime
 from os.path          import join as os_path_join
+from threading        import Thread
+from time             import time
 import types
 
 #
@@ -166,3 +172,289 @@ class TestSequenceFunctions(TestCase):
         """Test fetch for a key syntax (keychain:{{keyname}}) that does not exist"""
         self.assertRaises(KeyError, self.getLocalConfig().keychain.fetch, "keychain:dumb-db")
 
+
+
+reload_conf = '''
+---
+top:
+  value:    <<VALUE>>
+keychain:
+  file:     missing-keychain.yaml
+  dirs:
+    - <<DIR>>
+'''
+
+class TestConfigReload(TestCase):
+
+    def writeConfig(self, value):
+        """Write the global fragment with the given value"""
+        f = open(os_path_join(self.tmp_dir, "global.yaml"), 'w')
+        f.write(reload_conf.replace("<<DIR>>", self.tmp_dir).replace("<<VALUE>>", value))
+        f.close()
+
+
+    def setUp(self):
+        """Create the config files and replace the cached config"""
+
+        self.tmp_dir = mkdtemp()
+        self.writeConfig("one")
+        open(os_path_join(self.tmp_dir, "local.yaml"), 'w').close()
+
+        # keep the current singleton and install ours
+        self.saved = (ecommerce.config._cachedConfig, ecommerce.config._cachedLoader)
+        ecommerce.config._cachedConfig = None
+        ecommerce.config.getConfig(ConfigLoaderFileSystem(self.tmp_dir))
+
+        # record notifications
+        self.notified = [ ]
+        ecommerce.config.subscribe(self.notified.append)
+
+
+    def tearDown(self):
+        """Restore the cached config and remove the temporary directory"""
+        ecommerce.config.unsubscribe(self.notified.append)
+        (ecommerce.config._cachedConfig, ecommerce.config._cachedLoader) = self.saved
+        rmtree(self.tmp_dir)
+
+
+    def test_reload_unchanged(self):
+        """Reload without changes keeps the same config and notifies nobody"""
+        config = ecommerce.config.getConfig()
+        self.assertIs(ecommerce.config.reloadConfig(), config)
+        self.assertEqual(self.notified, [ ])
+
+
+    def test_reload_changed(self):
+        """Reload after a fragment change swaps the config and notifies"""
+        self.writeConfig("a-longer-value")
+        config = ecommerce.config.reloadConfig()
+        self.assertEqual(ecommerce.config.getConfig().get("top.value"), "a-longer-value")
+        self.assertEqual(self.notified, [ config ])
+
+
+    def test_reload_error_keeps_config(self):
+        """A broken fragment does not replace the current config"""
+        config = ecommerce.config.getConfig()
+        self.writeConfig("[ broken")
+        self.assertRaises(Exception, ecommerce.config.reloadConfig)
+        self.assertIs(ecommerce.config.getConfig(), config)
+
+
+class TestConfigSnapshot(TestCase):
+
+    def writeConfig(self, value):
+        """Write the global fragment with the given value"""
+        f = open(os_path_join(self.tmp_dir, "global.yaml"), 'w')
+        f.write(reload_conf.replace("<<DIR>>", self.tmp_dir).replace("<<VALUE>>", value))
+        f.close()
+
+
+    def setUp(self):
+        """Create the config files and a private snapshot folder"""
+
+        self.tmp_dir = mkdtemp()
+        self.writeConfig("one")
+        open(os_path_join(self.tmp_dir, "local.yaml"), 'w').close()
+
+        self.saved = ecommerce.config.snapshot.snapshotFolder
+        ecommerce.config.snapshot.snapshotFolder = os_path_join(self.tmp_dir, "snapshots")
+
+
+    def tearDown(self):
+        """Restore the snapshot folder and remove the temporary directory"""
+        ecommerce.config.snapshot.snapshotFolder = self.saved
+        ecommerce.config.snapshot._parsed.clear()
+        rmtree(self.tmp_dir)
+
+
+    def test_snapshot_written(self):
+        """Loading a config leaves a snapshot that is used on the next load"""
+        Config(ConfigLoaderFileSystem(self.tmp_dir))
+        self.assertEqual(len(listdir(ecommerce.config.snapshot.snapshotFolder)), 1)
+
+        ecommerce.config.snapshot._parsed.clear()
+        self.assertEqual(Config(ConfigLoaderFileSystem(self.tmp_dir)).get("top.value"), "one")
+
+
+    def test_snapshot_stale(self):
+        """A changed fragment is parsed again"""
+        Config(ConfigLoaderFileSystem(self.tmp_dir))
+        self.writeConfig("a-longer-value")
+        ecommerce.config.snapshot._parsed.clear()
+        self.assertEqual(Config(ConfigLoaderFileSystem(self.tmp_dir)).get("top.value"), "a-longer-value")
+
+
+    def test_snapshot_same_tick(self):
+        """A same size change keeping the mtime is not hidden by the snapshot"""
+        fname = os_path_join(self.tmp_dir, "global.yaml")
+        now = time()
+        utime(fname, (now, now))
+        Config(ConfigLoaderFileSystem(self.tmp_dir))
+        self.writeConfig("two")
+        utime(fname, (now, now))
+        ecommerce.config.snapshot._parsed.clear()
+        self.assertEqual(Config(ConfigLoaderFileSystem(self.tmp_dir)).get("top.value"), "two")
+
+
+    def test_snapshot_copies(self):
+        """Each config gets its own copy of the parsed data"""
+        c1 = Config(ConfigLoaderFileSystem(self.tmp_dir))
+        c1.get("top")["value"] = "changed"
+        c2 = Config(ConfigLoaderFileSystem(self.tmp_dir))
+        self.assertEqual(c2.get("top.value"), "one")
+
+
+cipher_conf = '''
+---
+keychain:
+  file:     keychain.yaml
+  dirs:
+    - <<DIR>>
+  cipher:   <<CIPHER>>
+  agent:    false
+'''
+
+cipher_keychain = '''
+master-key:
+    data:           7255f551e088bf83e8b60c3ca7465a346ed98ab430ff51ff9c3e0a4e02f9b01478b35e028b8bc7749ad60d75964aca5127b30af298567a23f10fbe2edd58e8e6
+db:
+    data:
+        password:   <<CIPHERTEXT>>
+    algorithm:      3DES_CBC
+    key:            master-key
+'''
+
+master_key = "7255f551e088bf83e8b60c3ca7465a346ed98ab430ff51ff9c3e0a4e02f9b01478b35e028b8bc7749ad60d75964aca5127b30af298567a23f10fbe2edd58e8e6"
+
+class TestKeychainCipher(TestCase):
+
+    def setUp(self):
+        """Write a keychain encrypted by keygen"""
+
+        self.tmp_dir = mkdtemp()
+        f = open(os_path_join(self.tmp_dir, "keychain.yaml"), 'w')
+        f.write(cipher_keychain.replace("<<CIPHERTEXT>>",
+                                        keygen.fcn_3DES_CBC(True, master_key, "s3cr3t-password")))
+        f.close()
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        rmtree(self.tmp_dir)
+
+
+    def getKeychain(self, cipher):
+        """Return the keychain using the given cipher"""
+        return getConfigFromString(cipher_conf.replace("<<DIR>>", self.tmp_dir)
+                                              .replace("<<CIPHER>>", cipher)).keychain
+
+
+    def test_master_key_compatible(self):
+        """The master key derivation matches keygen"""
+        keygen._masterKey(master_key)
+        keychain = self.getKeychain("pydes")
+        keychain._ensureLoaded()
+        self.assertEqual(keychain._mkSeed, keygen._mkSeed)
+
+
+    def test_decrypt_pydes(self):
+        """Decrypt with pyDes"""
+        self.assertEqual(self.getKeychain("pydes").fetch("keychain:db:password"), "s3cr3t-password")
+
+
+    def test_decrypt_auto(self):
+        """Decrypt with the fastest available implementation"""
+        self.assertEqual(self.getKeychain("auto").fetch("keychain:db:password"), "s3cr3t-password")
+
+
+    def test_decrypt_cached(self):
+        """Decrypted keys are kept"""
+        keychain = self.getKeychain("auto")
+        keychain.fetch("keychain:db:password")
+        keychain._keychain["db"]["data"]["password"] = "00"
+        self.assertEqual(keychain.fetch("keychain:db:password"), "s3cr3t-password")
+
+
+agent_conf = '''
+---
+keychain:
+  file:     keychain.yaml
+  dirs:
+    - <<DIR>>
+  agent:    <<DIR>>/agent/agent.sock
+'''
+
+class TestKeychainAgent(TestCase):
+
+    def setUp(self):
+        """Write a keychain and start an agent serving it"""
+
+        self.tmp_dir = mkdtemp()
+        f = open(os_path_join(self.tmp_dir, "keychain.yaml"), 'w')
+        f.write(cipher_keychain.replace("<<CIPHERTEXT>>",
+                                        keygen.fcn_3DES_CBC(True, master_key, "s3cr3t-password")))
+        f.close()
+
+        self.config = getConfigFromString(agent_conf.replace("<<DIR>>", self.tmp_dir))
+        self.agent  = agent.KeychainAgent(self.config)
+        self.thread = Thread(target = self.agent.serve_forever)
+        self.thread.start()
+
+
+    def tearDown(self):
+        """Stop the agent and remove the temporary directory"""
+        self.stopAgent()
+        rmtree(self.tmp_dir)
+
+
+    def stopAgent(self):
+        """Stop the agent (if running)"""
+        if self.agent is not None:
+            self.agent.shutdown()
+            self.thread.join()
+            self.agent.server_close()
+            self.agent = None
+
+
+    def getKeychain(self):
+        """A keychain for the same config (not the agent's)"""
+        return Keychain(self.config)
+
+
+    def test_agent_fetch(self):
+        """Keys are fetched from the agent, the keychain is not loaded"""
+        keychain = self.getKeychain()
+        self.assertEqual(keychain.fetch("keychain:db:password"), "s3cr3t-password")
+        self.assertRaises(KeyError, keychain.fetch, "keychain:nokey:password")
+        self.assertEqual(keychain._keychain, None)
+
+
+    def test_agent_missing(self):
+        """Without an agent the keychain is loaded in-process"""
+        self.stopAgent()
+        keychain = self.getKeychain()
+        self.assertEqual(keychain.fetch("keychain:db:password"), "s3cr3t-password")
+        self.assertNotEqual(keychain._keychain, None)
+
+
+    def test_agent_not_private(self):
+        """Agents with a socket or a folder others can access are not used"""
+        chmod(self.agent._path, 0666)
+        keychain = self.getKeychain()
+        self.assertEqual(keychain.fetch("keychain:db:password"), "s3cr3t-password")
+        self.assertNotEqual(keychain._keychain, None)
+
+        chmod(self.agent._path, 0600)
+        chmod(os_path_join(self.tmp_dir, "agent"), 0755)
+        self.assertRaises(agent.AgentUnavailable, agent.fetch, self.agent._path,
+                          os_path_join(self.tmp_dir, "keychain.yaml"), "keychain:db:password")
+
+
+    def test_agent_peer_rejected(self):
+        """The agent does not serve other users"""
+        self.agent._uid = getuid() + 1
+        self.assertRaises(agent.AgentUnavailable, agent.fetch, self.agent._path,
+                          os_path_join(self.tmp_dir, "keychain.yaml"), "keychain:db:password")
+        keychain = self.getKeychain()
+        self.assertEqual(keychain.fetch("keychain:db:password"), "s3cr3t-password")
+        self.assertNotEqual(keychain._keychain, None)
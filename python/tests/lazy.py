@@ -0,0 +1,108 @@
+import ecommerce.config
+import ecommerce.db
+import threading
+import time
+from unittest         import TestCase
+
+# import the subsystems without touching the database
+_lazyInit = ecommerce.config.lazyInit
+ecommerce.config.lazyInit = True
+import tmklib.cache
+import tmklib.cache.cacheconf
+import tmklib.url
+import tmklib.url.tree
+ecommerce.config.lazyInit = _lazyInit
+
+#
+# Test configuration
+#
+lazy_conf = '''
+---
+paths:
+    cache:
+        name:   fscache
+keychain:
+    file:           "null"
+    dirs:
+        - /dev
+'''
+
+class TestLazyInitialization(TestCase):
+
+    def setUp(self):
+        """Keep the functions the tests replace"""
+
+        self.saved = [ (ecommerce.config, "getConfig"), (ecommerce.db, "getConnection"),
+                       (tmklib.url.tree, "_loadNodes"), (tmklib.url.tree, "_buildURLs") ]
+        self.saved = [ (module, name, getattr(module, name)) for (module, name) in self.saved ]
+
+        config = ecommerce.config.getConfigFromString(lazy_conf)
+        ecommerce.config.getConfig = lambda *args: config
+
+        tmklib.cache.cacheconf._initialized = False
+        tmklib.cache.cacheconf._connection  = None
+        tmklib.url.tree._initialized = False
+        tmklib.url.tree._tree  = None
+        tmklib.url.tree._nodes = None
+
+    def tearDown(self):
+        """Put back the replaced functions"""
+
+        for (module, name, value) in self.saved:
+            setattr(module, name, value)
+
+        # do not follow the reloads of the other tests
+        tmklib.cache._reloadable = False
+
+    def test_cache_connect_retried(self):
+        """A failed connect leaves the cache uninitialized, the next use retries"""
+
+        connections = [ ]
+        def getConnection(name):
+            connections.append(name)
+            if len(connections) == 1:
+                raise RuntimeError("database down")
+            return "connection"
+        ecommerce.db.getConnection = getConnection
+
+        self.assertRaises(RuntimeError, tmklib.cache.cacheconf._ensureInitialized)
+        self.assertFalse(tmklib.cache.cacheconf._initialized)
+        tmklib.cache.cacheconf._ensureInitialized()
+        self.assertEqual(tmklib.cache.cacheconf._connection, "connection")
+        tmklib.cache.cacheconf._ensureInitialized()
+        self.assertEqual(connections, [ "fscache", "fscache" ])
+
+    def test_tree_failure_retried(self):
+        """A failure while building the tree is retried on the next use"""
+
+        def loadNodes():
+            tmklib.url.tree._nodes = { }
+        failures = [ RuntimeError("query failed") ]
+        def buildURLs():
+            if failures:
+                raise failures.pop()
+        tmklib.url.tree._loadNodes = loadNodes
+        tmklib.url.tree._buildURLs = buildURLs
+
+        self.assertRaises(RuntimeError, tmklib.url.tree.baseTree, 1)
+        self.assertEqual(tmklib.url.tree.baseTree(1), { })
+
+    def test_tree_loaded_once(self):
+        """Callers arriving during the initialization wait for it"""
+
+        loads = [ ]
+        def loadNodes():
+            loads.append(1)
+            time.sleep(0.2)
+            tmklib.url.tree._nodes = { }
+        tmklib.url.tree._loadNodes = loadNodes
+        tmklib.url.tree._buildURLs = lambda: None
+
+        results = [ ]
+        threads = [ threading.Thread(target = lambda: results.append(tmklib.url.tree.baseTree(1)))
+                    for i in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual((len(loads), results), (1, [ { } ] * 4))
@@ -0,0 +1,605 @@
+import ecommerce.config
+import ecommerce.queue
+import ecommerce.queue.runner
+import json
+from unittest         import TestCase
+from tempfile         import mkdtemp
+from shutil           import rmtree
+from os               import listdir, rename, utime, walk, remove
+from os.path          import join as os_path_join, exists
+from threading        import Timer
+from time             import time, sleep
+from datetime         import datetime, timedelta
+
+#
+# Test configuration files
+#
+queue_conf = '''
+---
+queue:
+    type:           folder
+    folder:         <<DIR>>/queue
+keychain:
+    file:           "null"
+    dirs:
+        - /dev
+'''
+
+class TestQueueFolder(TestCase):
+
+    def setUp(self):
+        """Create a config object with a queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        self.config   = ecommerce.config.getConfigFromString(queue_conf.replace("<<DIR>>", self.tmp_dir))
+        self.producer = ecommerce.queue.queue(self.config, "queue", True)
+        self.consumer = ecommerce.queue.queue(self.config, "queue", False)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.consumer = None
+        self.producer = None
+        rmtree(self.tmp_dir)
+
+
+    def put(self, content, queue = None):
+        """Put an item in the queue (thru the producer by default)"""
+        queue = self.producer if queue is None else queue
+        item = queue.item()
+        item.content = content
+        return queue.ready(item)
+
+
+    def test_empty(self):
+        """A new queue is empty"""
+        self.assertTrue(self.consumer.isEmpty())
+        self.assertIsNone(self.consumer.next())
+
+
+    def test_order(self):
+        """Items come out in the order they were put"""
+        for i in range(5):
+            self.put("item %d" % i)
+        self.assertEqual([ self.consumer.next().content for i in range(5) ],
+                         [ "item %d" % i for i in range(5) ])
+        self.assertTrue(self.consumer.isEmpty())
+
+
+    def test_list(self):
+        """The consumer sees items put by producers"""
+        self.assertEqual(self.consumer.list(), [ ])
+        items = [ self.put("item %d" % i) for i in range(3) ]
+        self.assertEqual(self.consumer.list(), [ item.id + ".bin" for item in items ])
+
+
+    def test_stats_read_only(self):
+        """Items are counted as enqueued by the producer only, a read only queue creates nothing"""
+        for i in range(3):
+            self.put("item %d" % i)
+        self.consumer.next()
+        self.consumer.publish(True)
+        self.producer.publish(True)
+        reader = ecommerce.queue.queue(self.config, "queue", True, True)
+        stats = reader.stats()
+        self.assertEqual((stats["pending"], stats["enqueued"]), (2, 3))
+        self.assertEqual([ m["counts"]["enqueued"] for m in stats["producers"] ], [ 3 ])
+        self.assertEqual([ m["counts"]["dequeued"] for m in stats["consumers"] ], [ 1 ])
+        self.assertRaises(ecommerce.queue.QueueRuntimeException, reader.ready, reader.item())
+
+        # gone producers leave their last metrics, until they expire
+        self.put("item 3")
+        self.producer = None
+        stats = reader.stats()
+        self.assertEqual((stats["enqueued"], [ m["stale"] for m in stats["producers"] ]), (4, [ False ]))
+        stats_dir = os_path_join(self.tmp_dir, "queue", "stats")
+        for fname in listdir(stats_dir):
+            metrics = json.load(open(os_path_join(stats_dir, fname)))
+            metrics["updated"] -= 7200
+            json.dump(metrics, open(os_path_join(stats_dir, fname), "w"))
+        self.assertEqual((reader.stats()["enqueued"], reader.stats()["consumers"]), (0, [ ]))
+
+        missing = ecommerce.config.getConfigFromString(queue_conf.replace("<<DIR>>", self.tmp_dir + "/missing"))
+        self.assertRaises(ecommerce.queue.QueueRuntimeException, ecommerce.queue.queue, missing, "queue", True, True)
+        self.assertFalse(exists(os_path_join(self.tmp_dir, "missing")))
+
+
+    def test_interleaved(self):
+        """Items put after the index was built are seen"""
+        self.put("first")
+        self.assertEqual(self.consumer.next().content, "first")
+        self.put("second")
+        self.put("third", self.consumer)
+        self.assertEqual(self.consumer.next().content, "second")
+        self.assertEqual(self.consumer.next().content, "third")
+
+
+    def test_same_tick(self):
+        """Items put in the same mtime tick as the last listing are seen"""
+        folder = os_path_join(self.tmp_dir, "queue")
+        tick = time() - 0.01
+        utime(folder, (tick, tick))
+        self.assertIsNone(self.consumer.next())
+        self.put("same tick")
+        utime(folder, (tick, tick))
+        self.assertEqual(self.consumer.next().content, "same tick")
+
+
+    def test_creation_date(self):
+        """Items keep the date they were put, not the date they were taken"""
+        self.put("job")
+        put = datetime.now()
+        sleep(0.3)
+        self.assertTrue(self.consumer.next().creationDate <= put)
+
+
+    def test_done(self):
+        """Done items leave the work folder"""
+        self.put("job")
+        item = self.consumer.next()
+        self.assertEqual(len(listdir(os_path_join(self.tmp_dir, "queue", "work"))), 1)
+        self.consumer.done(item)
+        self.assertEqual(listdir(os_path_join(self.tmp_dir, "queue", "work")), [ ])
+        self.assertEqual(item.status, "done")
+
+
+    def test_error(self):
+        """Items in error go to the error folder"""
+        self.put("job")
+        item = self.consumer.error(self.consumer.next())
+        self.assertEqual(item.status, "error")
+        self.assertEqual(len(listdir(os_path_join(self.tmp_dir, "queue", "err"))), 1)
+
+
+    def test_batch(self):
+        """Items can be put, taken and marked done in batches"""
+        items = [ self.producer.item() for i in range(5) ]
+        for i in range(5):
+            items[i].content = "item %d" % i
+        self.producer.readyBatch(items)
+
+        batch = self.consumer.nextBatch(3)
+        self.assertEqual([ item.content for item in batch ], [ "item 0", "item 1", "item 2" ])
+        self.consumer.doneBatch(batch)
+        self.assertEqual([ item.status for item in batch ], [ "done" ] * 3)
+
+        batch = self.consumer.nextBatch(10)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(self.consumer.nextBatch(10, True, 0.1), [ ])
+
+
+    def test_blocking(self):
+        """A blocking next waits for the next item (or the timeout)"""
+        start = time()
+        self.assertIsNone(self.consumer.next(True, 0.2))
+        self.assertTrue(time() - start >= 0.2)
+
+        timer = Timer(0.1, self.put, [ "late" ])
+        timer.start()
+        item = self.consumer.next(True, 5)
+        timer.join()
+        self.assertEqual(item.content, "late")
+
+
+class TestQueueFolderItemLocking(TestCase):
+
+    def setUp(self):
+        """Create a config object with an item locking queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        conf = queue_conf.replace("/queue\n", "/queue\n    locking:        item\n")
+        conf = conf.replace("<<DIR>>", self.tmp_dir)
+        self.config   = ecommerce.config.getConfigFromString(conf)
+        self.producer = ecommerce.queue.queue(self.config, "queue", True)
+        for i in range(10):
+            item = self.producer.item()
+            item.content = "item %d" % i
+            self.producer.ready(item)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.producer = None
+        rmtree(self.tmp_dir)
+
+
+    def test_consumers(self):
+        """Many consumers can drain the queue, each item is taken once"""
+        consumers = [ ecommerce.queue.queue(self.config, "queue", False) for i in range(3) ]
+        taken = [ ]
+        while True:
+            items = [ c.next() for c in consumers ]
+            items = [ item for item in items if item is not None ]
+            if len(items) == 0:
+                break
+            self.assertTrue(all([ item.locked for item in items ]))
+            taken.extend([ item.content for item in items ])
+        self.assertEqual(sorted(taken), sorted([ "item %d" % i for i in range(10) ]))
+
+
+    def test_blocking_race(self):
+        """A blocking next keeps waiting if other consumers took the items it saw"""
+        (first, second) = [ ecommerce.queue.queue(self.config, "queue", False) for i in range(2) ]
+        late = self.producer.item()
+        late.content = "late"
+        timer = Timer(0.2, self.producer.ready, [ late ])
+
+        pop = first._pop
+        def racing():
+            # the other consumer takes everything just before the claim
+            if first._pop == racing:
+                first._pop = pop
+                self.assertEqual(len(second.nextBatch(10)), 10)
+                timer.start()
+            return pop()
+        first._pop = racing
+        item = first.next(True, 5)
+        timer.join()
+        self.assertIsNotNone(item)
+        self.assertEqual(item.content, "late")
+
+
+    def test_unlock(self):
+        """Unlocked items go back to the queue"""
+        consumer = ecommerce.queue.queue(self.config, "queue", False)
+        item = consumer.next()
+        consumer.unlock(item)
+        self.assertEqual(consumer.next().content, item.content)
+
+
+    def test_recover(self):
+        """Items of dead consumers are put back in the queue"""
+        consumer = ecommerce.queue.queue(self.config, "queue", False)
+        items = consumer.nextBatch(3)
+        work = consumer._workFolder
+        self.assertEqual(len(listdir(work)), 3)
+
+        # a dead consumer on another host, lease expired
+        dead = os_path_join(self.tmp_dir, "queue", "work", "otherhost-1-00000000")
+        rename(work, dead)
+        utime(dead, (0, 0))
+        consumer = None
+
+        other = ecommerce.queue.queue(self.config, "queue", False)
+        self.assertFalse(exists(dead))
+        self.assertEqual([ item.content for item in other.nextBatch(10) ],
+                         [ "item %d" % i for i in range(10) ])
+
+
+def _handler(item):
+    """Runner test handler: fails on "bad" items, sleeps on "slow" items"""
+    if item.content == "bad":
+        raise ValueError("bad item")
+    if item.content == "slow":
+        sleep(1)
+
+
+class TestQueueRunner(TestCase):
+
+    def setUp(self):
+        """Create a config object with a queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        self.config   = ecommerce.config.getConfigFromString(queue_conf.replace("<<DIR>>", self.tmp_dir))
+        self.consumer = ecommerce.queue.queue(self.config, "queue", False)
+        items = [ self.consumer.item() for i in range(20) ]
+        for i in range(20):
+            items[i].content = "bad" if i % 5 == 0 else "item %d" % i
+        self.consumer.readyBatch(items)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.consumer = None
+        rmtree(self.tmp_dir)
+
+
+    def errors(self):
+        """Number of items in the error folder"""
+        err = os_path_join(self.tmp_dir, "queue", "err")
+        return sum([ len(files) for (path, dirs, files) in walk(err) ])
+
+
+    def test_threads(self):
+        """All items are done or in error"""
+        runner = ecommerce.queue.Runner(self.consumer, _handler, workers = 4, prefetch = 3)
+        self.assertEqual(runner.run(True), 16)
+        self.assertEqual(runner.errors, 4)
+        self.assertEqual(self.errors(), 4)
+        self.assertTrue(self.consumer.isEmpty())
+
+
+    def test_processes(self):
+        """Process pools work the same"""
+        runner = ecommerce.queue.Runner(self.consumer, _handler, workers = 2, pool = "process")
+        self.assertEqual(runner.run(True), 16)
+        self.assertEqual(self.errors(), 4)
+
+
+    def test_timeout(self):
+        """Items taking too long are in error"""
+        item = self.consumer.item()
+        item.content = "slow"
+        self.consumer.ready(item)
+        runner = ecommerce.queue.Runner(self.consumer, _handler, workers = 2, timeout = 0.2)
+        self.assertEqual(runner.run(True), 16)
+        self.assertEqual(runner.timeouts, 1)
+        self.assertEqual(self.errors(), 5)
+
+
+    def test_stats(self):
+        """The counts and the published consumer metrics are reported"""
+        stats = self.consumer.stats()
+        self.assertEqual((stats["type"], stats["pending"], stats["work"], stats["error"]), ("QueueFolder", 20, 0, 0))
+        self.assertTrue(stats["oldest"] >= 0)
+
+        ecommerce.queue.Runner(self.consumer, _handler, workers = 2).run(True)
+        self.consumer.publish(True)
+        stats = self.consumer.stats()
+        self.assertEqual((stats["pending"], stats["oldest"], stats["error"]), (0, None, 4))
+        self.assertEqual((len(stats["consumers"]), stats["enqueued"]), (1, 20))
+        metrics = stats["consumers"][0]
+        self.assertEqual((metrics["counts"]["dequeued"], metrics["counts"]["done"], metrics["counts"]["errors"]),
+                         (20, 16, 4))
+        self.assertEqual(sum(metrics["histogram"]), 20)
+
+
+class TestQueueFolderPriority(TestCase):
+
+    def setUp(self):
+        """Create a config object with a queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        self.config   = ecommerce.config.getConfigFromString(queue_conf.replace("<<DIR>>", self.tmp_dir))
+        self.producer = ecommerce.queue.queue(self.config, "queue", True)
+        self.consumer = ecommerce.queue.queue(self.config, "queue", False)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.consumer = None
+        self.producer = None
+        rmtree(self.tmp_dir)
+
+
+    def put(self, content, priority = None, notBefore = None):
+        """Put an item in the queue"""
+        item = self.producer.item()
+        item.content   = content
+        item.priority  = priority
+        item.notBefore = notBefore
+        return self.producer.ready(item)
+
+
+    def test_priority(self):
+        """Urgent items come out first, same priority items in order"""
+        self.put("normal 1")
+        self.put("low", 9)
+        self.put("normal 2", 5)
+        self.put("urgent", 0)
+        items = [ self.consumer.next() for i in range(4) ]
+        self.assertEqual([ item.content for item in items ], [ "urgent", "normal 1", "normal 2", "low" ])
+        self.assertEqual([ item.priority for item in items ], [ 0, 5, 5, 9 ])
+        self.assertRaises(ValueError, setattr, self.producer.item(), "priority", 10)
+
+
+    def test_delayed(self):
+        """Delayed items are not taken before they are due"""
+        self.put("later", 0, datetime.now() + timedelta(seconds = 0.3))
+        self.put("now")
+        self.assertEqual(self.consumer.next().content, "now")
+        self.assertIsNone(self.consumer.next())
+        self.assertTrue(self.consumer.isEmpty())
+        self.assertEqual(self.consumer.next(True, 5).content, "later")
+
+
+class TestQueueFolderCoalesce(TestCase):
+
+    def setUp(self):
+        """Create a config object with a queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        self.config   = ecommerce.config.getConfigFromString(queue_conf.replace("<<DIR>>", self.tmp_dir))
+        self.producer = ecommerce.queue.queue(self.config, "queue", True)
+        self.consumer = ecommerce.queue.queue(self.config, "queue", False)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.consumer = None
+        self.producer = None
+        rmtree(self.tmp_dir)
+
+
+    def put(self, content, key, priority = None, notBefore = None):
+        """Put an item with a key in the queue"""
+        item = self.producer.item()
+        item.content   = content
+        item.key       = key
+        item.priority  = priority
+        item.notBefore = notBefore
+        return self.producer.ready(item)
+
+
+    def test_coalesce(self):
+        """Items with the same key as a pending item are dropped"""
+        first = self.put("PROD 1234", "PROD/1234")
+        self.assertEqual(self.put("PROD 1234 again", "PROD/1234").status, "coalesced")
+        self.put("PROD 99", "PROD/99")
+        self.assertEqual(self.put("PROD 1234 and again", "PROD/1234").id, first.id)
+        self.assertEqual(self.producer.coalesced, 2)
+
+        item = self.consumer.next()
+        self.assertEqual((item.content, item.coalesced), ("PROD 1234", 2))
+
+        # taken => queued again
+        self.assertEqual(self.put("PROD 1234 later", "PROD/1234").status, "ready")
+        self.assertEqual([ i.content for i in self.consumer.nextBatch(5) ], [ "PROD 99", "PROD 1234 later" ])
+
+
+    def test_urgent(self):
+        """A more urgent item with the same key moves the pending one"""
+        self.put("PROD 1234", "PROD/1234", 9)
+        self.put("PROD 99", "PROD/99")
+        self.assertEqual(self.put("PROD 1234 now", "PROD/1234", 0).status, "coalesced")
+        self.put("SUBJ 1", "SUBJ/1", 0, datetime.now() + timedelta(hours = 1))
+        self.assertEqual(self.put("SUBJ 1 now", "SUBJ/1", 7).status, "coalesced")
+
+        items = self.consumer.nextBatch(5)
+        self.assertEqual([ (item.content, item.priority, item.coalesced) for item in items ],
+                         [ ("PROD 1234", 0, 1), ("SUBJ 1", 0, 1), ("PROD 99", 5, 0) ])
+        self.assertEqual(listdir(os_path_join(self.tmp_dir, "queue", "keys")), [ ])
+
+
+    def test_stale(self):
+        """Markers of items removed by hand are ignored"""
+        item = self.put("PROD 1234", "PROD/1234")
+        remove(os_path_join(self.tmp_dir, "queue", item.id + ".bin"))
+        self.assertEqual(self.put("PROD 1234 again", "PROD/1234").status, "ready")
+
+
+class TestQueueFolderSegments(TestCase):
+
+    def setUp(self):
+        """Create a config object with a segment queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        conf = queue_conf.replace("/queue\n", "/queue\n    segments:       true\n    durability:     fsync\n")
+        self.config   = ecommerce.config.getConfigFromString(conf.replace("<<DIR>>", self.tmp_dir))
+        self.producer = ecommerce.queue.queue(self.config, "queue", True)
+        self.consumer = ecommerce.queue.queue(self.config, "queue", False)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.consumer = None
+        self.producer = None
+        rmtree(self.tmp_dir)
+
+
+    def test_segment(self):
+        """Plain items of a batch go in a single file, handed out one by one"""
+        items = [ self.producer.item() for i in range(11) ]
+        for i in range(11):
+            items[i].content = "item %d" % i
+        items[10].priority = 0
+        self.producer.readyBatch(items)
+        self.assertEqual(len(self.consumer.list()), 2)
+
+        self.assertEqual(self.consumer.next().content, "item 10")
+        taken = [ self.consumer.next() for i in range(10) ]
+        self.assertEqual([ item.content for item in taken ], [ "item %d" % i for i in range(10) ])
+        self.assertTrue(self.consumer.isEmpty())
+
+        # the segment goes away when all its items are finished
+        work = os_path_join(self.tmp_dir, "queue", "work")
+        self.consumer.doneBatch(taken[:9])
+        self.assertEqual(len(listdir(work)), 2)
+        self.consumer.error(taken[9])
+        self.assertEqual(len(listdir(work)), 1)
+        self.assertEqual((self.consumer.stats()["error"], taken[9].content), (1, "item 9"))
+
+
+class TestQueueSqlite(TestCase):
+
+    def setUp(self):
+        """Create a config object with a sqlite queue in a temp dir"""
+
+        self.tmp_dir  = mkdtemp()
+        conf = queue_conf.replace("folder", "sqlite", 1).replace("folder:         <<DIR>>/queue",
+                                                                 "file:           <<DIR>>/queue.db")
+        self.config   = ecommerce.config.getConfigFromString(conf.replace("<<DIR>>", self.tmp_dir))
+        self.producer = ecommerce.queue.queue(self.config, "queue", True)
+        self.consumer = ecommerce.queue.queue(self.config, "queue", False)
+
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.consumer = None
+        self.producer = None
+        rmtree(self.tmp_dir)
+
+
+    def put(self, content, priority = None, key = None):
+        """Put an item in the queue"""
+        item = self.producer.item()
+        item.content  = content
+        item.priority = priority
+        item.key      = key
+        return self.producer.ready(item)
+
+
+    def test_order(self):
+        """Items come out by priority, then in the order they were put"""
+        self.assertIsNone(self.consumer.next())
+        for i in range(5):
+            self.put("item %d" % i)
+        self.put("urgent", 0)
+        self.assertEqual([ item.content for item in self.consumer.nextBatch(10) ],
+                         [ "urgent" ] + [ "item %d" % i for i in range(5) ])
+        self.assertTrue(self.consumer.isEmpty())
+
+
+    def test_claim(self):
+        """Items are taken once, done, in error or back to the queue"""
+        for i in range(4):
+            self.put("item %d" % i)
+        other = ecommerce.queue.queue(self.config, "queue", False)
+        (a, b) = (self.consumer.nextBatch(2), other.nextBatch(2))
+        self.assertEqual([ item.content for item in a + b ], [ "item %d" % i for i in range(4) ])
+
+        self.consumer.doneBatch(a)
+        other.error(b[0])
+        other.unlock(b[1])
+        self.assertEqual(self.consumer.count("error"), 1)
+        self.assertEqual(self.consumer.next().content, "item 3")
+
+        # expired leases give the items back
+        self.put("item 4")
+        other._lease = -1
+        self.assertEqual(other.next().content, "item 4")
+        self.assertEqual(self.consumer.count("ready"), 0)
+        self.consumer._recover()
+        self.assertEqual(self.consumer.count("ready"), 1)
+
+
+    def test_coalesce(self):
+        """Items with the same key as a pending item are dropped"""
+        first = self.put("PROD 1234", key = "PROD/1234")
+        self.assertEqual(self.put("again", key = "PROD/1234").status, "coalesced")
+        item = self.consumer.next(True, 1)
+        self.assertEqual((item.id, item.coalesced), (first.id, 1))
+        self.assertEqual(self.put("later", key = "PROD/1234").status, "ready")
+
+        # items put back are coalesced into the pending one
+        self.consumer.unlock(item)
+        self.assertEqual(self.consumer.coalesced, 1)
+        item = self.consumer.next()
+        self.assertEqual((item.content, item.coalesced), ("later", 2))
+
+
+    def test_coalesce_urgent(self):
+        """A more urgent item with the same key makes the pending one urgent"""
+        self.put("PROD 1234", 9, "PROD/1234")
+        self.put("PROD 99")
+        self.assertEqual(self.put("PROD 1234 now", 0, "PROD/1234").status, "coalesced")
+        self.assertEqual([ (item.content, item.priority) for item in self.consumer.nextBatch(5) ],
+                         [ ("PROD 1234", 0), ("PROD 99", 5) ])
+
+
+    def test_stats(self):
+        """The counts and the published consumer metrics are reported"""
+        self.put("item 1")
+        self.put("item 2")
+        self.consumer.done(self.consumer.next())
+        self.consumer.publish(True)
+        self.producer.publish(True)
+        stats = ecommerce.queue.queue(self.config, "queue", True, True).stats()
+        self.assertEqual((stats["pending"], stats["work"], stats["done"]), (1, 0, None))
+        self.assertEqual([ c["counts"]["done"] for c in stats["consumers"] ], [ 1 ])
+        self.assertEqual([ p["counts"]["enqueued"] for p in stats["producers"] ], [ 2 ])
+
+        # a gone producer leaves its last metrics
+        self.put("item 3")
+        self.producer = None
+        self.assertEqual(ecommerce.queue.queue(self.config, "queue", True, True).stats()["enqueued"], 3)
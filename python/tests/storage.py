@@ -1,9 +1,15 @@
-from ecommerce.storage  import FilesystemStorage, S3Storage
+import ecommerce.config
+from ecommerce.storage  import getStorage, BaseStorage, FilesystemStorage, S3Storage, CachingStorage, ReplicatedStorage, Manifest
+from ecommerce.storage.s3local import S3Server
 from unittest           import TestCase
 from tempfile           import mkdtemp
 from shutil             import rmtree
-from os                 import chmod, remove
+from os                 import chmod, remove, walk
 from os.path            import join as os_path_join
+from hashlib            import md5
+from gzip               import GzipFile
+from StringIO           import StringIO
+from time               import sleep
 
 
 bucket_name = 'tmk-a'
@@ -15,6 +21,42 @@ headers  = {
     'Cache-Control': 'max-age=3600, must-revalidate'
 }
 
+cached_conf = '''
+---
+storages:
+    web:
+        type:           cached
+        backend:        s3
+        bucket:         tmk-a
+        cache:          public,max-age=60
+        cache-dir:      <<DIR>>
+        access-key:     key
+        secret-key:     secret
+        host:           127.0.0.1
+        port:           <<PORT>>
+        secure:         false
+keychain:
+    file:           "null"
+    dirs:
+        - /dev
+'''
+
+class _BrokenPipe(object):
+    '''A stream that can't seek and fails after the first read'''
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size = -1):
+        if self.data is None:
+            raise IOError('broken pipe')
+        (data, self.data) = (self.data[:4], None)
+        return data
+
+    def tell(self):
+        raise IOError('illegal seek')
+
+
 class TestStorageModule(TestCase):
 
     def getFilesystemStorage(self):
@@ -60,3 +102,290 @@ class TestStorageModule(TestCase):
         s.send(page_name, page_data, headers)
         self.assertEqual(page_data, s.get(page_name))
 
+    def testPutManyFilesystemStorage(self):
+        '''Objects are stored in parallel, failures are reported'''
+        s = self.getFilesystemStorage()
+        s.put('blocker', page_data)
+        objects = [ ('page%d.html' % i, page_data, headers) for i in range(50) ]
+        objects.append(('blocker/page.html', page_data, headers))
+        seen = [ ]
+        report = s.putMany(iter(objects), workers = 4, backoff = 0,
+                           progress = lambda r, name, err: seen.append(name))
+        self.assertEqual((report.stored, report.retries), (50, 3))
+        self.assertEqual([ name for (name, err) in report.failed ], [ 'blocker/page.html' ])
+        self.assertEqual(len(seen), 51)
+        self.assertEqual(s.get('page49.html'), page_data)
+
+    def testPutManyStreamsFilesystemStorage(self):
+        '''Streams that fail are reported, never retried from where they stopped'''
+        s = self.getFilesystemStorage()
+        closed = StringIO(page_data)
+        closed.close()
+        report = s.putMany([ ('closed%d.html' % i, closed, headers) for i in range(5) ] +
+                           [ ('pipe.html', _BrokenPipe('0123456789'), headers), ('page.html', page_data, headers) ],
+                           workers = 1, backoff = 0, progress = lambda r, name, err: 1 / 0)
+        self.assertEqual((report.stored, report.retries), (1, 0))
+        self.assertEqual([ name for (name, err) in report.failed ], [ 'closed%d.html' % i for i in range(5) ] + [ 'pipe.html' ])
+        self.assertEqual((s.stat('pipe.html'), s.get('page.html')), (None, page_data))
+
+    def testAtomicFilesystemStorage(self):
+        '''Objects are written thru temporary files, directories are created once'''
+        s = self.getFilesystemStorage()
+        objects = [ ('dir%d/sub/page%d.html' % (i % 3, i), page_data, headers) for i in range(30) ]
+        self.assertTrue(s.putMany(objects, workers = 4).ok)
+        s.copy('dir0/copy.html', 'dir0/sub/page0.html')
+        s.put('dir0/copy.html', 'new data')
+        self.assertEqual(s.get('dir0/copy.html'), 'new data')
+        self.assertEqual(len(s._dirs), 4)
+        self.assertEqual([ f for (path, dirs, files) in walk(self.tmp_dir) for f in files if f.endswith('.tmp') ], [ ])
+        self.assertEqual(len(list(s._listing())), 31)
+
+    def testCopyFilesystemStorage(self):
+        '''Copies (data, links or clones) are independent of the source'''
+        for mode in ('copy', 'link', 'reflink'):
+            s = FilesystemStorage(self.tmp_dir, mode)
+            s.put('cover.jpg', page_data * 1000)
+            s.copy('covers/%s.jpg' % mode, 'cover.jpg')
+            s.put('cover.jpg', 'new cover')
+            self.assertEqual(s.get('covers/%s.jpg' % mode), page_data * 1000)
+            self.assertEqual(s.getMap('covers/%s.jpg' % mode)[:len(page_data)], page_data)
+        self.assertRaises(ValueError, FilesystemStorage, self.tmp_dir, 'move')
+
+    def testCachingStorage(self):
+        '''Reads are served from memory or the cache folder until revalidated'''
+        s = self.getFilesystemStorage()
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        c = CachingStorage(s, cache_dir, max_size = 10000, memory_object = 100, revalidate = 60)
+        c.put('small.html', page_data)
+        s.put('big.html', 'x' * 1000)
+        self.assertEqual(c.get('small.html'), page_data)
+        self.assertEqual(c.get('small.html'), page_data)
+        self.assertEqual(c.get('big.html'), 'x' * 1000)
+        self.assertEqual(c.get('big.html'), 'x' * 1000)
+        self.assertEqual((c.misses, c.diskHits, c.hits), (2, 1, 1))
+
+        # changed in the backend: seen once revalidated
+        s.put('big.html', 'y' * 1000)
+        self.assertEqual(c.get('big.html'), 'x' * 1000)
+        c._revalidate = 0
+        self.assertEqual(c.get('big.html'), 'y' * 1000)
+        self.assertEqual(c.getStream('small.html').read(), page_data)
+
+        # the cache folder stays under its size
+        for i in range(30):
+            s.put('page%d.html' % i, 'z' * 1000)
+            c.get('page%d.html' % i)
+        self.assertTrue(sum([ len(open(os_path_join(path, f)).read())
+                              for (path, dirs, files) in walk(cache_dir) for f in files ]) <= 11000)
+        c.delete('small.html')
+        self.assertRaises(IOError, c.get, 'small.html')
+        self.assertEqual([ c.stats.ops[op]['count'] for op in ('delete', 'getStream') ], [ 1, 1 ])
+
+    def testListDeleteFilesystemStorage(self):
+        '''Objects are listed by prefix and deleted in parallel'''
+        s = self.getFilesystemStorage()
+        for i in range(20):
+            s.put('products/%d/page.html' % i, page_data)
+        s.put('products.html', page_data)
+        self.assertEqual(len(list(s.list())), 21)
+        self.assertEqual(list(s.list('products/1/')), [ 'products/1/page.html' ])
+        self.assertEqual(len(list(s.list('products/1'))), 11)
+        gone = [ 'products/%d/page.html' % i for i in range(10) ] + [ 'missing.html' ]
+        self.assertEqual(s.deleteMany(gone), [ ])
+        self.assertEqual(len(list(s.list('products/'))), 10)
+
+        # the generic one deletes without looking first
+        s.stat = lambda name: self.fail('stat called for %s' % name)
+        gone = [ 'products/%d/page.html' % i for i in range(10, 15) ] + [ 'missing.html' ]
+        self.assertEqual(BaseStorage.deleteMany(s, gone), [ ])
+        self.assertEqual(len(list(s.list('products/'))), 5)
+        self.assertEqual([ name for (name, error) in BaseStorage.deleteMany(s, [ 'products/15' ]) ],
+                         [ 'products/15' ])
+
+    def testReplicatedStorage(self):
+        '''Objects are written to every backend, failures are reported'''
+        other_dir = mkdtemp()
+        self.addCleanup(rmtree, other_dir)
+        primary = self.getFilesystemStorage()
+        other   = FilesystemStorage(other_dir)
+        other.put('blocker', page_data)
+        r = ReplicatedStorage([ ('primary', primary), ('other', other) ], backoff = 0)
+        r.put(page_name, page_data, headers)
+        report = r.putMany([ ('page%d.html' % i, StringIO(page_data), headers) for i in range(20) ] +
+                           [ ('blocker/page.html', page_data, headers) ])
+        self.assertEqual((report.backends['primary'].stored, report.backends['other'].stored), (22, 21))
+        self.assertEqual(report.inconsistent, [ 'blocker/page.html' ])
+        self.assertFalse(report.ok)
+        self.assertEqual((r.get('page19.html'), other.get('page19.html')), (page_data, page_data))
+        r.delete(page_name)
+        self.assertEqual((primary.stat(page_name), other.stat(page_name)), (None, None))
+        self.assertTrue(r.flush().ok)
+        self.assertEqual([ r.stats.ops[op]['count'] for op in ('send', 'putMany', 'get', 'delete') ], [ 1, 1, 1, 1 ])
+
+    def testReplicatedStorageOrder(self):
+        '''Deletes happen after the puts queued before, close stops the threads'''
+        other_dir = mkdtemp()
+        self.addCleanup(rmtree, other_dir)
+        primary = self.getFilesystemStorage()
+        other   = FilesystemStorage(other_dir)
+        putRetry = other._putRetry
+        def slowPutRetry(*args):
+            sleep(0.2)
+            return putRetry(*args)
+        other._putRetry = slowPutRetry
+        r = ReplicatedStorage([ ('primary', primary), ('other', other) ], backoff = 0)
+        r.put(page_name, page_data, headers)
+        r.delete(page_name)
+        r.put('other.html', page_data, headers)
+        r.deleteMany([ 'other.html' ])
+        self.assertTrue(r.flush().ok)
+        self.assertEqual([ (s.stat(page_name), s.stat('other.html')) for s in (primary, other) ],
+                         [ (None, None), (None, None) ])
+
+        threads = [ thread for replica in r._replicas for thread in replica.threads ]
+        r.put(page_name, page_data, headers)
+        self.assertEqual(r.close().backends['other'].stored, 1)
+        self.assertFalse([ thread for thread in threads if thread.is_alive() ])
+        self.assertEqual(other.get(page_name), page_data)
+        self.assertRaises(ValueError, r.put, page_name, page_data, headers)
+
+    def testVariantsFilesystemStorage(self):
+        '''Compressible objects get a gzip variant next to them'''
+        s = FilesystemStorage(self.tmp_dir, variants = [ 'gzip' ], compressors = 2)
+        objects = [ ('page%d.html' % i, page_data, headers) for i in range(10) ]
+        objects.append(('cover.jpg', 'JPEG', { 'Content-Type': 'image/jpeg' }))
+        self.assertEqual(s.putMany(objects).stored, 11)
+        s.put('sitemap.xml', StringIO(page_data))
+        for name in ('page9.html', 'sitemap.xml'):
+            self.assertEqual(GzipFile(fileobj = StringIO(s.get(name + '.gz'))).read(), page_data)
+        self.assertEqual(s.stat('cover.jpg.gz'), None)
+
+        # file sources are written by the threads as they are
+        src_dir = mkdtemp()
+        self.addCleanup(rmtree, src_dir)
+        open(os_path_join(src_dir, 'out.html'), 'wb').write(page_data)
+        report = s.putMany([ ('out.html', open(os_path_join(src_dir, 'out.html'), 'rb'), headers) ])
+        self.assertEqual((report.stored, report.failed), (1, [ ]))
+        self.assertEqual(s.get('out.html'), page_data)
+        self.assertEqual(GzipFile(fileobj = StringIO(s.get('out.html.gz'))).read(), page_data)
+
+        s.put('out.html', page_data + 'out', headers)
+        s.copy('page9.html', 'out.html')
+        self.assertEqual(GzipFile(fileobj = StringIO(s.get('page9.html.gz'))).read(), page_data + 'out')
+        s.copy('page8.html', 'cover.jpg')
+        self.assertEqual(s.stat('page8.html.gz'), None)
+        s.delete('page9.html')
+        self.assertEqual(s.stat('page9.html.gz'), None)
+        self.assertRaises(ValueError, FilesystemStorage, self.tmp_dir, variants = [ 'zip' ])
+
+    def testManifestFilesystemStorage(self):
+        '''Unchanged objects are skipped, reconcile catches remote changes'''
+        s = self.getFilesystemStorage()
+        manifest_dir = mkdtemp()
+        self.addCleanup(rmtree, manifest_dir)
+        s.manifest = Manifest(os_path_join(manifest_dir, 'manifest.db'))
+        self.assertTrue(s.put(page_name, page_data, headers))
+        self.assertFalse(s.put(page_name, page_data, headers))
+        self.assertTrue(s.put(page_name, page_data, { 'Content-Type': 'text/plain' }))
+        report = s.putMany([ (page_name, page_data, { 'Content-Type': 'text/plain' }),
+                             ('other.html', page_data, headers) ])
+        self.assertEqual((report.stored, report.skipped), (1, 1))
+
+        # changed behind the manifest back
+        open(os_path_join(self.tmp_dir, page_name), 'w').write('changed')
+        remove(os_path_join(self.tmp_dir, 'other.html'))
+        self.assertEqual(s.manifest.reconcile(s._listing()), (0, 1, 1))
+        self.assertTrue(s.put(page_name, page_data, headers))
+        self.assertFalse(s.put(page_name, page_data, headers))
+
+    def testManifestVariantsFilesystemStorage(self):
+        '''With variants, putMany checks every object against the manifest once'''
+        s = FilesystemStorage(self.tmp_dir, variants = [ 'gzip' ], compressors = 2)
+        manifest_dir = mkdtemp()
+        self.addCleanup(rmtree, manifest_dir)
+        s.manifest = Manifest(os_path_join(manifest_dir, 'manifest.db'))
+        objects = [ ('page%d.html' % i, page_data + str(i), headers) for i in range(5) ]
+        self.assertEqual(s.putMany(objects).stored, 5)
+        self.assertEqual(GzipFile(fileobj = StringIO(s.get('page4.html.gz'))).read(), page_data + '4')
+
+        digests = [ ]
+        digest  = s.manifest.digest
+        s.manifest.digest = lambda *args: digests.append(args[0]) or digest(*args)
+        s.stats.reset()
+        report = s.putMany(objects)
+        self.assertEqual((report.stored, report.skipped, s.stats.skipped, len(digests)), (0, 5, 5, 5))
+
+
+class TestS3StorageLocal(TestCase):
+
+    def setUp(self):
+        '''Start the S3 stand-in'''
+        self.server = S3Server()
+        self.server.start()
+        self.storage = S3Storage(bucket_name, AWS_ACCESS_KEY_ID = 'key', AWS_SECRET_ACCESS_KEY = 'secret',
+                                 host = '127.0.0.1', port = self.server.server_port, secure = False)
+
+    def tearDown(self):
+        '''Stop the S3 stand-in'''
+        self.server.stop()
+
+    def testPutMany(self):
+        '''Objects are uploaded in parallel, failed uploads are retried'''
+        self.server.failPuts = 3
+        objects = [ ('page%d.html' % i, page_data, headers) for i in range(20) ]
+        report = self.storage.putMany(objects, workers = 4, backoff = 0)
+        self.assertTrue(report.ok)
+        self.assertEqual((report.stored, report.retries), (20, 3))
+        self.assertEqual(len(self.server.objects), 20)
+        self.assertEqual(self.storage.get('page19.html'), page_data)
+
+    def testStats(self):
+        '''Operations are counted and timed, with the bytes before and after gzip'''
+        self.server.failPuts = 2
+        objects = [ ('page%d.html' % i, page_data, headers) for i in range(10) ]
+        self.assertTrue(self.storage.putMany(objects, workers = 2, backoff = 0).ok)
+        self.storage.get('page0.html')
+        self.assertRaises(Exception, self.storage.get, 'missing.html')
+        stats = self.storage.stats.snapshot()
+        self.assertEqual((stats['ops']['send']['count'], stats['ops']['send']['errors']), (12, 2))
+        self.assertEqual((stats['ops']['get']['count'], stats['ops']['get']['errors']), (2, 1))
+        self.assertNotIn('getStream', stats['ops'])
+        self.assertEqual(stats['ops']['get']['bytes'], len(page_data))
+        self.assertEqual((stats['raw'], stats['retries']), (10 * len(page_data), 2))
+        self.assertEqual(stats['stored'], sum([ len(body) for (h, body) in self.server.objects.values() ]))
+        self.storage.stats.reset()
+        self.assertEqual(self.storage.stats.snapshot()['ops'], { })
+
+    def testStreaming(self):
+        '''Large objects are compressed in chunks and uploaded in parts'''
+        self.storage._part_size = 64 * 1024
+        feed = ''.join([ '<item id="%d">%s</item>\n' % (i, md5(str(i)).hexdigest()) for i in range(20000) ])
+        self.storage.send('feed.xml', StringIO(feed), headers)
+        (stored, body) = self.server.objects['/%s/feed.xml' % bucket_name]
+        self.assertTrue(len(body) > 2 * 64 * 1024)
+        self.assertTrue(int(stored['ETag'].strip('"').split('-')[1]) > 1)
+        self.assertEqual(GzipFile(fileobj = StringIO(body)).read(), feed)
+
+        stream = self.storage.getStream('feed.xml')
+        self.assertEqual(stream.read(10), feed[:10])
+        self.assertEqual(stream.read(), feed[10:])
+
+    def testCachedConfig(self):
+        '''A cached s3 storage keeps its folder and Cache-Control options apart'''
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        config = ecommerce.config.getConfigFromString(cached_conf.replace('<<DIR>>', cache_dir)
+                                                                 .replace('<<PORT>>', str(self.server.server_port)))
+        storage = getStorage(config, 'storages', 'web')
+        self.assertEqual((storage._directory, storage._backend._cache_type), (cache_dir, 'public,max-age=60'))
+        storage.put(page_name, page_data, headers)
+        self.assertEqual((storage.get(page_name), storage.get(page_name)), (page_data, page_data))
+
+    def testListDelete(self):
+        '''Objects are listed by prefix and deleted in one request'''
+        for name in ('a/1.html', 'a/2.html', 'b/1.html'):
+            self.storage.send(name, page_data)
+        self.assertEqual(list(self.storage.list('a/')), [ 'a/1.html', 'a/2.html' ])
+        self.assertEqual(self.storage.deleteMany(self.storage.list('a/')), [ ])
+        self.assertEqual(list(self.storage.list()), [ 'b/1.html' ])
@@ -19,17 +19,38 @@ from reload import reload
 from queries import findBiography, findFirstChapter, findInterview, findImages
 import queries
 
+# config reload tracking
+_reloadable = False     # True if initialized from the default configuration
+_section    = None      # the "paths" section the module was initialized from
+
 
 def initialize(config = None):
     """Initialize the cache"""
 
+    global _reloadable, _section
+
+    # only follow config reloads when using the default configuration
+    _reloadable = config is None
+
     # be sure to get a config object
     if config is None:
         config = ecommerce.config.getConfig()
 
     cacheconf._initialize(config)
 
+    _section = config.get("paths") if _reloadable else None
+
+
+def _configReloaded(config):
+    """Re-initialize (and reconnect) if the "paths" section changed"""
+
+    if _reloadable and config.get("paths") != _section:
+        initialize()
+
 
-initialize()
+# initialize (unless lazy)
+if not ecommerce.config.lazyInit:
+    initialize()
+ecommerce.config.subscribe(_configReloaded)
 
 __all__ = [ "CONT", "IMPR", "PAGE", "PROD", "SUBJ" ]
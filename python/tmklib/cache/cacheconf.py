@@ -11,8 +11,13 @@ up to date
 by Jose Luis Campanello
 """
 
+import threading
+
 import ecommerce.db
 
+# set once connected (first use initializes when lazy)
+_initialized = False
+_initLock = threading.RLock()
 _connection = None
 _database = {
     "name"                  : "fscache",
@@ -58,6 +63,7 @@ def _initialize(config = None):
     global _database
     global _paths
     global _connection
+    global _initialized
 
     # set some defaults
     _database           = {
@@ -109,3 +115,16 @@ def _initialize(config = None):
 
     # get a connection to the database
     _connection = ecommerce.db.getConnection(_database["name"])
+
+    # only now the cache can be used (a failed connect is retried on next use)
+    _initialized = True
+
+
+def _ensureInitialized():
+    """Initialize with the default config on first use (lazy initialization)"""
+
+    if not _initialized:
+        with _initLock:
+            if not _initialized:
+                import tmklib.cache
+                tmklib.cache.initialize()
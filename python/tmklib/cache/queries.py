@@ -41,6 +41,9 @@ def ensureInt(id):
 def queryDB(tableName, fieldName, id):
     """Do the actual query"""
 
+    # be sure the cache is initialized
+    cacheconf._ensureInitialized()
+
     # do the query
     cursor = cacheconf._connection.cursor()
     cursor.execute(
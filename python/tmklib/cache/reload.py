@@ -216,6 +216,9 @@ def reloadImageSite():
 def reload():
     """Re-create the cache (destroy tables and create them)"""
 
+    # be sure the cache is initialized
+    cacheconf._ensureInitialized()
+
     # reload biography
     reloadBiography()
 
@@ -5,6 +5,8 @@ by Jose Luis Campanello
 
 import urllib
 
+import ecommerce.config
+
 import tmklib.support
 
 from SUBJ import SUBJ
@@ -342,7 +344,16 @@ def cannonicals(entities):
 
 ########################################################
 
+def initialize():
+    """Load the subject tree (done at import time unless lazy initialization is on)"""
+
+    tree._initialize()
+
+########################################################
+
 __all__ = [ "SUBJ", "PROD", "CONT", "IMPR", "PAGE", "cannonicals",
-            "treePath", "treeBranch" ]
+            "treePath", "treeBranch", "initialize" ]
 
-tree._initialize()
+# initialize (unless lazy)
+if not ecommerce.config.lazyInit:
+    initialize()
@@ -3,6 +3,8 @@
 by Jose Luis Campanello
 """
 
+import threading
+
 import ecommerce.config
 import ecommerce.db
 
@@ -13,11 +15,18 @@ import SUBJ
 _tree  = None
 _nodes = None
 
+# set once the tree is completely built (first use loads it when lazy)
+_initialized = False
+_initLock    = threading.RLock()
+
 ########################################################
 
 def baseTree(seccion):
     """Find the base tree"""
 
+    # be sure the tree is loaded
+    _ensureInitialized()
+
     # return the node (none if not present)
     return _tree.get(seccion, { })
 
@@ -67,6 +76,9 @@ def basePath(seccion, grupo = -1, familia = -1, subfamilia = -1):
 def findNode(seccion, grupo = -1, familia = -1, subfamilia = -1):
     """Find a node and return the information"""
 
+    # be sure the tree is loaded
+    _ensureInitialized()
+
     # build the key
     key = (seccion, grupo, familia, subfamilia)
 
@@ -358,12 +370,27 @@ def _buildURLs():
 def _initialize():
     """Initialize the component"""
 
-    # load nodes (if needed)
-    _loadNodes()
+    global _initialized
+
+    with _initLock:
+
+        # load nodes (if needed)
+        _loadNodes()
+
+        # build urls
+        _buildURLs()
+
+        # build tree
+        _buildTree()
+
+        # only now the tree can be used (a failure is retried on next use)
+        _initialized = True
 
-    # build urls
-    _buildURLs()
 
-    # build tree
-    _buildTree()
+def _ensureInitialized():
+    """Load the tree on first use (lazy initialization)"""
 
+    if not _initialized:
+        with _initLock:
+            if not _initialized:
+                _initialize()